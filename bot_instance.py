@@ -6,6 +6,16 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN не задан")
 
-bot = Bot(token=BOT_TOKEN, parse_mode="HTML")
+
+class RateLimitedBot(Bot):
+    """Все вызовы Bot API, включая message.answer и edit_text из хендлеров, идут через общий
+    с очередью отправки лимит и паузу RetryAfter (utils/outbox.py)."""
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        from utils import outbox
+        return await outbox.direct_request(super().request, method, data, files, **kwargs)
+
+
+bot = RateLimitedBot(token=BOT_TOKEN, parse_mode="HTML")
 storage = MemoryStorage()
 dp = Dispatcher(bot, storage=storage)
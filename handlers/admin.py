@@ -1,5 +1,6 @@
 import asyncio
 import logging
+import html
 import json
 import io
 import csv
@@ -12,7 +13,7 @@ import asyncpg
 
 from bot_instance import dp, bot
 from utils.db import (
-    db_pool, is_admin, is_super_admin, is_junior_admin, has_permission,
+    acquire, is_admin, is_super_admin, is_junior_admin, has_permission,
     get_admin_permissions, update_admin_permissions,
     ensure_user_exists, is_banned, get_user_balance, update_user_balance,
     get_user_reputation, update_user_reputation, get_user_bitcoin,
@@ -26,11 +27,17 @@ from utils.db import (
     upgrade_business, get_order_book, get_active_orders, create_bitcoin_order,
     cancel_bitcoin_order, match_orders, get_media_file_id,
     perform_cleanup, export_users_to_csv, export_table_to_csv,
-    spawn_boss
+    spawn_boss, update_user_fields, get_pool_stats, write_behind_dropped,
+    get_query_stats, publish_invalidation, create_broadcast_job, get_broadcast_job,
+    set_broadcast_status
 )
+from utils.middlewares import throttle_stats
+from utils import outbox
+from utils.background import start_broadcast
 from utils.helpers import (
     safe_send_message, send_with_media, auto_delete_reply, auto_delete_message,
-    get_random_phrase, notify_chats, format_time_remaining, progress_bar
+    get_random_phrase, notify_chats, format_time_remaining, progress_bar, format_datetime,
+    broadcast_status_text
 )
 from utils.constants import (
     PERMISSIONS_LIST, DEFAULT_SETTINGS, ITEMS_PER_PAGE, SUPER_ADMINS
@@ -42,7 +49,7 @@ from utils.keyboards import (
     admin_chats_keyboard, admin_boss_keyboard, admin_auction_keyboard,
     admin_ad_keyboard, admin_exchange_keyboard, admin_business_keyboard,
     admin_media_keyboard, settings_categories_keyboard, settings_param_keyboard,
-    purchase_action_keyboard, back_keyboard, cancel_keyboard
+    purchase_action_keyboard, back_keyboard, cancel_keyboard, broadcast_job_inline
 )
 from utils.states import (
     AddBalance, RemoveBalance, AddReputation, RemoveReputation,
@@ -371,8 +378,7 @@ async def set_level_value(message: types.Message, state: FSMContext):
     data = await state.get_data()
     uid = data['user_id']
     try:
-        async with db_pool.acquire() as conn:
-            await conn.execute("UPDATE users SET level=$1 WHERE user_id=$2", level, uid)
+        await update_user_fields(uid, values={'level': level})
         await message.answer(f"✅ Пользователю {uid} установлен уровень {level}.")
         await safe_send_message(uid, f"🔝 Ваш уровень изменён на {level} администратором.")
     except Exception as e:
@@ -746,7 +752,7 @@ async def add_shop_item_photo(message: types.Message, state: FSMContext):
         return
     data = await state.get_data()
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             await conn.execute(
                 "INSERT INTO shop_items (name, description, price, stock, photo_file_id) VALUES ($1, $2, $3, $4, $5)",
                 data['name'], data['description'], data['price'], data['stock'], photo_file_id
@@ -762,7 +768,7 @@ async def remove_shop_item_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_shop"):
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             items = await conn.fetch("SELECT id, name FROM shop_items ORDER BY id")
         if not items:
             await message.answer("В магазине нет товаров.")
@@ -787,7 +793,7 @@ async def remove_shop_item(message: types.Message, state: FSMContext):
         await message.answer("❌ Введи число.")
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             await conn.execute("DELETE FROM shop_items WHERE id=$1", item_id)
         await message.answer("✅ Товар удалён, если существовал.", reply_markup=admin_shop_keyboard())
     except Exception as e:
@@ -856,7 +862,7 @@ async def edit_shop_item_final(message: types.Message, state: FSMContext):
     item_id = data['item_id']
     field = data['field']
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             await conn.execute(f"UPDATE shop_items SET {field}=$1 WHERE id=$2", value, item_id)
         await message.answer("✅ Товар обновлён.", reply_markup=admin_shop_keyboard())
     except Exception as e:
@@ -876,7 +882,7 @@ async def list_shop_items(message: types.Message):
         pass
     offset = (page - 1) * ITEMS_PER_PAGE
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             total = await conn.fetchval("SELECT COUNT(*) FROM shop_items")
             items = await conn.fetch(
                 "SELECT id, name, description, price, stock, photo_file_id FROM shop_items ORDER BY id LIMIT $1 OFFSET $2",
@@ -916,7 +922,7 @@ async def admin_purchases(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_shop"):
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             rows = await conn.fetch(
                 "SELECT p.id, u.user_id, u.username, s.name, p.purchase_date, p.status FROM purchases p "
                 "JOIN users u ON p.user_id = u.user_id JOIN shop_items s ON p.item_id = s.id "
@@ -927,7 +933,7 @@ async def admin_purchases(message: types.Message):
             return
         for row in rows:
             pid, uid, username, item_name, date, status = row['id'], row['user_id'], row['username'], row['name'], row['purchase_date'], row['status']
-            text = f"🆔 {pid}\nПользователь: {uid} (@{username})\nТовар: {item_name}\nДата: {date}"
+            text = f"🆔 {pid}\nПользователь: {uid} (@{username})\nТовар: {item_name}\nДата: {format_datetime(date)}"
             await message.answer(text, reply_markup=purchase_action_keyboard(pid))
     except Exception as e:
         logging.error(f"Admin purchases error: {e}", exc_info=True)
@@ -941,7 +947,7 @@ async def purchase_done(callback: types.CallbackQuery):
         return
     purchase_id = int(callback.data.split("_")[2])
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             await conn.execute("UPDATE purchases SET status='completed' WHERE id=$1", purchase_id)
             user_id = await conn.fetchval("SELECT user_id FROM purchases WHERE id=$1", purchase_id)
             if user_id:
@@ -959,7 +965,7 @@ async def purchase_reject(callback: types.CallbackQuery):
         return
     purchase_id = int(callback.data.split("_")[2])
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             await conn.execute("UPDATE purchases SET status='rejected' WHERE id=$1", purchase_id)
             user_id = await conn.fetchval("SELECT user_id FROM purchases WHERE id=$1", purchase_id)
             if user_id:
@@ -1013,11 +1019,12 @@ async def add_channel_link(message: types.Message, state: FSMContext):
     link = None if message.text.lower() == 'нет' else message.text.strip()
     data = await state.get_data()
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             await conn.execute(
                 "INSERT INTO channels (chat_id, title, invite_link) VALUES ($1, $2, $3)",
                 data['chat_id'], data['title'], link
             )
+            await publish_invalidation("channels", conn=conn)
         await message.answer("✅ Канал добавлен!", reply_markup=admin_channel_keyboard())
     except asyncpg.UniqueViolationError:
         await message.answer("❌ Канал с таким chat_id уже существует.")
@@ -1041,8 +1048,9 @@ async def remove_channel(message: types.Message, state: FSMContext):
         return
     chat_id = message.text.strip()
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             await conn.execute("DELETE FROM channels WHERE chat_id=$1", chat_id)
+            await publish_invalidation("channels", conn=conn)
         await message.answer("✅ Канал удалён, если существовал.", reply_markup=admin_channel_keyboard())
     except Exception as e:
         logging.error(f"Remove channel error: {e}", exc_info=True)
@@ -1125,7 +1133,7 @@ async def create_promo_max_uses(message: types.Message, state: FSMContext):
         return
     data = await state.get_data()
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             await conn.execute(
                 "INSERT INTO promocodes (code, reward, max_uses, created_at) VALUES ($1, $2, $3, $4)",
                 data['code'], data['reward'], max_uses, datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -1151,7 +1159,7 @@ async def list_promos(message: types.Message):
         pass
     offset = (page - 1) * ITEMS_PER_PAGE
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             total = await conn.fetchval("SELECT COUNT(*) FROM promocodes")
             rows = await conn.fetch(
                 "SELECT code, reward, max_uses, used_count FROM promocodes LIMIT $1 OFFSET $2",
@@ -1332,7 +1340,7 @@ async def create_task_max_completions(message: types.Message, state: FSMContext)
         return
     data = await state.get_data()
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             await conn.execute(
                 "INSERT INTO tasks (name, description, task_type, target_id, reward_coins, reward_reputation, required_days, penalty_days, max_completions, created_by, created_at, active) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12)",
                 data['name'], data['description'], data['task_type'], data['target_id'], data['reward_coins'], data['reward_reputation'], data['required_days'], data['penalty_days'], max_comp, message.from_user.id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), True
@@ -1347,7 +1355,7 @@ async def create_task_max_completions(message: types.Message, state: FSMContext)
 async def list_tasks_admin(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_tasks"):
         return
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         rows = await conn.fetch("SELECT id, name, description, reward_coins, reward_reputation, active FROM tasks ORDER BY id")
     if not rows:
         await message.answer("Нет созданных заданий.")
@@ -1377,7 +1385,7 @@ async def delete_task_finish(message: types.Message, state: FSMContext):
         await message.answer("❌ Введи число.")
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             await conn.execute("DELETE FROM tasks WHERE id=$1", task_id)
             await conn.execute("DELETE FROM user_tasks WHERE task_id=$1", task_id)
         await message.answer("✅ Задание удалено, если существовало.", reply_markup=admin_tasks_keyboard())
@@ -1430,11 +1438,12 @@ async def block_user_reason(message: types.Message, state: FSMContext):
     data = await state.get_data()
     uid = data['user_id']
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             await conn.execute(
                 "INSERT INTO banned_users (user_id, banned_by, banned_date, reason) VALUES ($1, $2, $3, $4) ON CONFLICT (user_id) DO NOTHING",
                 uid, message.from_user.id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), reason
             )
+            await publish_invalidation("ban", uid, conn=conn)
         await message.answer(f"✅ Пользователь {uid} заблокирован.")
         await safe_send_message(uid, f"⛔ Вы заблокированы в боте. Причина: {reason if reason else 'не указана'}")
     except Exception as e:
@@ -1461,8 +1470,9 @@ async def unblock_user_finish(message: types.Message, state: FSMContext):
         return
     uid = user_data['user_id']
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             await conn.execute("DELETE FROM banned_users WHERE user_id=$1", uid)
+            await publish_invalidation("ban", uid, conn=conn)
         await message.answer(f"✅ Пользователь {uid} разблокирован.")
         await safe_send_message(uid, "🔓 Вы разблокированы в боте.")
     except Exception as e:
@@ -1474,7 +1484,7 @@ async def unblock_user_finish(message: types.Message, state: FSMContext):
 async def list_banned(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_bans"):
         return
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         rows = await conn.fetch("SELECT user_id, banned_date, reason FROM banned_users ORDER BY banned_date DESC")
     if not rows:
         await message.answer("Нет заблокированных пользователей.")
@@ -1537,11 +1547,12 @@ async def add_admin_done(callback: types.CallbackQuery, state: FSMContext):
     uid = data['user_id']
     perms = data.get('selected_perms', [])
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             await conn.execute(
                 "INSERT INTO admins (user_id, added_by, added_date, permissions) VALUES ($1, $2, $3, $4) ON CONFLICT (user_id) DO UPDATE SET permissions=$4",
                 uid, callback.from_user.id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), json.dumps(perms)
             )
+            await publish_invalidation("admin", uid, conn=conn)
         await callback.message.edit_text(f"✅ Пользователь {uid} теперь младший админ с правами: {', '.join(perms) if perms else 'нет прав'}.")
         await safe_send_message(uid, f"🔔 Вам назначены права администратора!\nВаши права: {', '.join(perms) if perms else 'нет прав'}.\nПожалуйста, нажмите /start для обновления меню.")
     except Exception as e:
@@ -1632,8 +1643,9 @@ async def remove_admin_finish(message: types.Message, state: FSMContext):
         await state.finish()
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             await conn.execute("DELETE FROM admins WHERE user_id=$1", uid)
+            await publish_invalidation("admin", uid, conn=conn)
         await message.answer(f"✅ Пользователь {uid} больше не админ, если был им.")
         await safe_send_message(uid, "🔔 Ваши права администратора были отозваны.")
     except Exception as e:
@@ -1645,7 +1657,7 @@ async def remove_admin_finish(message: types.Message, state: FSMContext):
 async def list_admins(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_admins"):
         return
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         rows = await conn.fetch("SELECT user_id, added_date, permissions FROM admins ORDER BY added_date")
     if not rows:
         await message.answer("Нет младших админов.")
@@ -1728,7 +1740,7 @@ async def process_chat_id(message: types.Message, state: FSMContext):
         return
     data = await state.get_data()
     action = data.get('action')
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         if action == "confirm":
             request = await conn.fetchrow("SELECT * FROM chat_confirmation_requests WHERE chat_id=$1", chat_id)
             if request:
@@ -1768,7 +1780,7 @@ async def admin_boss_menu(message: types.Message):
 async def list_active_bosses(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_bosses"):
         return
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         rows = await conn.fetch("SELECT * FROM bosses WHERE status='active' ORDER BY spawned_at")
     if not rows:
         await message.answer("Нет активных боссов.")
@@ -1787,7 +1799,7 @@ async def delete_boss_callback(callback: types.CallbackQuery):
         await callback.message.answer("❌ Недостаточно прав")
         return
     boss_id = int(callback.data.split("_")[2])
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         boss = await conn.fetchrow("SELECT * FROM bosses WHERE id=$1", boss_id)
         if not boss:
             await callback.message.answer("❌ Босс не найден")
@@ -1893,7 +1905,7 @@ async def delete_boss_by_id_final(message: types.Message, state: FSMContext):
     if message.text.lower() == 'да':
         data = await state.get_data()
         boss_id = data['boss_id']
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             boss = await conn.fetchrow("SELECT * FROM bosses WHERE id=$1", boss_id)
             if not boss:
                 await message.answer("❌ Босс с таким ID не найден.")
@@ -2026,7 +2038,7 @@ async def create_auction_photo(message: types.Message, state: FSMContext):
         return
     data = await state.get_data()
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             await conn.execute(
                 "INSERT INTO auctions (item_name, description, start_price, current_price, end_time, target_price, created_by, photo_file_id) VALUES ($1, $2, $3, $4, $5, $6, $7, $8)",
                 data['item_name'], data['description'], data['start_price'], data['start_price'], data['end_time'], data['target_price'], message.from_user.id, photo_file_id
@@ -2041,7 +2053,7 @@ async def create_auction_photo(message: types.Message, state: FSMContext):
 async def list_active_auctions(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_auctions"):
         return
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         rows = await conn.fetch("SELECT * FROM auctions WHERE status='active' ORDER BY created_at")
     if not rows:
         await message.answer("Нет активных аукционов.")
@@ -2069,7 +2081,7 @@ async def cancel_auction_finish(message: types.Message, state: FSMContext):
     except:
         await message.answer("❌ Введи число.")
         return
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         exists = await conn.fetchval("SELECT 1 FROM auctions WHERE id=$1", auction_id)
         if not exists:
             await message.answer("❌ Аукцион с таким ID не найден.")
@@ -2132,7 +2144,7 @@ async def create_ad_target(message: types.Message, state: FSMContext):
         return
     data = await state.get_data()
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             await conn.execute(
                 "INSERT INTO ads (text, interval_minutes, target, last_sent, enabled) VALUES ($1, $2, $3, $4, $5)",
                 data['text'], data['interval'], target, datetime.now(), True
@@ -2147,7 +2159,7 @@ async def create_ad_target(message: types.Message, state: FSMContext):
 async def list_ads(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_ads"):
         return
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         rows = await conn.fetch("SELECT id, text, interval_minutes, enabled FROM ads ORDER BY id")
     if not rows:
         await message.answer("Нет рекламных объявлений.")
@@ -2176,7 +2188,7 @@ async def edit_ad_id(message: types.Message, state: FSMContext):
     except:
         await message.answer("❌ Введи число.")
         return
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         ad = await conn.fetchrow("SELECT * FROM ads WHERE id=$1", ad_id)
         if not ad:
             await message.answer("❌ Реклама не найдена.")
@@ -2230,7 +2242,7 @@ async def edit_ad_value(message: types.Message, state: FSMContext):
         val = message.text
 
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             await conn.execute(f"UPDATE ads SET {field}=$1 WHERE id=$2", val, ad_id)
         await message.answer("✅ Реклама обновлена.", reply_markup=admin_ad_keyboard())
     except Exception as e:
@@ -2256,7 +2268,7 @@ async def delete_ad_finish(message: types.Message, state: FSMContext):
     except:
         await message.answer("❌ Введи число.")
         return
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         await conn.execute("DELETE FROM ads WHERE id=$1", ad_id)
     await message.answer("✅ Реклама удалена, если существовала.", reply_markup=admin_ad_keyboard())
     await state.finish()
@@ -2300,7 +2312,7 @@ async def admin_remove_order_finish(message: types.Message, state: FSMContext):
     except:
         await message.answer("❌ Введи число.")
         return
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         async with conn.transaction():
             order = await conn.fetchrow("SELECT * FROM bitcoin_orders WHERE id=$1 AND status='active'", order_id)
             if not order:
@@ -2320,7 +2332,7 @@ async def admin_remove_order_finish(message: types.Message, state: FSMContext):
 async def admin_trade_history(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_exchange"):
         return
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         rows = await conn.fetch("SELECT * FROM bitcoin_trades ORDER BY traded_at DESC LIMIT 50")
     if not rows:
         await message.answer("Нет сделок.")
@@ -2445,7 +2457,7 @@ async def add_business_max_level(message: types.Message, state: FSMContext):
         return
     data = await state.get_data()
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             await conn.execute(
                 "INSERT INTO business_types (name, emoji, base_price_btc, base_income_cents, description, max_level, available) VALUES ($1, $2, $3, $4, $5, $6, $7)",
                 data['name'], data['emoji'], data['price'], data['income'], data['description'], max_level, True
@@ -2545,7 +2557,7 @@ async def edit_business_value(message: types.Message, state: FSMContext):
         val = message.text
 
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             column_map = {
                 'name': 'name',
                 'emoji': 'emoji',
@@ -2603,7 +2615,7 @@ async def toggle_business_finish(message: types.Message, state: FSMContext):
         bid = data['business_id']
         new_status = data['new_status']
         try:
-            async with db_pool.acquire() as conn:
+            async with acquire() as conn:
                 await conn.execute("UPDATE business_types SET available=$1 WHERE id=$2", new_status, bid)
             await message.answer(f"✅ Доступность бизнеса изменена на {'✅ доступен' if new_status else '❌ недоступен'}.", reply_markup=admin_business_keyboard())
         except Exception as e:
@@ -2658,11 +2670,12 @@ async def add_media_file(message: types.Message, state: FSMContext):
     data = await state.get_data()
     key = data['key']
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             await conn.execute(
                 "INSERT INTO media (key, file_id, description) VALUES ($1, $2, $3) ON CONFLICT (key) DO UPDATE SET file_id=$2",
                 key, file_id, f"Медиа для {key}"
             )
+            await publish_invalidation("media", key, conn=conn)
         await message.answer(f"✅ Медиа с ключом '{key}' сохранено.")
     except Exception as e:
         logging.error(f"Add media error: {e}", exc_info=True)
@@ -2685,8 +2698,9 @@ async def remove_media_finish(message: types.Message, state: FSMContext):
         return
     key = message.text.strip()
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             await conn.execute("DELETE FROM media WHERE key=$1", key)
+            await publish_invalidation("media", key, conn=conn)
         await message.answer(f"✅ Медиа с ключом '{key}' удалено, если существовало.")
     except Exception as e:
         logging.error(f"Remove media error: {e}", exc_info=True)
@@ -2697,7 +2711,7 @@ async def remove_media_finish(message: types.Message, state: FSMContext):
 async def list_media(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_media"):
         return
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         rows = await conn.fetch("SELECT key, description FROM media ORDER BY key")
     if not rows:
         await message.answer("Нет сохранённых медиа.")
@@ -2714,7 +2728,7 @@ async def stats_handler(message: types.Message):
         await message.answer("❌ Недостаточно прав.")
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire(readonly=True) as conn:
             users = await conn.fetchval("SELECT COUNT(*) FROM users")
             total_balance = await conn.fetchval("SELECT SUM(balance) FROM users") or 0.0
             total_reputation = await conn.fetchval("SELECT SUM(reputation) FROM users") or 0
@@ -2756,6 +2770,53 @@ async def stats_handler(message: types.Message):
         logging.error(f"Stats error: {e}", exc_info=True)
         await message.answer("❌ Ошибка получения статистики.")
 
+@dp.message_handler(commands=['dbstats'])
+async def db_stats_command(message: types.Message):
+    if message.chat.type != 'private':
+        return
+    if not await check_admin_permissions(message.from_user.id, "view_stats"):
+        await message.answer("❌ Недостаточно прав.")
+        return
+    stats = get_pool_stats()
+    text = (
+        f"🗄 <b>Пул соединений:</b>\n"
+        f"Занято: {stats['in_use']} / {stats['size']} (макс. {stats['max_size']}), свободно: {stats['idle']}\n"
+        f"Захватов: {stats['acquires']}\n"
+        f"Ожидание: ср. {stats['wait_avg'] * 1000:.1f} мс, p95 {stats['wait_p95'] * 1000:.1f} мс, макс. {stats['wait_max'] * 1000:.1f} мс\n"
+        f"Фоновых соединений: {stats['background_in_use']}, нагрузка интерактива: {stats['interactive_pressure'] * 1000:.0f} мс\n"
+        f"Отказов «занято»: {stats['busy_rejections']}\n"
+        f"Апдейтов пропущено: {throttle_stats['passed']}, отброшено троттлингом: "
+        f"{throttle_stats['throttled_user']} (пользователь) / {throttle_stats['throttled_chat']} (чат)\n"
+    )
+    out = outbox.get_outbox_stats()
+    paused = f", пауза {out['paused']:.0f} с" if out['paused'] else ""
+    text += (
+        f"\n📤 <b>Очередь отправки:</b> {out['queue']} в очереди, {out['parked']} ждут слота чата{paused}\n"
+        f"Отправлено: {out['sent']}, RetryAfter: {out['retry_after']}, недоступны: {out['unreachable']}, ошибок: {out['failed']}\n"
+    )
+    if write_behind_dropped:
+        text += "\n🗑 <b>Отложенная запись, выброшено:</b> " + ", ".join(
+            f"{section}: {count}" for section, count in write_behind_dropped.items()
+        ) + "\n"
+    if stats['holders']:
+        text += "\n<b>Дольше всех держат соединение:</b>\n"
+        for h in stats['holders']:
+            text += f"{h['site']}: {h['count']} раз, ср. {h['avg'] * 1000:.0f} мс, макс. {h['max']:.1f} с\n"
+    if stats['long_holds']:
+        text += "\n⚠️ <b>Сейчас удерживаются долго:</b>\n"
+        for site, held in stats['long_holds']:
+            text += f"{site}: {held:.1f} с\n"
+    queries = get_query_stats(5)
+    if queries:
+        text += "\n🐢 <b>Самые затратные запросы:</b>\n"
+        for fingerprint, q in queries:
+            site = q['sites'].most_common(1)[0][0]
+            text += (
+                f"<code>{html.escape(fingerprint[:120])}</code>\n"
+                f"   {q['count']} раз, ср. {q['total'] / q['count']:.1f} мс, макс. {q['max']:.0f} мс, {site}\n"
+            )
+    await message.answer(text)
+
 # ==================== РАССЫЛКА ====================
 @dp.message_handler(lambda message: message.text == "📢 Рассылка")
 async def broadcast_start(message: types.Message):
@@ -2796,57 +2857,37 @@ async def broadcast_media(message: types.Message, state: FSMContext):
     await state.finish()
 
     status_msg = await message.answer("⏳ Рассылка начата... Это может занять некоторое время.")
-
-    async with db_pool.acquire() as conn:
-        users = await conn.fetch("SELECT user_id FROM users")
-        users = [r['user_id'] for r in users]
-
-    sent = 0
-    failed = 0
-    total = len(users)
-
-    for i, uid in enumerate(users):
-        if await is_banned(uid):
-            continue
-        try:
-            if content['type'] == 'text':
-                await bot.send_message(uid, content['text'])
-            elif content['type'] == 'photo':
-                await bot.send_photo(uid, content['file_id'], caption=content['caption'])
-            elif content['type'] == 'video':
-                await bot.send_video(uid, content['file_id'], caption=content['caption'])
-            elif content['type'] == 'document':
-                await bot.send_document(uid, content['file_id'], caption=content['caption'])
-            sent += 1
-        except (BotBlocked, UserDeactivated, ChatNotFound):
-            failed += 1
-        except RetryAfter as e:
-            await asyncio.sleep(e.timeout)
-            try:
-                if content['type'] == 'text':
-                    await bot.send_message(uid, content['text'])
-                else:
-                    if content['type'] == 'photo':
-                        await bot.send_photo(uid, content['file_id'], caption=content['caption'])
-                    elif content['type'] == 'video':
-                        await bot.send_video(uid, content['file_id'], caption=content['caption'])
-                    elif content['type'] == 'document':
-                        await bot.send_document(uid, content['file_id'], caption=content['caption'])
-                sent += 1
-            except:
-                failed += 1
-        except Exception as e:
-            failed += 1
-
-        if (i + 1) % 10 == 0:
-            try:
-                await status_msg.edit_text(f"⏳ Прогресс: {i+1}/{total}\n✅ Отправлено: {sent}\n❌ Ошибок: {failed}")
-            except:
-                pass
-
-        await asyncio.sleep(0.05)
-
-    await status_msg.edit_text(f"✅ Рассылка завершена!\n📊 Отправлено: {sent}\n❌ Ошибок: {failed}\n👥 Всего: {total}")
+    job_id = await create_broadcast_job(message.from_user.id, content, status_msg.chat.id, status_msg.message_id)
+    job = await get_broadcast_job(job_id)
+    await status_msg.edit_text(broadcast_status_text(job), reply_markup=broadcast_job_inline(job_id, job['status']))
+    start_broadcast(job_id)
+
+@dp.callback_query_handler(lambda c: c.data.startswith(("bcast_pause_", "bcast_resume_", "bcast_cancel_")))
+async def broadcast_control(callback: types.CallbackQuery):
+    if not await check_admin_permissions(callback.from_user.id, "broadcast"):
+        await callback.answer("❌ Недостаточно прав.", show_alert=True)
+        return
+    _, action, job_id = callback.data.split("_")
+    job_id = int(job_id)
+    if action == "pause":
+        job = await set_broadcast_status(job_id, 'paused', ['running'])
+    elif action == "resume":
+        job = await set_broadcast_status(job_id, 'running', ['paused'])
+        if job:
+            start_broadcast(job_id)
+    else:
+        job = await set_broadcast_status(job_id, 'cancelled', ['running', 'paused'])
+    if job is None:
+        await callback.answer("Рассылка уже в другом состоянии.", show_alert=True)
+        job = await get_broadcast_job(job_id)
+        if job is None:
+            return
+    else:
+        await callback.answer()
+    try:
+        await callback.message.edit_text(broadcast_status_text(job), reply_markup=broadcast_job_inline(job_id, job['status']))
+    except Exception:
+        pass
 
 # ==================== ОЧИСТКА СТАРЫХ ЗАПИСЕЙ ====================
 @dp.message_handler(lambda message: message.text == "🧹 Очистка")
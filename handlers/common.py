@@ -11,8 +11,9 @@ from utils.db import (
     get_user_level, get_user_exp, get_user_stats, get_user_bitcoin, get_user_authority,
     get_total_user_authority, get_total_user_fights, update_user_balance,
     update_user_reputation, get_setting, get_setting_int, get_setting_float,
-    check_subscription, db_pool
+    update_user_fields, check_subscription, acquire, DatabaseBusy
 )
+from utils.decorators import guarded
 from utils.helpers import (
     safe_send_message, send_with_media, auto_delete_reply, auto_delete_message,
     progress_bar, get_random_phrase, notify_chats, find_user_by_input
@@ -37,6 +38,19 @@ async def cmd_cancel(message: types.Message, state: FSMContext):
     await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
     await message.answer("❌ Действие отменено.", reply_markup=main_menu_keyboard(await is_admin(user_id)))
 
+# ==================== ПЕРЕГРУЗКА БД ====================
+@dp.errors_handler(exception=DatabaseBusy)
+async def database_busy_handler(update: types.Update, exception: DatabaseBusy):
+    text = "⏳ Бот сейчас перегружен, попробуй ещё раз через пару секунд."
+    try:
+        if update.callback_query:
+            await update.callback_query.answer(text, show_alert=True)
+        elif update.message and update.message.chat.type == 'private':
+            await update.message.answer(text)
+    except Exception:
+        pass
+    return True
+
 # ==================== СТАРТ И ГЛАВНОЕ МЕНЮ ====================
 @dp.message_handler(commands=['start'])
 async def cmd_start(message: types.Message):
@@ -52,7 +66,7 @@ async def cmd_start(message: types.Message):
         try:
             referrer_id = int(args[3:])
             if referrer_id != user_id:
-                async with db_pool.acquire() as conn:
+                async with acquire() as conn:
                     referrer_exists = await conn.fetchval("SELECT 1 FROM users WHERE user_id=$1", referrer_id)
                     if referrer_exists and not await is_banned(referrer_id):
                         existing = await conn.fetchval("SELECT 1 FROM referrals WHERE referred_id=$1", user_id)
@@ -140,7 +154,7 @@ async def check_subscription_callback(callback: types.CallbackQuery):
         await callback.answer("⛔ Вы заблокированы.", show_alert=True)
         return
     await ensure_user_exists(user_id, callback.from_user.username, callback.from_user.first_name)
-    ok, not_subscribed = await check_subscription(user_id)
+    ok, not_subscribed = await check_subscription(user_id, force=True)
     if ok:
         await callback.message.delete()
         is_admin_user = await is_admin(user_id)
@@ -158,20 +172,11 @@ async def no_link_callback(callback: types.CallbackQuery):
 
 # ==================== ПРОФИЛЬ ====================
 @dp.message_handler(lambda message: message.text == "👤 Профиль")
+@guarded()
 async def profile_handler(message: types.Message):
-    if message.chat.type != 'private':
-        return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
-        return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
-    ok, not_subscribed = await check_subscription(user_id)
-    if not ok:
-        await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
-        return
-
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             row = await conn.fetchrow(
                 "SELECT balance, reputation, total_spent, negative_balance, joined_date, "
                 "theft_attempts, theft_success, theft_failed, theft_protected, "
@@ -259,17 +264,9 @@ async def profile_handler(message: types.Message):
     await send_with_media(user_id, text, media_key='profile', reply_markup=main_menu_keyboard(await is_admin(user_id)))
   # ==================== УРОВЕНЬ ====================
 @dp.message_handler(lambda message: message.text == "📊 Уровень")
+@guarded()
 async def level_handler(message: types.Message):
-    if message.chat.type != 'private':
-        return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
-        return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
-    ok, not_subscribed = await check_subscription(user_id)
-    if not ok:
-        await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
-        return
     level = await get_user_level(user_id)
     exp = await get_user_exp(user_id)
     level_mult = await get_setting_int("level_multiplier")
@@ -289,7 +286,7 @@ async def level_handler(message: types.Message):
     }
     level_name = level_names.get(level, f"Уровень {level}")
     
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         next_reward = await conn.fetchrow(
             "SELECT coins, reputation FROM level_rewards WHERE level=$1",
             level + 1
@@ -309,17 +306,9 @@ async def level_handler(message: types.Message):
 
 # ==================== РЕПУТАЦИЯ ====================
 @dp.message_handler(lambda message: message.text == "⭐️ Репутация")
+@guarded()
 async def reputation_handler(message: types.Message):
-    if message.chat.type != 'private':
-        return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
-        return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
-    ok, not_subscribed = await check_subscription(user_id)
-    if not ok:
-        await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
-        return
     rep = await get_user_reputation(user_id)
     theft_bonus = float(await get_setting_float("reputation_theft_bonus")) * rep
     defense_bonus = float(await get_setting_float("reputation_defense_bonus")) * rep
@@ -344,57 +333,36 @@ async def reputation_handler(message: types.Message):
 
 # ==================== ЕЖЕДНЕВНЫЙ БОНУС ====================
 @dp.message_handler(lambda message: message.text == "🎁 Бонус")
+@guarded()
 async def bonus_handler(message: types.Message):
-    if message.chat.type != 'private':
-        return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
-        return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
-    ok, not_subscribed = await check_subscription(user_id)
-    if not ok:
-        await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
-        return
-
-    async with db_pool.acquire() as conn:
-        last_bonus_str = await conn.fetchval("SELECT last_bonus FROM users WHERE user_id=$1", user_id)
+    async with acquire() as conn:
+        last_bonus = await conn.fetchval("SELECT last_bonus FROM users WHERE user_id=$1", user_id)
 
         now = datetime.now()
-        if last_bonus_str:
-            try:
-                last_bonus = datetime.strptime(last_bonus_str, "%Y-%m-%d %H:%M:%S")
-                if last_bonus.date() == now.date():
-                    next_bonus = last_bonus + timedelta(days=1)
-                    time_left = next_bonus - now
-                    hours, remainder = divmod(time_left.seconds, 3600)
-                    minutes, _ = divmod(remainder, 60)
-                    await message.answer(f"⏳ Бонус уже получен сегодня. Следующий через {hours} ч {minutes} мин.")
-                    return
-            except:
-                pass
+        if last_bonus:
+            last_bonus = last_bonus.astimezone().replace(tzinfo=None)
+            if last_bonus.date() == now.date():
+                next_bonus = last_bonus + timedelta(days=1)
+                time_left = next_bonus - now
+                hours, remainder = divmod(time_left.seconds, 3600)
+                minutes, _ = divmod(remainder, 60)
+                await message.answer(f"⏳ Бонус уже получен сегодня. Следующий через {hours} ч {minutes} мин.")
+                return
 
         bonus = random.randint(10, 50)
         phrase = get_random_phrase(BONUS_PHRASES, bonus=bonus)
 
-        await conn.execute(
-            "UPDATE users SET balance = balance + $1, last_bonus = $2 WHERE user_id=$3",
-            bonus, now.strftime("%Y-%m-%d %H:%M:%S"), user_id
-        )
+        async with conn.transaction():
+            await update_user_balance(user_id, bonus, conn=conn)
+            await update_user_fields(user_id, values={'last_bonus': now}, conn=conn)
     await message.answer(phrase, reply_markup=main_menu_keyboard(await is_admin(user_id)))
 
 # ==================== ТОП ИГРОКОВ ====================
 @dp.message_handler(lambda message: message.text == "🏆 Топ игроков")
+@guarded()
 async def leaderboard_menu(message: types.Message):
-    if message.chat.type != 'private':
-        return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
-        return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
-    ok, not_subscribed = await check_subscription(user_id)
-    if not ok:
-        await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
-        return
     kb = ReplyKeyboardMarkup(keyboard=[
         [KeyboardButton(text="💰 Самые богатые")],
         [KeyboardButton(text="💸 Транжиры")],
@@ -419,7 +387,7 @@ async def show_top(message: types.Message, order_field: str, title: str):
         pass
     offset = (page - 1) * ITEMS_PER_PAGE
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire(readonly=True) as conn:
             if order_field == 'bitcoin_balance':
                 order_expr = "bitcoin_balance"
             else:
@@ -9,23 +9,24 @@ from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 from bot_instance import dp, bot
 from utils.db import (
-    db_pool, ensure_user_exists, is_banned, is_admin, has_permission,
+    acquire, ensure_user_exists, is_banned, is_admin, has_permission,
     get_user_balance, update_user_balance, update_user_total_spent,
     get_user_reputation, update_user_reputation, get_user_bitcoin,
     update_user_bitcoin, get_user_authority, update_user_authority,
-    get_user_level, add_exp, get_setting, get_setting_int, get_setting_float,
-    get_random_user, find_user_by_input, check_global_cooldown, set_global_cooldown,
-    get_media_file_id, check_subscription
+    get_user_level, apply_wallet_deltas, update_user_fields, get_setting, get_setting_int, get_setting_float,
+    get_random_user, find_user_by_input, check_global_cooldown,
+    get_media_file_id, check_subscription, check_channel_member, get_admin_ids
 )
+from utils.decorators import guarded
 from utils.helpers import (
     safe_send_message, send_with_media, auto_delete_reply, auto_delete_message,
-    get_random_phrase, notify_chats, progress_bar, format_time_remaining
+    get_random_phrase, notify_chats, progress_bar, format_time_remaining, format_datetime
 )
 from utils.constants import (
     PURCHASE_PHRASES, BIG_PURCHASE_THRESHOLD, CHAT_PURCHASE_PHRASES,
     THEFT_CHOICE_PHRASES, THEFT_COOLDOWN_PHRASES, THEFT_NO_MONEY_PHRASES,
     THEFT_SUCCESS_PHRASES, THEFT_FAIL_PHRASES, THEFT_DEFENSE_PHRASES,
-    THEFT_VICTIM_DEFENSE_PHRASES, ITEMS_PER_PAGE, SUPER_ADMINS
+    THEFT_VICTIM_DEFENSE_PHRASES, ITEMS_PER_PAGE
 )
 from utils.keyboards import (
     main_menu_keyboard, back_keyboard, cancel_keyboard, subscription_inline,
@@ -38,17 +39,9 @@ from utils.states import (
 
 # ==================== МАГАЗИН ПОДАРКОВ ====================
 @dp.message_handler(lambda message: message.text == "🛒 Магазин подарков")
+@guarded()
 async def shop_handler(message: types.Message):
-    if message.chat.type != 'private':
-        return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
-        return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
-    ok, not_subscribed = await check_subscription(user_id)
-    if not ok:
-        await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
-        return
     page = 1
     try:
         parts = message.text.split()
@@ -58,7 +51,7 @@ async def shop_handler(message: types.Message):
         pass
     offset = (page - 1) * ITEMS_PER_PAGE
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             total = await conn.fetchval("SELECT COUNT(*) FROM shop_items")
             rows = await conn.fetch(
                 "SELECT id, name, description, price, stock, photo_file_id FROM shop_items ORDER BY id LIMIT $1 OFFSET $2",
@@ -117,7 +110,7 @@ async def buy_callback(callback: types.CallbackQuery):
         return
     item_id = int(callback.data.split("_")[1])
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             row = await conn.fetchrow("SELECT name, price, stock FROM shop_items WHERE id=$1", item_id)
             if not row:
                 await callback.message.answer("Товар не найден")
@@ -135,7 +128,7 @@ async def buy_callback(callback: types.CallbackQuery):
                 await update_user_total_spent(user_id, price)
                 await conn.execute(
                     "INSERT INTO purchases (user_id, item_id, purchase_date) VALUES ($1, $2, $3)",
-                    user_id, item_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    user_id, item_id, datetime.now()
                 )
                 if stock != -1:
                     await conn.execute("UPDATE shop_items SET stock = stock - 1 WHERE id=$1", item_id)
@@ -156,11 +149,7 @@ async def buy_callback(callback: types.CallbackQuery):
         await callback.message.answer("❌ Ошибка при покупке. Попробуй позже.")
 
 async def notify_admins_about_purchase(user: types.User, item_name: str, price: float):
-    admins = SUPER_ADMINS.copy()
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch("SELECT user_id FROM admins")
-        for row in rows:
-            admins.append(row['user_id'])
+    admins = get_admin_ids()
     for admin_id in admins:
         await safe_send_message(admin_id,
             f"🛒 Покупка: пользователь {user.full_name} (@{user.username})\n"
@@ -169,17 +158,9 @@ async def notify_admins_about_purchase(user: types.User, item_name: str, price:
 
 # ==================== МОИ ПОКУПКИ ====================
 @dp.message_handler(lambda message: message.text == "💰 Мои покупки")
+@guarded()
 async def my_purchases(message: types.Message):
-    if message.chat.type != 'private':
-        return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
-        return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
-    ok, not_subscribed = await check_subscription(user_id)
-    if not ok:
-        await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
-        return
     page = 1
     try:
         parts = message.text.split()
@@ -189,7 +170,7 @@ async def my_purchases(message: types.Message):
         pass
     offset = (page - 1) * ITEMS_PER_PAGE
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             total = await conn.fetchval("SELECT COUNT(*) FROM purchases WHERE user_id=$1", user_id)
             rows = await conn.fetch(
                 "SELECT p.id, s.name, p.purchase_date, p.status, p.admin_comment FROM purchases p "
@@ -203,7 +184,7 @@ async def my_purchases(message: types.Message):
         for row in rows:
             pid, name, date, status, comment = row['id'], row['name'], row['purchase_date'], row['status'], row['admin_comment']
             status_emoji = "⏳" if status == 'pending' else "✅" if status == 'completed' else "❌"
-            text += f"{status_emoji} {name} от {date}\n"
+            text += f"{status_emoji} {name} от {format_datetime(date)}\n"
             if comment:
                 text += f"   Комментарий: {comment}\n"
             text += "\n"
@@ -231,17 +212,9 @@ async def mypurchases_page_callback(callback: types.CallbackQuery):
     await callback.answer()
   # ==================== ПРОМОКОД ====================
 @dp.message_handler(lambda message: message.text == "🎟 Промокод")
+@guarded()
 async def promo_handler(message: types.Message):
-    if message.chat.type != 'private':
-        return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
-        return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
-    ok, not_subscribed = await check_subscription(user_id)
-    if not ok:
-        await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
-        return
     await send_with_media(user_id, "Введи промокод:", media_key='promo', reply_markup=back_keyboard())
     await PromoActivate.code.set()
 
@@ -262,7 +235,7 @@ async def promo_activate(message: types.Message, state: FSMContext):
         await state.finish()
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             already_used = await conn.fetchval(
                 "SELECT 1 FROM promo_activations WHERE user_id=$1 AND promo_code=$2",
                 user_id, code
@@ -323,119 +296,101 @@ async def perform_theft(message: types.Message, robber_id: int, victim_id: int,
     min_amount = await get_setting_float("min_theft_amount")
     max_amount = await get_setting_float("max_theft_amount")
     bitcoin_reward = await get_setting_int("bitcoin_per_theft")
+    exp_success = await get_setting_int("exp_per_theft_success")
+    exp_fail = await get_setting_int("exp_per_theft_fail")
+    exp_defense = await get_setting_int("exp_per_theft_defense")
+    required_thefts = await get_setting_int("referral_required_thefts")
+    bonus_coins = await get_setting_float("referral_bonus")
+    bonus_rep = await get_setting_int("referral_reputation")
 
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
+            referrer_id = await conn.fetchval(
+                "SELECT referrer_id FROM referrals WHERE referred_id=$1 AND reward_given=FALSE", robber_id
+            )
             async with conn.transaction():
-                robber_balance = await get_user_balance(robber_id)
-                if robber_balance is None:
+                # Все участники (и реферер, если награда возможна) блокируются одним запросом
+                # по возрастанию user_id до любых записей: встречные ограбления не ловят дедлок.
+                involved = sorted({robber_id, victim_id} | ({referrer_id} if referrer_id else set()))
+                rows = await conn.fetch(
+                    "SELECT user_id, balance, theft_success, first_name FROM users "
+                    "WHERE user_id = ANY($1::bigint[]) ORDER BY user_id FOR UPDATE",
+                    involved
+                )
+                locked = {r['user_id']: r for r in rows}
+                robber = locked.get(robber_id)
+                if robber is None:
                     await message.answer("❌ Ошибка: ваш профиль не найден.")
                     return
+                robber_balance = float(robber['balance'])
                 if robber_balance < cost:
                     await message.answer(get_random_phrase(THEFT_NO_MONEY_PHRASES), reply_markup=main_menu_keyboard(await is_admin(robber_id)))
                     return
-
-                victim_row = await conn.fetchrow("SELECT balance, username, first_name FROM users WHERE user_id=$1", victim_id)
-                if not victim_row:
+                victim = locked.get(victim_id)
+                if victim is None:
                     await message.answer("❌ Цель не найдена в базе.")
                     return
-                victim_balance = float(victim_row['balance'])
-                victim_username = victim_row['username']
-                victim_first = victim_row['first_name']
-                victim_name = victim_first if victim_first else str(victim_id)
-
-                if cost > 0:
-                    await update_user_balance(robber_id, -cost, conn=conn)
-                    robber_balance -= cost
+                victim_balance = float(victim['balance'])
+                victim_name = victim['first_name'] if victim['first_name'] else str(victim_id)
+                robber_balance -= cost
+                now = datetime.now()
 
-                defense_triggered = random.random() * 100 <= defense_chance
-                if defense_triggered:
+                if random.random() * 100 <= defense_chance:
                     penalty = min(defense_penalty, robber_balance)
-                    if penalty > 0:
-                        await update_user_balance(robber_id, -penalty, conn=conn)
-                        await update_user_balance(victim_id, penalty, conn=conn)
-                    await conn.execute("UPDATE users SET theft_attempts = theft_attempts + 1, theft_failed = theft_failed + 1 WHERE user_id=$1", robber_id)
-                    await conn.execute("UPDATE users SET theft_protected = theft_protected + 1 WHERE user_id=$1", victim_id)
-                    await conn.execute("UPDATE users SET last_theft_time = $1 WHERE user_id=$2", datetime.now().strftime("%Y-%m-%d %H:%M:%S"), robber_id)
-
-                    exp_defense = await get_setting_int("exp_per_theft_defense")
-                    await add_exp(victim_id, exp_defense, conn=conn)
-                    exp_fail = await get_setting_int("exp_per_theft_fail")
-                    await add_exp(robber_id, exp_fail, conn=conn)
-
-                    robber_phrase = get_random_phrase(THEFT_DEFENSE_PHRASES, target=victim_name, penalty=penalty)
-                    victim_phrase = get_random_phrase(THEFT_VICTIM_DEFENSE_PHRASES, attacker=message.from_user.first_name, penalty=penalty)
-                    await message.answer(robber_phrase, reply_markup=main_menu_keyboard(await is_admin(robber_id)))
-                    await safe_send_message(victim_id, victim_phrase)
-                    return
-
-                success = random.random() * 100 <= success_chance
-                if success and victim_balance > 0:
-                    if victim_balance < min_amount:
-                        steal_amount = 0
-                    else:
-                        max_possible = min(max_amount, victim_balance)
-                        steal_amount = round(random.uniform(min_amount, max_possible), 2)
-
+                    penalty_delta = max(penalty, 0)
+                    await apply_wallet_deltas([
+                        {'user_id': robber_id, 'balance': -cost - penalty_delta, 'exp': exp_fail},
+                        {'user_id': victim_id, 'balance': penalty_delta, 'exp': exp_defense},
+                    ], conn=conn)
+                    await update_user_fields(robber_id, {'theft_attempts': 1, 'theft_failed': 1}, {'last_theft_time': now}, conn=conn)
+                    await update_user_fields(victim_id, {'theft_protected': 1}, conn=conn)
+                    outcome = 'defense'
+                else:
+                    steal_amount = 0
+                    if random.random() * 100 <= success_chance and victim_balance >= min_amount:
+                        steal_amount = round(random.uniform(min_amount, min(max_amount, victim_balance)), 2)
                     if steal_amount > 0:
-                        await update_user_balance(victim_id, -steal_amount, conn=conn)
-                        await update_user_balance(robber_id, steal_amount, conn=conn)
-                        if bitcoin_reward > 0:
-                            await update_user_bitcoin(robber_id, float(bitcoin_reward), conn=conn)
-                        await conn.execute("UPDATE users SET theft_attempts = theft_attempts + 1, theft_success = theft_success + 1 WHERE user_id=$1", robber_id)
-
-                        exp_success = await get_setting_int("exp_per_theft_success")
-                        await add_exp(robber_id, exp_success, conn=conn)
-
-                        required_thefts = await get_setting_int("referral_required_thefts")
-                        new_success = await conn.fetchval("SELECT theft_success FROM users WHERE user_id=$1", robber_id)
-                        if new_success == required_thefts:
-                            ref = await conn.fetchrow("SELECT referrer_id FROM referrals WHERE referred_id=$1 AND reward_given=FALSE", robber_id)
-                            if ref:
-                                referrer_id = ref['referrer_id']
-                                bonus_coins = await get_setting_float("referral_bonus")
-                                bonus_rep = await get_setting_int("referral_reputation")
-                                await update_user_balance(referrer_id, bonus_coins, conn=conn)
-                                await update_user_reputation(referrer_id, bonus_rep)
-                                await conn.execute("UPDATE referrals SET reward_given=TRUE WHERE referred_id=$1", robber_id)
-                                await conn.execute("UPDATE referrals SET active=TRUE WHERE referred_id=$1", robber_id)
-                                await safe_send_message(referrer_id, f"🎉 Ваш реферал совершил {required_thefts} успешных ограблений! Вы получили {bonus_coins:.2f} баксов и {bonus_rep} репутации.")
-
-                        btc_text = f" и {bitcoin_reward} BTC" if bitcoin_reward > 0 else ""
-                        phrase = get_random_phrase(THEFT_SUCCESS_PHRASES, amount=steal_amount, target=victim_name)
-                        await message.answer(f"{phrase}{btc_text}", reply_markup=main_menu_keyboard(await is_admin(robber_id)))
-                        await safe_send_message(victim_id, f"🔫 Вас ограбили! {message.from_user.first_name} украл {steal_amount:.2f} баксов.")
+                        reward_referrer = referrer_id is not None and (robber['theft_success'] or 0) + 1 == required_thefts
+                        deltas = [
+                            {'user_id': victim_id, 'balance': -steal_amount},
+                            {'user_id': robber_id, 'balance': steal_amount - cost, 'bitcoin': max(bitcoin_reward, 0), 'exp': exp_success},
+                        ]
+                        if reward_referrer:
+                            deltas.append({'user_id': referrer_id, 'balance': bonus_coins})
+                        await apply_wallet_deltas(deltas, conn=conn)
+                        await update_user_fields(robber_id, {'theft_attempts': 1, 'theft_success': 1}, {'last_theft_time': now}, conn=conn)
+                        if reward_referrer:
+                            await update_user_reputation(referrer_id, bonus_rep, conn=conn)
+                            await conn.execute("UPDATE referrals SET reward_given=TRUE, active=TRUE WHERE referred_id=$1", robber_id)
+                        outcome = 'success'
                     else:
-                        await conn.execute("UPDATE users SET theft_attempts = theft_attempts + 1, theft_failed = theft_failed + 1 WHERE user_id=$1", robber_id)
-                        exp_fail = await get_setting_int("exp_per_theft_fail")
-                        await add_exp(robber_id, exp_fail, conn=conn)
-                        phrase = get_random_phrase(THEFT_FAIL_PHRASES, target=victim_name)
-                        await message.answer(phrase, reply_markup=main_menu_keyboard(await is_admin(robber_id)))
-                else:
-                    await conn.execute("UPDATE users SET theft_attempts = theft_attempts + 1, theft_failed = theft_failed + 1 WHERE user_id=$1", robber_id)
-                    exp_fail = await get_setting_int("exp_per_theft_fail")
-                    await add_exp(robber_id, exp_fail, conn=conn)
-                    phrase = get_random_phrase(THEFT_FAIL_PHRASES, target=victim_name)
-                    await message.answer(phrase, reply_markup=main_menu_keyboard(await is_admin(robber_id)))
-
-                await conn.execute("UPDATE users SET last_theft_time = $1 WHERE user_id=$2", datetime.now().strftime("%Y-%m-%d %H:%M:%S"), robber_id)
+                        await apply_wallet_deltas([{'user_id': robber_id, 'balance': -cost, 'exp': exp_fail}], conn=conn)
+                        await update_user_fields(robber_id, {'theft_attempts': 1, 'theft_failed': 1}, {'last_theft_time': now}, conn=conn)
+                        outcome = 'fail'
+
+        # Ответы — после COMMIT, чтобы не держать блокировки строк на время отправки.
+        keyboard = main_menu_keyboard(await is_admin(robber_id))
+        if outcome == 'defense':
+            await message.answer(get_random_phrase(THEFT_DEFENSE_PHRASES, target=victim_name, penalty=penalty), reply_markup=keyboard)
+            await safe_send_message(victim_id, get_random_phrase(THEFT_VICTIM_DEFENSE_PHRASES, attacker=message.from_user.first_name, penalty=penalty))
+        elif outcome == 'success':
+            if reward_referrer:
+                await safe_send_message(referrer_id, f"🎉 Ваш реферал совершил {required_thefts} успешных ограблений! Вы получили {bonus_coins:.2f} баксов и {bonus_rep} репутации.")
+            btc_text = f" и {bitcoin_reward} BTC" if bitcoin_reward > 0 else ""
+            phrase = get_random_phrase(THEFT_SUCCESS_PHRASES, amount=steal_amount, target=victim_name)
+            await message.answer(f"{phrase}{btc_text}", reply_markup=keyboard)
+            await safe_send_message(victim_id, f"🔫 Вас ограбили! {message.from_user.first_name} украл {steal_amount:.2f} баксов.")
+        else:
+            await message.answer(get_random_phrase(THEFT_FAIL_PHRASES, target=victim_name), reply_markup=keyboard)
 
     except Exception as e:
         logging.error(f"Theft error: {e}", exc_info=True)
         await message.answer("❌ Ошибка при ограблении.")
 
 @dp.message_handler(lambda message: message.text == "🔫 Ограбить")
+@guarded()
 async def theft_menu(message: types.Message):
-    if message.chat.type != 'private':
-        return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
-        return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
-    ok, not_subscribed = await check_subscription(user_id)
-    if not ok:
-        await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
-        return
     phrase = get_random_phrase(THEFT_CHOICE_PHRASES)
     await send_with_media(user_id, phrase, media_key='theft', reply_markup=theft_choice_keyboard())
 
@@ -445,22 +400,18 @@ async def theft_random(message: types.Message, state: FSMContext):
         return
     user_id = message.from_user.id
     cooldown_minutes = await get_setting_int("theft_cooldown_minutes")
-    async with db_pool.acquire() as conn:
-        last_time_str = await conn.fetchval("SELECT last_theft_time FROM users WHERE user_id=$1", user_id)
-        if last_time_str:
-            try:
-                last_time = datetime.strptime(last_time_str, "%Y-%m-%d %H:%M:%S")
-                diff = datetime.now() - last_time
-                if diff < timedelta(minutes=cooldown_minutes):
-                    remaining = cooldown_minutes - int(diff.total_seconds() // 60)
-                    phrase = get_random_phrase(THEFT_COOLDOWN_PHRASES, minutes=remaining)
-                    await message.answer(phrase, reply_markup=main_menu_keyboard(await is_admin(user_id)))
-                    return
-            except:
-                pass
-    target_id = await get_random_user(user_id)
+    async with acquire() as conn:
+        last_time = await conn.fetchval("SELECT last_theft_time FROM users WHERE user_id=$1", user_id)
+        if last_time:
+            diff = datetime.now() - last_time.astimezone().replace(tzinfo=None)
+            if diff < timedelta(minutes=cooldown_minutes):
+                remaining = cooldown_minutes - int(diff.total_seconds() // 60)
+                phrase = get_random_phrase(THEFT_COOLDOWN_PHRASES, minutes=remaining)
+                await message.answer(phrase, reply_markup=main_menu_keyboard(await is_admin(user_id)))
+                return
+    target_id = await get_random_user(user_id, min_balance=await get_setting_float("min_theft_amount"))
     if not target_id:
-        await message.answer("😕 В игре пока нет других игроков.", reply_markup=main_menu_keyboard(await is_admin(user_id)))
+        await message.answer("😕 Сейчас некого обокрасть: других игроков с деньгами нет.", reply_markup=main_menu_keyboard(await is_admin(user_id)))
         return
     cost = await get_setting_float("random_attack_cost")
     await perform_theft(message, user_id, target_id, cost)
@@ -471,19 +422,15 @@ async def theft_choose_user(message: types.Message, state: FSMContext):
         return
     user_id = message.from_user.id
     cooldown_minutes = await get_setting_int("theft_cooldown_minutes")
-    async with db_pool.acquire() as conn:
-        last_time_str = await conn.fetchval("SELECT last_theft_time FROM users WHERE user_id=$1", user_id)
-        if last_time_str:
-            try:
-                last_time = datetime.strptime(last_time_str, "%Y-%m-%d %H:%M:%S")
-                diff = datetime.now() - last_time
-                if diff < timedelta(minutes=cooldown_minutes):
-                    remaining = cooldown_minutes - int(diff.total_seconds() // 60)
-                    phrase = get_random_phrase(THEFT_COOLDOWN_PHRASES, minutes=remaining)
-                    await message.answer(phrase, reply_markup=main_menu_keyboard(await is_admin(user_id)))
-                    return
-            except:
-                pass
+    async with acquire() as conn:
+        last_time = await conn.fetchval("SELECT last_theft_time FROM users WHERE user_id=$1", user_id)
+        if last_time:
+            diff = datetime.now() - last_time.astimezone().replace(tzinfo=None)
+            if diff < timedelta(minutes=cooldown_minutes):
+                remaining = cooldown_minutes - int(diff.total_seconds() // 60)
+                phrase = get_random_phrase(THEFT_COOLDOWN_PHRASES, minutes=remaining)
+                await message.answer(phrase, reply_markup=main_menu_keyboard(await is_admin(user_id)))
+                return
     await message.answer("Введи @username или ID того, кого хочешь ограбить:", reply_markup=back_keyboard())
     await TheftTarget.target.set()
 
@@ -530,7 +477,7 @@ async def referral_link(message: types.Message):
     bonus_rep = await get_setting_int("referral_reputation")
     required_thefts = await get_setting_int("referral_required_thefts")
 
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         clicks = await conn.fetchval("SELECT SUM(clicks) FROM referrals WHERE referrer_id=$1", user_id) or 0
         active = await conn.fetchval("SELECT COUNT(*) FROM referrals WHERE referrer_id=$1 AND active=TRUE", user_id) or 0
         earned = active * bonus_coins
@@ -547,19 +494,10 @@ async def referral_link(message: types.Message):
 
 # ==================== ЗАДАНИЯ ====================
 @dp.message_handler(lambda message: message.text == "📋 Задания")
+@guarded()
 async def tasks_handler(message: types.Message):
-    if message.chat.type != 'private':
-        return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
-        return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
-    ok, not_subscribed = await check_subscription(user_id)
-    if not ok:
-        await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
-        return
-
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         rows = await conn.fetch("SELECT id, name, description, reward_coins, reward_reputation, max_completions, completed_count FROM tasks WHERE active=TRUE")
     
     if not rows:
@@ -580,7 +518,7 @@ async def take_task(callback: types.CallbackQuery):
     task_id = int(callback.data.split("_")[1])
     user_id = callback.from_user.id
 
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         existing = await conn.fetchval("SELECT 1 FROM user_tasks WHERE user_id=$1 AND task_id=$2", user_id, task_id)
         if existing:
             await callback.answer("Ты уже выполнял это задание!", show_alert=True)
@@ -596,24 +534,22 @@ async def take_task(callback: types.CallbackQuery):
             return
 
         if task['task_type'] == 'subscribe':
-            channel_id = task['target_id']
-            try:
-                member = await bot.get_chat_member(chat_id=channel_id, user_id=user_id)
-                if member.status in ['left', 'kicked']:
-                    await callback.answer("❌ Ты не подписан на этот канал!", show_alert=True)
-                    return
-            except Exception as e:
-                logging.error(f"Task subscribe check error: {e}", exc_info=True)
+            # Пользователь сам нажал «проверить» — идём в Bot API мимо кэша.
+            subscribed = await check_channel_member(user_id, task['target_id'], force=True)
+            if subscribed is None:
                 await callback.answer("❌ Не удалось проверить подписку. Возможно, бот не админ канала.", show_alert=True)
                 return
+            if not subscribed:
+                await callback.answer("❌ Ты не подписан на этот канал!", show_alert=True)
+                return
 
             async with conn.transaction():
                 await update_user_balance(user_id, float(task['reward_coins']), conn=conn)
                 await update_user_reputation(user_id, task['reward_reputation'])
-                expires_at = (datetime.now() + timedelta(days=task['required_days'])).strftime("%Y-%m-%d %H:%M:%S") if task['required_days'] > 0 else None
+                expires_at = datetime.now() + timedelta(days=task['required_days']) if task['required_days'] > 0 else None
                 await conn.execute(
                     "INSERT INTO user_tasks (user_id, task_id, completed_at, expires_at, status) VALUES ($1, $2, $3, $4, $5)",
-                    user_id, task_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), expires_at, 'completed'
+                    user_id, task_id, datetime.now(), expires_at, 'completed'
                 )
                 await conn.execute("UPDATE tasks SET completed_count = completed_count + 1 WHERE id=$1", task_id)
 
@@ -624,23 +560,14 @@ async def take_task(callback: types.CallbackQuery):
 
 # ==================== АУКЦИОН ====================
 @dp.message_handler(lambda message: message.text == "🏷 Аукцион")
+@guarded()
 async def auction_handler(message: types.Message):
-    if message.chat.type != 'private':
-        return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
-        return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
-    ok, not_subscribed = await check_subscription(user_id)
-    if not ok:
-        await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
-        return
-
     await list_auctions(message)
 
 async def list_auctions(message: types.Message, page: int = 1):
     offset = (page - 1) * ITEMS_PER_PAGE
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         total = await conn.fetchval("SELECT COUNT(*) FROM auctions WHERE status='active'")
         rows = await conn.fetch(
             "SELECT id, item_name, current_price, end_time, target_price FROM auctions WHERE status='active' ORDER BY created_at DESC LIMIT $1 OFFSET $2",
@@ -674,7 +601,7 @@ async def auction_page_callback(callback: types.CallbackQuery):
 @dp.callback_query_handler(lambda c: c.data.startswith("auction_view_"))
 async def auction_view(callback: types.CallbackQuery):
     auction_id = int(callback.data.split("_")[2])
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         auction = await conn.fetchrow("SELECT * FROM auctions WHERE id=$1 AND status='active'", auction_id)
         if not auction:
             await callback.answer("Аукцион не найден или завершён.", show_alert=True)
@@ -733,7 +660,7 @@ async def auction_bid_amount(message: types.Message, state: FSMContext):
     data = await state.get_data()
     auction_id = data['auction_id']
     user_id = message.from_user.id
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         auction = await conn.fetchrow("SELECT * FROM auctions WHERE id=$1 AND status='active'", auction_id)
         if not auction:
             await message.answer("❌ Аукцион не найден или завершён.")
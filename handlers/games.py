@@ -1,7 +1,6 @@
 import asyncio
 import logging
 import random
-import json
 from datetime import datetime
 
 from aiogram import types
@@ -12,9 +11,10 @@ from utils.db import (
     ensure_user_exists, is_banned, is_admin, get_user_balance, get_user_level,
     update_user_balance, update_user_bitcoin, update_user_game_stats,
     update_user_reputation, add_exp, get_setting, get_setting_int, get_setting_float,
-    check_global_cooldown, set_global_cooldown, check_subscription, db_pool,
-    slots_spin, format_slots_result, roulette_spin
+    check_global_cooldown, claim_global_cooldown, check_subscription, acquire,
+    slots_spin, format_slots_result, roulette_spin, queue_last_bet
 )
+from utils.decorators import guarded
 from utils.helpers import (
     safe_send_message, send_with_media, auto_delete_reply, auto_delete_message,
     get_random_phrase, notify_chats
@@ -37,17 +37,9 @@ from utils.db import slots_spin, format_slots_result, roulette_spin
 
 # ==================== КАЗИНО И ИГРЫ ====================
 @dp.message_handler(lambda message: message.text == "🎰 Казино")
+@guarded()
 async def casino_menu(message: types.Message):
-    if message.chat.type != 'private':
-        return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
-        return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
-    ok, not_subscribed = await check_subscription(user_id)
-    if not ok:
-        await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
-        return
     min_level = await get_setting_int("min_level_casino")
     level = await get_user_level(user_id)
     if level < min_level:
@@ -56,15 +48,7 @@ async def casino_menu(message: types.Message):
     await send_with_media(user_id, "Выбери игру:", media_key='casino', reply_markup=casino_menu_keyboard())
 
 async def save_last_bet(user_id: int, game: str, amount: float, bet_data: dict = None):
-    async with db_pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO user_last_bets (user_id, game, bet_amount, bet_data, updated_at)
-            VALUES ($1, $2, $3, $4, NOW())
-            ON CONFLICT (user_id, game) DO UPDATE SET
-                bet_amount = EXCLUDED.bet_amount,
-                bet_data = EXCLUDED.bet_data,
-                updated_at = NOW()
-        """, user_id, game, amount, json.dumps(bet_data) if bet_data else None)
+    queue_last_bet(user_id, game, amount, bet_data)
 
 # ----- Казино (простое) -----
 @dp.message_handler(lambda message: message.text == "🎰 Играть в казино")
@@ -115,6 +99,11 @@ async def casino_bet(message: types.Message, state: FSMContext):
         await message.answer("❌ Недостаточно баксов.")
         return
 
+    ok, remaining = await claim_global_cooldown(user_id, "casino")
+    if not ok:
+        await message.answer(f"⏳ Подожди ещё {remaining} сек.")
+        return
+
     win_chance = await get_setting_float("casino_win_chance")
     multiplier = await get_setting_float("casino_multiplier")
 
@@ -125,7 +114,7 @@ async def casino_bet(message: types.Message, state: FSMContext):
 
     win = random.random() * 100 <= win_chance
 
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         await update_user_balance(user_id, -amount, conn=conn)
         await update_user_game_stats(user_id, 'casino', win, conn=conn)
 
@@ -148,7 +137,6 @@ async def casino_bet(message: types.Message, state: FSMContext):
         await add_exp(user_id, exp, conn=conn)
 
     await save_last_bet(user_id, 'casino', amount)
-    await set_global_cooldown(user_id, "casino")
 
     await anim.edit_text(phrase, reply_markup=repeat_bet_keyboard('casino'))
     await state.finish()
@@ -205,13 +193,18 @@ async def dice_bet(message: types.Message, state: FSMContext):
         await message.answer("❌ Недостаточно баксов.")
         return
 
+    ok, remaining = await claim_global_cooldown(user_id, "dice")
+    if not ok:
+        await message.answer(f"⏳ Подожди ещё {remaining} сек.")
+        return
+
     dice1 = random.randint(1, 6)
     dice2 = random.randint(1, 6)
     total = dice1 + dice2
     threshold = await get_setting_int("dice_win_threshold")
     win = total > threshold
 
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         await update_user_balance(user_id, -amount, conn=conn)
         await update_user_game_stats(user_id, 'dice', win, conn=conn)
         if win:
@@ -229,7 +222,6 @@ async def dice_bet(message: types.Message, state: FSMContext):
         await add_exp(user_id, exp, conn=conn)
 
     await save_last_bet(user_id, 'dice', amount)
-    await set_global_cooldown(user_id, "dice")
 
     await message.answer(phrase, reply_markup=repeat_bet_keyboard('dice'))
     await state.finish()
@@ -298,10 +290,15 @@ async def guess_number(message: types.Message, state: FSMContext):
     amount = data['amount']
     user_id = message.from_user.id
 
+    ok, remaining = await claim_global_cooldown(user_id, "guess")
+    if not ok:
+        await message.answer(f"⏳ Подожди ещё {remaining} сек.")
+        return
+
     secret = random.randint(1, 5)
     win = (guess == secret)
 
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         await update_user_balance(user_id, -amount, conn=conn)
         await update_user_game_stats(user_id, 'guess', win, conn=conn)
         if win:
@@ -323,7 +320,6 @@ async def guess_number(message: types.Message, state: FSMContext):
         await add_exp(user_id, exp, conn=conn)
 
     await save_last_bet(user_id, 'guess', amount, bet_data)
-    await set_global_cooldown(user_id, "guess")
 
     await message.answer(phrase, reply_markup=repeat_bet_keyboard('guess'))
     await state.finish()
@@ -377,6 +373,11 @@ async def slots_bet(message: types.Message, state: FSMContext):
         await message.answer("❌ Недостаточно баксов.")
         return
 
+    ok, remaining = await claim_global_cooldown(user_id, "slots")
+    if not ok:
+        await message.answer(f"⏳ Подожди ещё {remaining} сек.")
+        return
+
     anim = await message.answer("🍒 Запускаем слоты...")
     stages = [
         "🍒 | 🍋 | 🍊",
@@ -391,7 +392,7 @@ async def slots_bet(message: types.Message, state: FSMContext):
     symbols, multiplier, win = await slots_spin()
     result_str = format_slots_result(symbols)
 
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         await update_user_balance(user_id, -amount, conn=conn)
         await update_user_game_stats(user_id, 'slots', win, conn=conn)
         if win:
@@ -408,7 +409,6 @@ async def slots_bet(message: types.Message, state: FSMContext):
         await add_exp(user_id, exp, conn=conn)
 
     await save_last_bet(user_id, 'slots', amount)
-    await set_global_cooldown(user_id, "slots")
 
     await anim.edit_text(phrase, reply_markup=repeat_bet_keyboard('slots'))
     await state.finish()
@@ -506,6 +506,11 @@ async def process_roulette_bet(message: types.Message, state: FSMContext):
     bet_number = data.get('number')
     user_id = message.from_user.id
 
+    ok, remaining = await claim_global_cooldown(user_id, "roulette")
+    if not ok:
+        await message.answer(f"⏳ Подожди ещё {remaining} сек.")
+        return
+
     anim = await message.answer("🎡 Крутим рулетку...")
     for _ in range(3):
         await asyncio.sleep(0.5)
@@ -517,7 +522,7 @@ async def process_roulette_bet(message: types.Message, state: FSMContext):
 
     number, color, win = await roulette_spin(bet_type, bet_number)
 
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         await update_user_balance(user_id, -amount, conn=conn)
         await update_user_game_stats(user_id, 'roulette', win, conn=conn)
         if win:
@@ -542,7 +547,6 @@ async def process_roulette_bet(message: types.Message, state: FSMContext):
         await add_exp(user_id, exp, conn=conn)
 
     await save_last_bet(user_id, 'roulette', amount, bet_data)
-    await set_global_cooldown(user_id, "roulette")
 
     await anim.edit_text(phrase, reply_markup=repeat_bet_keyboard('roulette'))
     await state.finish()
@@ -9,16 +9,16 @@ from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 from bot_instance import dp, bot
 from utils.db import (
-    db_pool, ensure_user_exists, is_banned, is_admin, is_chat_confirmed,
+    acquire, ensure_user_exists, is_banned, is_admin, is_chat_confirmed,
     get_user_balance, update_user_balance, get_user_bitcoin, update_user_bitcoin,
     get_user_stats, get_user_level, get_user_reputation, add_exp,
     get_setting, get_setting_int, get_setting_float,
     check_smuggle_cooldown, set_smuggle_cooldown,
-    can_fight, set_fight_cooldown, add_chat_authority, log_fight,
+    claim_fight, add_chat_authority, log_fight,
     calculate_fight_damage, calculate_fight_authority,
     is_critical, is_counter, get_media_file_id,
     create_chat_confirmation_request, get_confirmed_chats, get_pending_chat_requests,
-    add_confirmed_chat, update_chat_request_status
+    add_confirmed_chat, update_chat_request_status, get_admin_ids
 )
 from utils.helpers import (
     safe_send_message, send_with_media, auto_delete_reply, auto_delete_message,
@@ -26,7 +26,7 @@ from utils.helpers import (
 )
 from utils.constants import (
     FIGHT_HIT_PHRASES, FIGHT_CRIT_PHRASES, FIGHT_COUNTER_PHRASES,
-    SMUGGLE_START_PHRASES, SMUGGLE_CARGO, SUPER_ADMINS,
+    SMUGGLE_START_PHRASES, SMUGGLE_CARGO,
     ITEMS_PER_PAGE
 )
 from utils.keyboards import confirm_chat_inline, subscription_inline
@@ -47,7 +47,7 @@ async def fight_command(message: types.Message):
 
     await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
 
-    ok, remaining = await can_fight(chat_id, user_id)
+    ok, remaining = await claim_fight(chat_id, user_id)
     if not ok:
         time_str = format_time_remaining(remaining)
         await auto_delete_reply(message, f"⏳ Ты ещё не восстановился. Подожди {time_str}.")
@@ -92,7 +92,6 @@ async def fight_command(message: types.Message):
     await add_exp(user_id, exp)
 
     await log_fight(chat_id, user_id, damage, authority, outcome)
-    await set_fight_cooldown(chat_id, user_id)
 
     await auto_delete_reply(message, phrase, delete_seconds=30)
 
@@ -131,10 +130,10 @@ async def smuggle_command(message: types.Message):
 
     cargo = random.choice(SMUGGLE_CARGO)
 
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         await conn.execute(
             "INSERT INTO smuggle_runs (user_id, chat_id, start_time, end_time) VALUES ($1, $2, $3, $4)",
-            user_id, chat_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), end_time.strftime("%Y-%m-%d %H:%M:%S")
+            user_id, chat_id, datetime.now(), end_time
         )
         if cost > 0:
             await update_user_balance(user_id, -cost, conn=conn)
@@ -165,11 +164,7 @@ async def activate_chat_command(message: types.Message):
     text = f"📩 Запрос на активацию чата:\nНазвание: {chat_title}\nID: {chat_id}\nОт пользователя: {user_name}"
     kb = confirm_chat_inline(chat_id)
 
-    admins = SUPER_ADMINS.copy()
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch("SELECT user_id FROM admins")
-        for r in rows:
-            admins.append(r['user_id'])
+    admins = get_admin_ids()
 
     for admin_id in admins:
         await safe_send_message(admin_id, text, reply_markup=kb)
@@ -183,7 +178,7 @@ async def confirm_chat_callback(callback: types.CallbackQuery):
         await callback.message.answer("❌ Недостаточно прав.")
         return
     chat_id = int(callback.data.split("_")[2])
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         req = await conn.fetchrow("SELECT * FROM chat_confirmation_requests WHERE chat_id=$1 AND status='pending'", chat_id)
         if not req:
             await callback.message.edit_text("❌ Запрос уже обработан.")
@@ -200,7 +195,7 @@ async def reject_chat_callback(callback: types.CallbackQuery):
         await callback.message.answer("❌ Недостаточно прав.")
         return
     chat_id = int(callback.data.split("_")[2])
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         req = await conn.fetchrow("SELECT * FROM chat_confirmation_requests WHERE chat_id=$1 AND status='pending'", chat_id)
         if not req:
             await callback.message.edit_text("❌ Запрос уже обработан.")
@@ -221,7 +216,7 @@ async def chat_top_command(message: types.Message):
         order = 'authority'
 
     offset = (page - 1) * ITEMS_PER_PAGE
-    async with db_pool.acquire() as conn:
+    async with acquire(readonly=True) as conn:
         if order == 'authority':
             order_by = 'authority DESC'
         elif order == 'damage':
@@ -12,11 +12,12 @@ from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from bot_instance import dp, bot
 from bot_instance import dp, bot
 from utils.db import (
-    db_pool, ensure_user_exists, is_banned, is_admin,
+    acquire, ensure_user_exists, is_banned, is_admin,
     get_user_balance, update_user_balance, update_user_game_stats,
-    add_exp, get_setting_int, get_setting_float, get_media_file_id,
-    check_global_cooldown, set_global_cooldown, check_subscription
+    add_exp, apply_wallet_deltas, get_setting_int, get_setting_float, get_media_file_id,
+    check_global_cooldown, check_subscription
 )
+from utils.decorators import guarded
 from utils.helpers import (
     safe_send_message, send_with_media, auto_delete_reply
 )
@@ -57,17 +58,17 @@ def create_deck():
     return deck
 
 async def get_multiplayer_game(game_id: str) -> Optional[dict]:
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         row = await conn.fetchrow("SELECT * FROM multiplayer_games WHERE game_id=$1", game_id)
         return dict(row) if row else None
 
 async def get_game_players(game_id: str) -> List[dict]:
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         rows = await conn.fetch("SELECT * FROM game_players WHERE game_id=$1 ORDER BY joined_at", game_id)
         return [dict(r) for r in rows]
 
 async def add_player_to_game(game_id: str, user_id: int, username: str):
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         async with conn.transaction():
             game = await conn.fetchrow("SELECT * FROM multiplayer_games WHERE game_id=$1 AND status='waiting' FOR UPDATE", game_id)
             if not game:
@@ -81,14 +82,14 @@ async def add_player_to_game(game_id: str, user_id: int, username: str):
             )
 
 async def remove_player_from_game(game_id: str, user_id: int):
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         await conn.execute("DELETE FROM game_players WHERE game_id=$1 AND user_id=$2", game_id, user_id)
         remaining = await conn.fetchval("SELECT COUNT(*) FROM game_players WHERE game_id=$1", game_id)
         if remaining == 0:
             await conn.execute("DELETE FROM multiplayer_games WHERE game_id=$1", game_id)
 
 async def start_game(game_id: str):
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         async with conn.transaction():
             game = await conn.fetchrow("SELECT * FROM multiplayer_games WHERE game_id=$1 AND status='waiting' FOR UPDATE", game_id)
             if not game:
@@ -120,7 +121,7 @@ async def start_game(game_id: str):
             return game_id
 
 async def get_current_player(game_id: str) -> Optional[dict]:
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         game = await conn.fetchrow("SELECT * FROM multiplayer_games WHERE game_id=$1", game_id)
         if not game or game['status'] != 'playing':
             return None
@@ -133,7 +134,7 @@ async def get_current_player(game_id: str) -> Optional[dict]:
         return dict(players[idx])
 
 async def next_player(game_id: str) -> Optional[int]:
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         async with conn.transaction():
             game = await conn.fetchrow("SELECT * FROM multiplayer_games WHERE game_id=$1 FOR UPDATE", game_id)
             if not game:
@@ -157,7 +158,7 @@ async def next_player(game_id: str) -> Optional[int]:
             return -1
 
 async def finish_game(game_id: str):
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         async with conn.transaction():
             game = await conn.fetchrow("SELECT * FROM multiplayer_games WHERE game_id=$1", game_id)
             if not game or game['status'] != 'playing':
@@ -175,28 +176,28 @@ async def finish_game(game_id: str):
                     winner_id = p['user_id']
             bet_amount = float(game['bet_amount'])
             pot = bet_amount * len(players)
+            exp_win = await get_setting_int("exp_per_game_win")
+            exp_lose = await get_setting_int("exp_per_game_lose")
             if winner_id:
-                await update_user_balance(winner_id, pot, conn=conn)
+                deltas = [{'user_id': winner_id, 'balance': pot, 'exp': exp_win}]
                 await update_user_game_stats(winner_id, 'multiplayer', win=True, conn=conn)
                 for p in players:
                     if p['user_id'] != winner_id:
+                        deltas.append({'user_id': p['user_id'], 'exp': exp_lose})
                         await update_user_game_stats(p['user_id'], 'multiplayer', win=False, conn=conn)
-                exp_win = await get_setting_int("exp_per_game_win")
-                exp_lose = await get_setting_int("exp_per_game_lose")
-                await add_exp(winner_id, exp_win, conn=conn)
-                for p in players:
-                    if p['user_id'] != winner_id:
-                        await add_exp(p['user_id'], exp_lose, conn=conn)
+                await apply_wallet_deltas(deltas, conn=conn)
                 for p in players:
                     if p['user_id'] == winner_id:
                         await safe_send_message(p['user_id'], f"🎉 Ты выиграл в игре 21! Твой выигрыш: {pot:.2f} баксов.")
                     else:
                         await safe_send_message(p['user_id'], f"😢 Ты проиграл в игре 21. Твоя ставка {bet_amount:.2f} баксов потеряна.")
             else:
+                await apply_wallet_deltas(
+                    [{'user_id': p['user_id'], 'balance': bet_amount, 'exp': exp_lose} for p in players],
+                    conn=conn
+                )
                 for p in players:
-                    await update_user_balance(p['user_id'], bet_amount, conn=conn)
                     await update_user_game_stats(p['user_id'], 'multiplayer', win=False, conn=conn)
-                    await add_exp(p['user_id'], await get_setting_int("exp_per_game_lose"), conn=conn)
                     await safe_send_message(p['user_id'], f"🤝 В игре 21 ничья. Твоя ставка {bet_amount:.2f} баксов возвращена.")
             await conn.execute("DELETE FROM multiplayer_games WHERE game_id=$1", game_id)
             await conn.execute("DELETE FROM game_players WHERE game_id=$1", game_id)
@@ -227,17 +228,9 @@ async def show_current_turn(game_id: str, message: types.Message = None, user_id
         await message.answer(text, reply_markup=kb)
       # ==================== ХЕНДЛЕРЫ ====================
 @dp.message_handler(lambda message: message.text == "👥 Мультиплеер 21")
+@guarded()
 async def multiplayer_menu(message: types.Message):
-    if message.chat.type != 'private':
-        return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
-        return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
-    ok, not_subscribed = await check_subscription(user_id)
-    if not ok:
-        await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
-        return
     min_level = await get_setting_int("min_level_multiplayer")
     level = await get_user_level(user_id)
     if level < min_level:
@@ -300,7 +293,7 @@ async def create_room_bet(message: types.Message, state: FSMContext):
     data = await state.get_data()
     max_players = data['max_players']
     game_id = generate_game_id()
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         await conn.execute(
             "INSERT INTO multiplayer_games (game_id, host_id, max_players, bet_amount, status, created_at) VALUES ($1, $2, $3, $4, $5, $6)",
             game_id, user_id, max_players, bet, 'waiting', datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -367,7 +360,7 @@ async def join_room_code(message: types.Message, state: FSMContext):
 async def list_rooms(message: types.Message):
     if message.chat.type != 'private':
         return
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         rows = await conn.fetch("SELECT * FROM multiplayer_games WHERE status='waiting' ORDER BY created_at DESC LIMIT 10")
     if not rows:
         await message.answer("Нет открытых комнат.")
@@ -383,7 +376,7 @@ async def close_room_callback(callback: types.CallbackQuery):
     await callback.answer()
     game_id = callback.data.split("_")[2]
     user_id = callback.from_user.id
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         game = await conn.fetchrow("SELECT * FROM multiplayer_games WHERE game_id=$1", game_id)
         if not game or game['host_id'] != user_id:
             await callback.message.answer("❌ Только создатель может закрыть комнату.")
@@ -421,7 +414,7 @@ async def start_game_callback(callback: types.CallbackQuery):
 async def room_action_callback(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
     user_id = callback.from_user.id
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         game_row = await conn.fetchrow("""
             SELECT g.* FROM multiplayer_games g
             JOIN game_players p ON g.game_id = p.game_id
@@ -438,7 +431,7 @@ async def room_action_callback(callback: types.CallbackQuery, state: FSMContext)
         return
 
     if action == "hit":
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             async with conn.transaction():
                 game = await conn.fetchrow("SELECT * FROM multiplayer_games WHERE game_id=$1 FOR UPDATE", game_id)
                 deck = game['deck'].split(',')
@@ -462,13 +455,13 @@ async def room_action_callback(callback: types.CallbackQuery, state: FSMContext)
         await show_current_turn(game_id, user_id=user_id)
 
     elif action == "stand":
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             await conn.execute("UPDATE game_players SET stopped=TRUE WHERE game_id=$1 AND user_id=$2", game_id, user_id)
             await next_player(game_id)
         await show_current_turn(game_id, user_id=user_id)
 
     elif action == "double":
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             async with conn.transaction():
                 player = await conn.fetchrow("SELECT * FROM game_players WHERE game_id=$1 AND user_id=$2 FOR UPDATE", game_id, user_id)
                 if player['doubled']:
@@ -500,7 +493,7 @@ async def room_action_callback(callback: types.CallbackQuery, state: FSMContext)
         await show_current_turn(game_id, user_id=user_id)
 
     elif action == "surrender":
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             await conn.execute("UPDATE game_players SET surrendered=TRUE WHERE game_id=$1 AND user_id=$2", game_id, user_id)
             await next_player(game_id)
         await show_current_turn(game_id, user_id=user_id)
@@ -531,7 +524,7 @@ async def leave_room_callback(callback: types.CallbackQuery):
     await callback.answer()
     game_id = callback.data.split("_")[2]
     user_id = callback.from_user.id
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         game = await conn.fetchrow("SELECT * FROM multiplayer_games WHERE game_id=$1", game_id)
         if game and game['status'] == 'waiting':
             await remove_player_from_game(game_id, user_id)
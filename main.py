@@ -2,13 +2,17 @@
 import asyncio
 import logging
 import os
+import time
 
 from aiogram import executor
 from aiogram.types import BotCommand, BotCommandScopeAllPrivateChats, BotCommandScopeAllGroupChats
 
 from bot_instance import dp, bot
-from utils.db import create_db_pool, init_db
-from utils.background import start_background_tasks
+from utils.db import create_db_pool, close_db_pool, init_db
+from utils.background import start_background_tasks, resume_broadcasts
+from utils.metrics import start_metrics_server
+from utils.outbox import start_outbox, stop_outbox
+from utils.middlewares import ThrottlingMiddleware, UnitOfWorkMiddleware, UserSnapshotMiddleware, GuardMiddleware
 from handlers import common, games, multiplayer, economy, groups, admin
 
 logging.basicConfig(
@@ -16,9 +20,14 @@ logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(name)s - %(message)s"
 )
 
+PROCESS_STARTED = time.monotonic()
+
 async def on_startup(dp):
     await create_db_pool()
     await init_db()
+    start_outbox()
+    await resume_broadcasts()
+    await start_metrics_server()
 
     await bot.set_my_commands(
         [BotCommand("start", "🚀 Запустить бота")],
@@ -34,14 +43,19 @@ async def on_startup(dp):
         ],
         scope=BotCommandScopeAllGroupChats()
     )
-    logging.info("Бот запущен!")
+    logging.info(f"Бот запущен! Готов к работе через {time.monotonic() - PROCESS_STARTED:.2f} с после старта процесса")
 
 async def on_shutdown(dp):
-    if db_pool:
-        await db_pool.close()
+    await stop_outbox()
+    await close_db_pool()
     logging.info("Бот остановлен, соединения закрыты.")
 
 if __name__ == '__main__':
+    # Троттлинг первым: отброшенный апдейт не должен открывать единицу работы.
+    dp.middleware.setup(ThrottlingMiddleware())
+    dp.middleware.setup(UnitOfWorkMiddleware())
+    dp.middleware.setup(UserSnapshotMiddleware())
+    dp.middleware.setup(GuardMiddleware())
     loop = asyncio.get_event_loop()
     loop.create_task(start_background_tasks())
     executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
@@ -0,0 +1,97 @@
+import os
+import asyncio
+
+os.environ.setdefault("DATABASE_URL", "postgresql://test@localhost/test")
+
+from utils import db
+
+
+class FakeConnection:
+    def __init__(self):
+        self.in_transaction = False
+
+    def is_in_transaction(self):
+        return self.in_transaction
+
+
+class FakePool:
+    """Считает занятые слоты вместо настоящего пула asyncpg."""
+
+    def __init__(self):
+        self.in_use = 0
+        self.acquired = 0
+
+    async def acquire(self, pool, site):
+        self.in_use += 1
+        self.acquired += 1
+        return FakeConnection()
+
+    async def release(self, pool, conn):
+        self.in_use -= 1
+
+
+def _patch_pool(monkeypatch):
+    pool = FakePool()
+    monkeypatch.setattr(db, "pool_acquire", pool.acquire)
+    monkeypatch.setattr(db, "pool_release", pool.release)
+    return pool
+
+
+def test_handler_sleeping_between_queries_does_not_hold_a_slot(monkeypatch):
+    pool = _patch_pool(monkeypatch)
+    in_use_while_sleeping = []
+
+    async def handler():
+        token = db.begin_unit_of_work()
+        try:
+            async with db.acquire():
+                pass
+            await asyncio.sleep(0)
+            in_use_while_sleeping.append(pool.in_use)
+            async with db.acquire():
+                pass
+        finally:
+            await db.end_unit_of_work(token)
+
+    asyncio.run(handler())
+    assert in_use_while_sleeping == [0]
+    assert pool.in_use == 0
+    assert pool.acquired == 2
+
+
+def test_nested_acquires_share_one_connection(monkeypatch):
+    pool = _patch_pool(monkeypatch)
+
+    async def handler():
+        token = db.begin_unit_of_work()
+        try:
+            async with db.acquire() as outer:
+                async with db.acquire() as inner:
+                    assert inner is outer
+                    assert pool.in_use == 1
+                assert pool.in_use == 1
+            assert pool.in_use == 0
+        finally:
+            await db.end_unit_of_work(token)
+
+    asyncio.run(handler())
+    assert pool.acquired == 1
+
+
+def test_open_transaction_keeps_the_connection(monkeypatch):
+    pool = _patch_pool(monkeypatch)
+
+    async def handler():
+        token = db.begin_unit_of_work()
+        try:
+            async with db.acquire() as conn:
+                conn.in_transaction = True
+            assert pool.in_use == 1
+            async with db.acquire() as again:
+                assert again is conn
+                conn.in_transaction = False
+            assert pool.in_use == 0
+        finally:
+            await db.end_unit_of_work(token)
+
+    asyncio.run(handler())
@@ -1,30 +1,43 @@
 import asyncio
+import json
 import logging
 import random
+import uuid
 from datetime import datetime, timedelta, date
 
-from bot_instance import bot
 from utils.db import (
-    db_pool, get_setting, get_setting_int, get_setting_float,
+    acquire, get_setting, get_setting_int, get_setting_float,
     get_confirmed_chats, get_user_reputation, get_media_file_id,
     update_user_bitcoin, update_user_balance, add_exp, set_smuggle_cooldown,
-    spawn_boss
+    spawn_boss, write_behind_flusher, pool_watchdog, set_background_priority,
+    settings_refresher, cache_listener, cooldown_sweeper,
+    claim_broadcast, fetch_broadcast_batch, checkpoint_broadcast, finish_broadcast,
+    get_running_broadcasts
 )
 from utils.constants import (
     SMUGGLE_SUCCESS_PHRASES, SMUGGLE_CAUGHT_PHRASES, SMUGGLE_LOST_PHRASES
 )
-from utils.helpers import get_random_phrase, notify_chats
+from bot_instance import bot
+from utils.helpers import get_random_phrase, notify_chats, broadcast_status_text
+from utils.keyboards import broadcast_job_inline
+from utils import outbox
+
+def _fallback_to_private(user_id: int, text: str):
+    """Если в чат отправить не вышло, результат уходит игроку в личку."""
+    def callback(future):
+        if future.result() is None:
+            outbox.send_message(user_id, text)
+    return callback
 
 async def process_smuggle_runs():
     while True:
         try:
             await asyncio.sleep(30)
-            now = datetime.now()
-            async with db_pool.acquire() as conn:
+            async with acquire() as conn:
                 runs = await conn.fetch("""
                     SELECT * FROM smuggle_runs
-                    WHERE status = 'in_progress' AND end_time::timestamp <= $1 AND notified = FALSE
-                """, now)
+                    WHERE status = 'in_progress' AND notified = FALSE AND end_time <= NOW()
+                """)
 
                 for run in runs:
                     try:
@@ -95,18 +108,16 @@ async def process_smuggle_runs():
                         )
 
                         if chat_id:
-                            try:
-                                user = await conn.fetchrow("SELECT first_name FROM users WHERE user_id=$1", user_id)
-                                name = user['first_name'] if user else f"ID {user_id}"
-                                file_id = await get_media_file_id('smuggle_result')
-                                if file_id:
-                                    await bot.send_photo(chat_id, file_id, caption=f"{result_text}\n(для {name})")
-                                else:
-                                    await bot.send_message(chat_id, f"{result_text}\n(для {name})")
-                            except:
-                                await bot.send_message(user_id, result_text)
+                            user = await conn.fetchrow("SELECT first_name FROM users WHERE user_id=$1", user_id)
+                            name = user['first_name'] if user else f"ID {user_id}"
+                            file_id = await get_media_file_id('smuggle_result')
+                            if file_id:
+                                sent = outbox.send(chat_id, 'send_photo', file_id, caption=f"{result_text}\n(для {name})")
+                            else:
+                                sent = outbox.send_message(chat_id, f"{result_text}\n(для {name})")
+                            sent.add_done_callback(_fallback_to_private(user_id, result_text))
                         else:
-                            await bot.send_message(user_id, result_text)
+                            outbox.send_message(user_id, result_text)
 
                         await set_smuggle_cooldown(user_id, penalty)
 
@@ -123,7 +134,7 @@ async def check_auctions():
         try:
             await asyncio.sleep(60)
             now = datetime.now()
-            async with db_pool.acquire() as conn:
+            async with acquire() as conn:
                 expired = await conn.fetch("""
                     SELECT * FROM auctions
                     WHERE status = 'active' AND end_time IS NOT NULL AND end_time <= $1
@@ -146,11 +157,11 @@ async def check_auctions():
                                 "UPDATE auctions SET status = 'ended', winner_id = $1, current_price = $2 WHERE id = $3",
                                 winner_id, final_price, auction_id
                             )
-                            await bot.send_message(
+                            outbox.send_message(
                                 winner_id,
                                 f"🎉 Поздравляем! Вы выиграли аукцион «{auction['item_name']}» с ценой {final_price:.2f} баксов. Админ скоро свяжется."
                             )
-                            await bot.send_message(
+                            outbox.send_message(
                                 auction['created_by'],
                                 f"🏁 Аукцион «{auction['item_name']}» завершён. Победитель: {winner_id}, цена: {final_price:.2f}."
                             )
@@ -159,7 +170,7 @@ async def check_auctions():
                                 "UPDATE auctions SET status = 'ended', winner_id = NULL WHERE id = $1",
                                 auction_id
                             )
-                            await bot.send_message(
+                            outbox.send_message(
                                 auction['created_by'],
                                 f"🏁 Аукцион «{auction['item_name']}» завершён без ставок."
                             )
@@ -177,7 +188,7 @@ async def boss_spawn_scheduler():
             if random.randint(1, 100) > spawn_chance:
                 continue
 
-            async with db_pool.acquire() as conn:
+            async with acquire() as conn:
                 chat_row = await conn.fetchrow("""
                     SELECT chat_id FROM confirmed_chats 
                     WHERE boss_spawn_count < (SELECT value::int FROM settings WHERE key='boss_max_per_day')
@@ -190,7 +201,7 @@ async def boss_spawn_scheduler():
             max_per_day = await get_setting_int("boss_max_per_day")
             today = date.today().isoformat()
 
-            async with db_pool.acquire() as conn2:
+            async with acquire() as conn2:
                 chat_data = await conn2.fetchrow(
                     "SELECT boss_last_spawn, boss_spawn_count FROM confirmed_chats WHERE chat_id = $1",
                     chat_id
@@ -232,55 +243,50 @@ async def ad_sender():
         try:
             await asyncio.sleep(300)
             now = datetime.now()
-            async with db_pool.acquire() as conn:
+            async with acquire() as conn:
                 ads = await conn.fetch("SELECT * FROM ads WHERE enabled = TRUE")
-                for ad in ads:
-                    try:
-                        last_sent = ad['last_sent']
-                        interval = ad['interval_minutes']
-                        if last_sent:
-                            try:
-                                if isinstance(last_sent, str):
-                                    last = datetime.strptime(last_sent, "%Y-%m-%d %H:%M:%S.%f")
-                                else:
-                                    last = last_sent
-                                if (now - last).total_seconds() < interval * 60:
-                                    continue
-                            except:
-                                pass
+            # Соединение не держим: рассылка ждёт места в очереди отправки.
+            for ad in ads:
+                try:
+                    last_sent = ad['last_sent']
+                    interval = ad['interval_minutes']
+                    if last_sent:
+                        try:
+                            if isinstance(last_sent, str):
+                                last = datetime.strptime(last_sent, "%Y-%m-%d %H:%M:%S.%f")
+                            else:
+                                last = last_sent
+                            if (now - last).total_seconds() < interval * 60:
+                                continue
+                        except:
+                            pass
 
-                        target = ad['target']
-                        recipients = []
+                    target = ad['target']
+                    recipients = []
 
-                        if target in ('chats', 'all'):
-                            confirmed = await get_confirmed_chats()
-                            for chat_id in confirmed.keys():
+                    if target in ('chats', 'all'):
+                        confirmed = await get_confirmed_chats()
+                        for chat_id, data in confirmed.items():
+                            if data.get('unreachable_since') is None:
                                 recipients.append(('chat', chat_id))
-                        if target in ('private', 'all'):
-                            async with db_pool.acquire() as conn2:
-                                users = await conn2.fetch("SELECT user_id FROM users")
-                                for u in users:
-                                    recipients.append(('user', u['user_id']))
-
-                        sent_count = 0
-                        for typ, dest in recipients:
-                            try:
-                                if typ == 'chat':
-                                    await bot.send_message(dest, ad['text'])
-                                else:
-                                    await bot.send_message(dest, ad['text'])
-                                sent_count += 1
-                            except:
-                                pass
-                            await asyncio.sleep(0.05)
+                    if target in ('private', 'all'):
+                        async with acquire() as conn2:
+                            users = await conn2.fetch("SELECT user_id FROM users WHERE unreachable_since IS NULL")
+                            for u in users:
+                                recipients.append(('user', u['user_id']))
+
+                    for typ, dest in recipients:
+                        await outbox.wait_for_room()
+                        outbox.send_message(dest, ad['text'], priority=outbox.PRIORITY_BULK)
 
+                    async with acquire() as conn:
                         await conn.execute(
                             "UPDATE ads SET last_sent = $1 WHERE id = $2",
                             now, ad['id']
                         )
-                        logging.info(f"Ad {ad['id']} sent to {sent_count} recipients")
-                    except Exception as e:
-                        logging.error(f"Error processing ad {ad['id']}: {e}", exc_info=True)
+                    logging.info(f"Ad {ad['id']} queued for {len(recipients)} recipients")
+                except Exception as e:
+                    logging.error(f"Error processing ad {ad['id']}: {e}", exc_info=True)
         except Exception as e:
             logging.error(f"Error in ad_sender: {e}", exc_info=True)
             await asyncio.sleep(60)
@@ -289,12 +295,11 @@ async def check_giveaways():
     while True:
         try:
             await asyncio.sleep(60)
-            now = datetime.now()
-            async with db_pool.acquire() as conn:
+            async with acquire() as conn:
                 expired = await conn.fetch("""
                     SELECT * FROM giveaways
-                    WHERE status = 'active' AND end_date <= $1
-                """, now.strftime("%Y-%m-%d %H:%M:%S"))
+                    WHERE status = 'active' AND end_date <= NOW()
+                """)
 
                 for gw in expired:
                     try:
@@ -318,12 +323,12 @@ async def check_giveaways():
                         )
 
                         for uid in winners:
-                            await bot.send_message(uid, f"🎉 Поздравляем! Вы выиграли в розыгрыше #{gw_id}: {gw['prize']}!")
+                            outbox.send_message(uid, f"🎉 Поздравляем! Вы выиграли в розыгрыше #{gw_id}: {gw['prize']}!")
                         if await get_setting("chat_notify_giveaway") == "1":
                             confirmed = await get_confirmed_chats()
                             for chat_id, data in confirmed.items():
-                                if data.get('notify_enabled', True):
-                                    await bot.send_message(chat_id, f"🏁 Розыгрыш #{gw_id} завершён! Победители: {winners_list}")
+                                if data.get('notify_enabled', True) and data.get('unreachable_since') is None:
+                                    outbox.send_message(chat_id, f"🏁 Розыгрыш #{gw_id} завершён! Победители: {winners_list}")
                     except Exception as e:
                         logging.error(f"Error processing giveaway {gw['id']}: {e}", exc_info=True)
         except Exception as e:
@@ -344,7 +349,7 @@ async def update_all_businesses_income():
     while True:
         await asyncio.sleep(3600)
         try:
-            async with db_pool.acquire() as conn:
+            async with acquire() as conn:
                 businesses = await conn.fetch("""
                     SELECT ub.*, bt.base_income_cents 
                     FROM user_businesses ub
@@ -364,7 +369,70 @@ async def update_all_businesses_income():
         except Exception as e:
             logging.error(f"Ошибка в update_all_businesses_income: {e}", exc_info=True)
 
+# ==================== РАССЫЛКИ ====================
+BROADCAST_BATCH = 500
+broadcast_tasks = {}
+
+def start_broadcast(job_id: int):
+    task = broadcast_tasks.get(job_id)
+    if task is not None and not task.done():
+        return
+    broadcast_tasks[job_id] = asyncio.create_task(run_broadcast(job_id))
+
+async def resume_broadcasts():
+    """Продолжает рассылки, прерванные перезапуском."""
+    for job_id in await get_running_broadcasts():
+        logging.info(f"📢 Продолжаю рассылку #{job_id} после перезапуска")
+        start_broadcast(job_id)
+
+def _show_broadcast_progress(job: dict):
+    if not job.get('status_chat_id'):
+        return
+    outbox.submit(job['status_chat_id'], lambda: bot.edit_message_text(
+        broadcast_status_text(job), job['status_chat_id'], job['status_message_id'],
+        reply_markup=broadcast_job_inline(job['id'], job['status'])
+    ))
+
+async def run_broadcast(job_id: int):
+    # Рассылка может идти часами — берёт соединения как фон, а не как апдейт админа.
+    set_background_priority()
+    runner = uuid.uuid4().hex
+    try:
+        job = await claim_broadcast(job_id, runner)
+        if job is None:
+            return
+        content = json.loads(job['content'])
+        if content['type'] == 'text':
+            method, payload, extra = 'send_message', content['text'], {}
+        else:
+            method, payload, extra = f"send_{content['type']}", content['file_id'], {'caption': content['caption']}
+        last_user_id = job['last_user_id']
+        while job['status'] == 'running':
+            batch = await fetch_broadcast_batch(last_user_id, BROADCAST_BATCH)
+            if not batch:
+                job = await finish_broadcast(job_id, runner) or job
+                break
+            # Темп, параллельность и RetryAfter — на стороне очереди отправки.
+            results = await asyncio.gather(*(
+                outbox.send(uid, method, payload, priority=outbox.PRIORITY_BULK, **extra) for uid in batch
+            ))
+            sent = sum(1 for r in results if r is not None)
+            last_user_id = batch[-1]
+            job = await checkpoint_broadcast(job_id, runner, last_user_id, sent, len(results) - sent)
+            if job is None:
+                logging.info(f"Рассылку #{job_id} продолжил другой исполнитель")
+                return
+            _show_broadcast_progress(job)
+        _show_broadcast_progress(job)
+        logging.info(f"📢 Рассылка #{job_id}: {job['status']}, отправлено {job['sent']}, ошибок {job['failed']}")
+    except Exception as e:
+        logging.error(f"Ошибка рассылки #{job_id}: {e}", exc_info=True)
+    finally:
+        broadcast_tasks.pop(job_id, None)
+
 async def start_background_tasks():
+    # Фоновые циклы уступают пул интерактивным апдейтам.
+    set_background_priority()
     tasks = [
         process_smuggle_runs(),
         check_auctions(),
@@ -373,5 +441,10 @@ async def start_background_tasks():
         periodic_cleanup(),
         update_all_businesses_income(),
         check_giveaways(),
+        write_behind_flusher(),
+        pool_watchdog(),
+        settings_refresher(),
+        cache_listener(),
+        cooldown_sweeper(),
     ]
     await asyncio.gather(*tasks)
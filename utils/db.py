@@ -1,14 +1,19 @@
 import os
+import sys
 import asyncio
 import logging
 import time
+import re
 import random
 import string
 import json
 import csv
 import io
+from collections import Counter, OrderedDict, deque
+from contextvars import ContextVar, Token
 from datetime import datetime, timedelta, date
-from typing import Dict, List, Optional, Tuple, Any, Union
+from types import MappingProxyType
+from typing import Dict, List, Optional, Tuple, Any, Union, Callable, Awaitable
 
 import asyncpg
 from asyncpg.pool import Pool
@@ -25,12 +30,23 @@ if "sslmode" not in DATABASE_URL:
     else:
         DATABASE_URL += "?sslmode=require"
 
+# Необязательная реплика для тяжёлых чтений (топы, статистика, экспорт).
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL")
+if DATABASE_REPLICA_URL and "sslmode" not in DATABASE_REPLICA_URL:
+    DATABASE_REPLICA_URL += ("&" if "?" in DATABASE_REPLICA_URL else "?") + "sslmode=require"
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("DB_REPLICA_MAX_LAG", "10"))
+REPLICA_LAG_CHECK_INTERVAL = 5
+
 db_pool: Optional[Pool] = None
+replica_pool: Optional[Pool] = None
+replica_usable: bool = False
+replica_lag: Optional[float] = None
+last_replica_check: float = 0
+replica_check_lock = asyncio.Lock()
 
-# Кэши с блокировками
-settings_cache: Dict[str, str] = {}
-settings_cache_lock = asyncio.Lock()
-last_settings_update: float = 0
+# Кэши с блокировками. Изменения разносятся через LISTEN/NOTIFY (см. ШИНА ИНВАЛИДАЦИИ КЭШЕЙ),
+# поэтому TTL — лишь страховка на случай потерянного уведомления.
+CACHE_TTL = 6 * 3600
 
 channels_cache: List[tuple] = []
 channels_cache_lock = asyncio.Lock()
@@ -40,6 +56,101 @@ confirmed_chats_cache: Dict[int, dict] = {}
 confirmed_chats_lock = asyncio.Lock()
 last_confirmed_chats_update: float = 0
 
+# ==================== ЖУРНАЛ МЕДЛЕННЫХ ЗАПРОСОВ ====================
+SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "200"))
+QUERY_BUCKETS_MS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500]
+
+# отпечаток SQL -> {'count', 'total', 'max', 'buckets', 'sites'}
+query_stats: Dict[str, dict] = {}
+_fingerprints: Dict[str, str] = {}
+_QUERY_WRAPPERS = {
+    'fetch', 'fetchrow', 'fetchval', 'execute', 'executemany',
+}
+
+def query_fingerprint(sql: str) -> str:
+    fingerprint = _fingerprints.get(sql)
+    if fingerprint is None:
+        fingerprint = re.sub(r"\s+", " ", sql).strip()
+        fingerprint = re.sub(r"'(?:[^']|'')*'", "?", fingerprint)
+        fingerprint = re.sub(r"(?<![$\w])\d+(?:\.\d+)?\b", "?", fingerprint)
+        if len(_fingerprints) < 5000:
+            _fingerprints[sql] = fingerprint
+    return fingerprint
+
+def _query_site() -> str:
+    frame = sys._getframe(2)
+    # Пропускаем обёртки и внутренности asyncpg (BEGIN/COMMIT из conn.transaction()).
+    while frame is not None and (
+        frame.f_code.co_name in _QUERY_WRAPPERS or f"{os.sep}asyncpg{os.sep}" in frame.f_code.co_filename
+    ):
+        frame = frame.f_back
+    if frame is None:
+        return "?"
+    module = os.path.splitext(os.path.basename(frame.f_code.co_filename))[0]
+    return f"{module}.{frame.f_code.co_name}"
+
+def record_query(sql: str, elapsed: float, site: str):
+    ms = elapsed * 1000
+    fingerprint = query_fingerprint(sql)
+    stat = query_stats.get(fingerprint)
+    if stat is None:
+        stat = query_stats[fingerprint] = {
+            'count': 0, 'total': 0.0, 'max': 0.0,
+            'buckets': [0] * (len(QUERY_BUCKETS_MS) + 1), 'sites': Counter()
+        }
+    stat['count'] += 1
+    stat['total'] += ms
+    stat['max'] = max(stat['max'], ms)
+    bucket = next((i for i, bound in enumerate(QUERY_BUCKETS_MS) if ms <= bound), len(QUERY_BUCKETS_MS))
+    stat['buckets'][bucket] += 1
+    stat['sites'][site] += 1
+    if ms >= SLOW_QUERY_MS:
+        logging.warning(f"🐢 Медленный запрос {ms:.0f} мс в {site}: {fingerprint[:300]}")
+
+class timed_query:
+    """Замеряет выполнение одного запроса: with timed_query(sql): ..."""
+    def __init__(self, sql: str):
+        self.sql = sql
+        self.site = _query_site()
+        self.started = 0.0
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        record_query(self.sql, time.monotonic() - self.started, self.site)
+
+def get_query_stats(limit: int = 10) -> List[Tuple[str, dict]]:
+    """Самые затратные запросы по суммарному времени."""
+    return sorted(query_stats.items(), key=lambda item: -item[1]['total'])[:limit]
+
+# ==================== ПОДГОТОВЛЕННЫЕ ЗАПРОСЫ ====================
+# asyncpg сам готовит и кэширует выражения на каждом соединении (statement_cache_size).
+# Под PgBouncer в режиме transaction кэш нужно выключить: DB_STATEMENT_CACHE_SIZE=0.
+STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+
+class BotConnection(asyncpg.Connection):
+    async def fetch(self, query, *args, **kwargs):
+        with timed_query(query):
+            return await super().fetch(query, *args, **kwargs)
+
+    async def fetchrow(self, query, *args, **kwargs):
+        with timed_query(query):
+            return await super().fetchrow(query, *args, **kwargs)
+
+    async def fetchval(self, query, *args, **kwargs):
+        with timed_query(query):
+            return await super().fetchval(query, *args, **kwargs)
+
+    async def execute(self, query, *args, **kwargs):
+        with timed_query(query):
+            return await super().execute(query, *args, **kwargs)
+
+    async def executemany(self, command, args, **kwargs):
+        with timed_query(command):
+            return await super().executemany(command, args, **kwargs)
+
 # ==================== ПОДКЛЮЧЕНИЕ К БД ====================
 async def create_db_pool(retries: int = 5, delay: int = 3) -> None:
     global db_pool
@@ -51,9 +162,12 @@ async def create_db_pool(retries: int = 5, delay: int = 3) -> None:
                 max_size=20,
                 command_timeout=60,
                 max_queries=50000,
-                max_inactive_connection_lifetime=300
+                max_inactive_connection_lifetime=300,
+                statement_cache_size=STATEMENT_CACHE_SIZE,
+                connection_class=BotConnection
             )
             logging.info(f"✅ Подключение к PostgreSQL установлено (попытка {attempt})")
+            await create_replica_pool()
             return
         except Exception as e:
             logging.error(f"❌ Ошибка подключения к БД (попытка {attempt}/{retries}): {e}")
@@ -62,625 +176,1194 @@ async def create_db_pool(retries: int = 5, delay: int = 3) -> None:
             else:
                 raise
 
-# ==================== ИНИЦИАЛИЗАЦИЯ ТАБЛИЦ ====================
-async def init_db() -> None:
-    async with db_pool.acquire() as conn:
-        # ---- Таблица users ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id BIGINT PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                joined_date TEXT,
-                balance NUMERIC(12,2) DEFAULT 0,
-                reputation INTEGER DEFAULT 0,
-                total_spent NUMERIC(12,2) DEFAULT 0,
-                negative_balance NUMERIC(12,2) DEFAULT 0,
-                last_bonus TEXT,
-                last_theft_time TEXT,
-                theft_attempts INTEGER DEFAULT 0,
-                theft_success INTEGER DEFAULT 0,
-                theft_failed INTEGER DEFAULT 0,
-                theft_protected INTEGER DEFAULT 0,
-                casino_wins INTEGER DEFAULT 0,
-                casino_losses INTEGER DEFAULT 0,
-                dice_wins INTEGER DEFAULT 0,
-                dice_losses INTEGER DEFAULT 0,
-                guess_wins INTEGER DEFAULT 0,
-                guess_losses INTEGER DEFAULT 0,
-                slots_wins INTEGER DEFAULT 0,
-                slots_losses INTEGER DEFAULT 0,
-                roulette_wins INTEGER DEFAULT 0,
-                roulette_losses INTEGER DEFAULT 0,
-                multiplayer_wins INTEGER DEFAULT 0,
-                multiplayer_losses INTEGER DEFAULT 0,
-                exp INTEGER DEFAULT 0,
-                level INTEGER DEFAULT 1,
-                strength INTEGER DEFAULT 1,
-                agility INTEGER DEFAULT 1,
-                defense INTEGER DEFAULT 1,
-                last_gift_time TEXT,
-                gift_count_today INTEGER DEFAULT 0,
-                global_authority INTEGER DEFAULT 0,
-                smuggle_success INTEGER DEFAULT 0,
-                smuggle_fail INTEGER DEFAULT 0,
-                bitcoin_balance NUMERIC(12,4) DEFAULT 0,
-                authority_balance INTEGER DEFAULT 0
-            )
-        ''')
-
-        # ---- Таблица бизнесов пользователей ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS user_businesses (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                business_type_id INTEGER NOT NULL,
-                level INTEGER DEFAULT 1,
-                last_collection TEXT,
-                accumulated INTEGER DEFAULT 0,
-                UNIQUE(user_id, business_type_id)
-            )
-        ''')
-
-        # ---- Таблица типов бизнесов ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS business_types (
-                id SERIAL PRIMARY KEY,
-                name TEXT UNIQUE NOT NULL,
-                emoji TEXT NOT NULL,
-                base_price_btc NUMERIC(10,2) NOT NULL,
-                base_income_cents INTEGER NOT NULL,
-                description TEXT,
-                max_level INTEGER DEFAULT 10,
-                available BOOLEAN DEFAULT TRUE
-            )
-        ''')
-
-        # ---- Таблица последних ставок ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS user_last_bets (
-                user_id BIGINT,
-                game TEXT,
-                bet_amount NUMERIC(12,2),
-                bet_data JSONB,
-                updated_at TIMESTAMP DEFAULT NOW(),
-                PRIMARY KEY (user_id, game)
-            )
-        ''')
-
-        # ---- Таблица подтверждённых чатов ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS confirmed_chats (
-                chat_id BIGINT PRIMARY KEY,
-                title TEXT,
-                type TEXT,
-                joined_date TEXT,
-                confirmed_by BIGINT,
-                confirmed_date TEXT,
-                notify_enabled BOOLEAN DEFAULT TRUE,
-                last_gift_date DATE,
-                gift_count_today INTEGER DEFAULT 0,
-                boss_last_spawn TEXT,
-                boss_spawn_count INTEGER DEFAULT 0,
-                auto_delete_enabled BOOLEAN DEFAULT TRUE,
-                last_boss_status_time TEXT
-            )
-        ''')
-
-        # ---- Запросы на подтверждение чатов ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS chat_confirmation_requests (
-                chat_id BIGINT PRIMARY KEY,
-                title TEXT,
-                type TEXT,
-                requested_by BIGINT,
-                request_date TEXT,
-                status TEXT DEFAULT 'pending'
-            )
-        ''')
-
-        # ---- Боссы ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS bosses (
-                id SERIAL PRIMARY KEY,
-                chat_id BIGINT,
-                name TEXT,
-                level INTEGER,
-                hp INTEGER,
-                max_hp INTEGER,
-                spawned_at TEXT,
-                expires_at TEXT,
-                reward_coins INTEGER,
-                reward_bitcoin INTEGER,
-                participants BIGINT[] DEFAULT '{}',
-                status TEXT DEFAULT 'active',
-                image_file_id TEXT,
-                description TEXT
-            )
-        ''')
-
-        # ---- Атаки на босса ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS boss_attacks (
-                boss_id INTEGER,
-                user_id BIGINT,
-                damage INTEGER,
-                attack_time TEXT,
-                PRIMARY KEY (boss_id, user_id)
-            )
-        ''')
-
-        # ---- Каналы для подписки ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS channels (
-                id SERIAL PRIMARY KEY,
-                chat_id TEXT UNIQUE,
-                title TEXT,
-                invite_link TEXT
-            )
-        ''')
-
-        # ---- Рефералы ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS referrals (
-                id SERIAL PRIMARY KEY,
-                referrer_id BIGINT,
-                referred_id BIGINT UNIQUE,
-                referred_date TEXT,
-                reward_given BOOLEAN DEFAULT FALSE,
-                clicks INTEGER DEFAULT 0,
-                active BOOLEAN DEFAULT FALSE
-            )
-        ''')
-
-        # ---- Товары магазина ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS shop_items (
-                id SERIAL PRIMARY KEY,
-                name TEXT,
-                description TEXT,
-                price NUMERIC(12,2),
-                stock INTEGER DEFAULT -1,
-                photo_file_id TEXT
-            )
-        ''')
+async def create_replica_pool() -> None:
+    global replica_pool
+    if not DATABASE_REPLICA_URL:
+        return
+    try:
+        replica_pool = await asyncpg.create_pool(
+            DATABASE_REPLICA_URL,
+            min_size=1,
+            max_size=5,
+            command_timeout=120,
+            max_inactive_connection_lifetime=300,
+            statement_cache_size=STATEMENT_CACHE_SIZE
+        )
+        logging.info("✅ Подключение к реплике установлено")
+    except Exception as e:
+        # Без реплики бот работает как раньше — все чтения идут в основную БД.
+        logging.error(f"❌ Реплика недоступна, чтения пойдут в основную БД: {e}")
+        replica_pool = None
+
+async def close_db_pool() -> None:
+    global db_pool, replica_pool
+    if db_pool is None:
+        return
+    await flush_write_behind()
+    await db_pool.close()
+    db_pool = None
+    if replica_pool is not None:
+        await replica_pool.close()
+        replica_pool = None
+
+async def check_replica() -> bool:
+    """Можно ли сейчас читать с реплики: она есть и отстаёт не больше REPLICA_MAX_LAG_SECONDS."""
+    global replica_usable, replica_lag, last_replica_check
+    if replica_pool is None:
+        return False
+    async with replica_check_lock:
+        now = time.time()
+        if now - last_replica_check < REPLICA_LAG_CHECK_INTERVAL:
+            return replica_usable
+        last_replica_check = now
+        try:
+            async with replica_pool.acquire() as conn:
+                # Простаивающая реплика без новых WAL не отстаёт, даже если последняя транзакция давно.
+                replica_lag = await conn.fetchval("""
+                    SELECT CASE
+                        WHEN NOT pg_is_in_recovery() THEN 0
+                        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                        ELSE COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0)
+                    END
+                """)
+            usable = replica_lag <= REPLICA_MAX_LAG_SECONDS
+        except Exception as e:
+            logging.warning(f"Проверка реплики не удалась: {e}")
+            replica_lag = None
+            usable = False
+        if usable != replica_usable:
+            if usable:
+                logging.info(f"Реплика снова используется (отставание {replica_lag:.1f} с)")
+            else:
+                logging.warning(f"Реплика отстаёт или недоступна ({replica_lag}), чтения идут в основную БД")
+        replica_usable = usable
+        return usable
+
+# ==================== ЕДИНИЦА РАБОТЫ (ОДНО СОЕДИНЕНИЕ НА АПДЕЙТ) ====================
+class UnitOfWork:
+    """Соединение, общее для вложенных запросов одного апдейта. Берётся из пула лениво и
+    возвращается, как только закрыт последний блок acquire() и нет открытой транзакции:
+    между запросами хендлер шлёт сообщения и спит в анимациях, и слот пула ему не нужен."""
+
+    def __init__(self):
+        self.task = asyncio.current_task()
+        self.conn = None
+        self.depth = 0
+
+    async def enter(self, site: str = "update"):
+        if self.conn is None:
+            self.conn = await pool_acquire(db_pool, f"update:{site}")
+        self.depth += 1
+        return self.conn
+
+    async def exit(self):
+        self.depth -= 1
+        if self.depth == 0 and self.conn is not None and not self.conn.is_in_transaction():
+            await self.release()
+
+    async def release(self):
+        self.depth = 0
+        if self.conn is not None:
+            conn, self.conn = self.conn, None
+            await pool_release(db_pool, conn)
+
+current_uow: ContextVar[Optional[UnitOfWork]] = ContextVar("current_uow", default=None)
+
+def begin_unit_of_work() -> Token:
+    return current_uow.set(UnitOfWork())
+
+async def end_unit_of_work(token: Token):
+    uow = current_uow.get()
+    current_uow.reset(token)
+    if uow is not None:
+        await uow.release()
+
+class _Acquire:
+    def __init__(self, site: str, readonly: bool = False):
+        self._site = site
+        self._readonly = readonly
+        self._own_conn = None
+        self._pool = None
+        self._uow = None
+
+    async def __aenter__(self):
+        if self._readonly and await check_replica():
+            self._pool = replica_pool
+            self._own_conn = await pool_acquire(replica_pool, f"replica:{self._site}")
+            return self._own_conn
+        uow = current_uow.get()
+        # Задачи, порождённые хендлером через create_task, наследуют контекст,
+        # но не должны делить с ним соединение — им выдаём отдельное из пула.
+        if uow is not None and uow.task is asyncio.current_task():
+            conn = await uow.enter(self._site)
+            self._uow = uow
+            return conn
+        self._pool = db_pool
+        self._own_conn = await pool_acquire(db_pool, self._site)
+        return self._own_conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._uow is not None:
+            uow, self._uow = self._uow, None
+            await uow.exit()
+        if self._own_conn is not None:
+            conn, self._own_conn = self._own_conn, None
+            await pool_release(self._pool, conn)
+
+def _call_site(depth: int = 2) -> str:
+    frame = sys._getframe(depth)
+    module = os.path.splitext(os.path.basename(frame.f_code.co_filename))[0]
+    return f"{module}.{frame.f_code.co_name}"
+
+def acquire(readonly: bool = False) -> _Acquire:
+    """Соединение текущего апдейта, если он открыт, иначе — отдельное из пула.
+    readonly=True — тяжёлое чтение, которое можно отдать реплике (если она есть и не отстаёт)."""
+    return _Acquire(_call_site(), readonly)
+
+# ==================== МЕТРИКИ ПУЛА ====================
+LONG_HOLD_SECONDS = float(os.getenv("DB_LONG_HOLD_SECONDS", "5"))
+
+acquire_waits: deque = deque(maxlen=1000)
+acquire_total: int = 0
+acquire_wait_max: float = 0
+# место вызова -> [захватов, суммарное удержание, максимальное удержание]
+hold_stats: Dict[str, List[float]] = {}
+# id(conn) -> (место вызова, момент захвата)
+active_holds: Dict[int, Tuple[str, float]] = {}
+reported_long_holds: set = set()
+
+# ---- Приоритеты: интерактивные апдейты важнее фоновых циклов ----
+ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "5"))
+BACKGROUND_MAX_CONNECTIONS = int(os.getenv("DB_BACKGROUND_MAX_CONNECTIONS", "5"))
+# Фон может подождать дольше интерактива, но не бесконечно.
+BACKGROUND_ACQUIRE_TIMEOUT = float(os.getenv("DB_BACKGROUND_ACQUIRE_TIMEOUT", "60"))
+# Если интерактивные запросы ждут соединение дольше этого, фон притормаживает.
+BACKGROUND_BACKOFF_WAIT = float(os.getenv("DB_BACKGROUND_BACKOFF_WAIT", "0.2"))
+BACKGROUND_MAX_BACKOFF = 30
+
+class DatabaseBusy(Exception):
+    """Пул занят дольше ACQUIRE_TIMEOUT — апдейт лучше отклонить, чем подвесить."""
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BACKGROUND = "background"
+current_priority: ContextVar[str] = ContextVar("current_priority", default=PRIORITY_INTERACTIVE)
+
+# Семафор ограничивает число фоновых задач с соединением, а не число соединений: вложенный
+# захват (фоновая задача держит соединение и вызывает хелпер, берущий второе) слот не занимает,
+# иначе пять таких задач ждали бы друг друга вечно.
+background_semaphore = asyncio.Semaphore(BACKGROUND_MAX_CONNECTIONS)
+# id(conn) -> задача, которая его держит
+background_holds: Dict[int, asyncio.Task] = {}
+# задача -> сколько фоновых соединений она держит
+background_task_conns: Counter = Counter()
+interactive_wait_ewma: float = 0
+last_interactive_acquire: float = 0
+busy_rejections: int = 0
+
+def set_background_priority():
+    """Все задачи, созданные дальше в этом контексте, берут соединения как фоновые."""
+    current_priority.set(PRIORITY_BACKGROUND)
+
+def interactive_pressure() -> float:
+    # Оценка устаревает, если интерактивных захватов давно не было.
+    if time.monotonic() - last_interactive_acquire > 10:
+        return 0.0
+    return interactive_wait_ewma
+
+async def _background_backoff():
+    delay, waited = 0.5, 0.0
+    while interactive_pressure() > BACKGROUND_BACKOFF_WAIT and waited < BACKGROUND_MAX_BACKOFF:
+        await asyncio.sleep(delay)
+        waited += delay
+        delay = min(delay * 2, 8)
+
+async def pool_acquire(pool: Pool, site: str):
+    global acquire_total, acquire_wait_max, interactive_wait_ewma, last_interactive_acquire, busy_rejections
+    background = pool is db_pool and current_priority.get() == PRIORITY_BACKGROUND
+    started = time.monotonic()
+    if background:
+        task = asyncio.current_task()
+        nested = background_task_conns[task] > 0
+        if not nested:
+            await _background_backoff()
+            try:
+                await asyncio.wait_for(background_semaphore.acquire(), timeout=BACKGROUND_ACQUIRE_TIMEOUT)
+            except asyncio.TimeoutError:
+                busy_rejections += 1
+                logging.warning(f"🚦 Фоновой задаче не досталось соединение за {BACKGROUND_ACQUIRE_TIMEOUT:.0f} с: {site}")
+                raise DatabaseBusy(site)
+        try:
+            conn = await pool.acquire(timeout=BACKGROUND_ACQUIRE_TIMEOUT)
+        except BaseException as e:
+            if not nested:
+                background_semaphore.release()
+            if isinstance(e, asyncio.TimeoutError):
+                busy_rejections += 1
+                raise DatabaseBusy(site)
+            raise
+        background_task_conns[task] += 1
+        background_holds[id(conn)] = task
+    else:
+        try:
+            conn = await pool.acquire(timeout=ACQUIRE_TIMEOUT)
+        except asyncio.TimeoutError:
+            busy_rejections += 1
+            logging.warning(f"🚦 Нет свободного соединения за {ACQUIRE_TIMEOUT:.0f} с: {site}")
+            raise DatabaseBusy(site)
+    now = time.monotonic()
+    waited = now - started
+    acquire_waits.append(waited)
+    acquire_total += 1
+    acquire_wait_max = max(acquire_wait_max, waited)
+    if not background and pool is db_pool:
+        interactive_wait_ewma = interactive_wait_ewma * 0.8 + waited * 0.2
+        last_interactive_acquire = now
+    active_holds[id(conn)] = (site, now)
+    return conn
+
+async def pool_release(pool: Pool, conn):
+    info = active_holds.pop(id(conn), None)
+    reported_long_holds.discard(id(conn))
+    task = background_holds.pop(id(conn), None)
+    if task is not None:
+        background_task_conns[task] -= 1
+        if background_task_conns[task] <= 0:
+            del background_task_conns[task]
+            background_semaphore.release()
+    if info is not None:
+        site, started = info
+        held = time.monotonic() - started
+        stat = hold_stats.setdefault(site, [0, 0.0, 0.0])
+        stat[0] += 1
+        stat[1] += held
+        stat[2] = max(stat[2], held)
+        if held > LONG_HOLD_SECONDS:
+            logging.warning(f"⏱ Соединение удерживалось {held:.1f} с: {site}")
+    await pool.release(conn)
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+def get_long_holds() -> List[Tuple[str, float]]:
+    now = time.monotonic()
+    return sorted(
+        ((site, now - started) for site, started in active_holds.values() if now - started > LONG_HOLD_SECONDS),
+        key=lambda item: -item[1]
+    )
+
+def get_pool_stats(limit: int = 10) -> dict:
+    waits = list(acquire_waits)
+    size = db_pool.get_size() if db_pool else 0
+    idle = db_pool.get_idle_size() if db_pool else 0
+    top_holders = sorted(hold_stats.items(), key=lambda item: -item[1][1])[:limit]
+    return {
+        'size': size,
+        'idle': idle,
+        'in_use': size - idle,
+        'max_size': db_pool.get_max_size() if db_pool else 0,
+        'acquires': acquire_total,
+        'wait_avg': sum(waits) / len(waits) if waits else 0.0,
+        'wait_p95': _percentile(waits, 0.95),
+        'wait_max': acquire_wait_max,
+        'interactive_pressure': interactive_pressure(),
+        'background_in_use': len(background_holds),
+        'busy_rejections': busy_rejections,
+        'holders': [
+            {'site': site, 'count': int(count), 'total': total, 'avg': total / count, 'max': max_held}
+            for site, (count, total, max_held) in top_holders
+        ],
+        'long_holds': get_long_holds(),
+    }
+
+async def pool_watchdog():
+    """Раз в 10 секунд предупреждает о соединениях, которые всё ещё удерживаются слишком долго."""
+    while True:
+        await asyncio.sleep(10)
+        now = time.monotonic()
+        for conn_id, (site, started) in list(active_holds.items()):
+            held = now - started
+            if held > LONG_HOLD_SECONDS and conn_id not in reported_long_holds:
+                reported_long_holds.add(conn_id)
+                logging.warning(f"⏱ Соединение занято уже {held:.1f} с и не возвращено: {site}")
 
-        # ---- Покупки ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS purchases (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                item_id INTEGER,
-                purchase_date TEXT,
-                status TEXT DEFAULT 'pending',
-                admin_comment TEXT
-            )
-        ''')
+# ==================== ИНИЦИАЛИЗАЦИЯ ТАБЛИЦ ====================
+async def create_base_schema(conn) -> None:
+    # ---- Таблица users ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            joined_date TEXT,
+            balance NUMERIC(12,2) DEFAULT 0,
+            reputation INTEGER DEFAULT 0,
+            total_spent NUMERIC(12,2) DEFAULT 0,
+            negative_balance NUMERIC(12,2) DEFAULT 0,
+            last_bonus TIMESTAMPTZ,
+            last_theft_time TIMESTAMPTZ,
+            theft_attempts INTEGER DEFAULT 0,
+            theft_success INTEGER DEFAULT 0,
+            theft_failed INTEGER DEFAULT 0,
+            theft_protected INTEGER DEFAULT 0,
+            casino_wins INTEGER DEFAULT 0,
+            casino_losses INTEGER DEFAULT 0,
+            dice_wins INTEGER DEFAULT 0,
+            dice_losses INTEGER DEFAULT 0,
+            guess_wins INTEGER DEFAULT 0,
+            guess_losses INTEGER DEFAULT 0,
+            slots_wins INTEGER DEFAULT 0,
+            slots_losses INTEGER DEFAULT 0,
+            roulette_wins INTEGER DEFAULT 0,
+            roulette_losses INTEGER DEFAULT 0,
+            multiplayer_wins INTEGER DEFAULT 0,
+            multiplayer_losses INTEGER DEFAULT 0,
+            exp INTEGER DEFAULT 0,
+            level INTEGER DEFAULT 1,
+            strength INTEGER DEFAULT 1,
+            agility INTEGER DEFAULT 1,
+            defense INTEGER DEFAULT 1,
+            last_gift_time TEXT,
+            gift_count_today INTEGER DEFAULT 0,
+            global_authority INTEGER DEFAULT 0,
+            smuggle_success INTEGER DEFAULT 0,
+            smuggle_fail INTEGER DEFAULT 0,
+            bitcoin_balance NUMERIC(12,4) DEFAULT 0,
+            authority_balance INTEGER DEFAULT 0
+        )
+    ''')
+
+    # ---- Таблица бизнесов пользователей ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_businesses (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            business_type_id INTEGER NOT NULL,
+            level INTEGER DEFAULT 1,
+            last_collection TIMESTAMPTZ,
+            accumulated INTEGER DEFAULT 0,
+            UNIQUE(user_id, business_type_id)
+        )
+    ''')
+
+    # ---- Таблица типов бизнесов ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS business_types (
+            id SERIAL PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL,
+            emoji TEXT NOT NULL,
+            base_price_btc NUMERIC(10,2) NOT NULL,
+            base_income_cents INTEGER NOT NULL,
+            description TEXT,
+            max_level INTEGER DEFAULT 10,
+            available BOOLEAN DEFAULT TRUE
+        )
+    ''')
+
+    # ---- Таблица последних ставок ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_last_bets (
+            user_id BIGINT,
+            game TEXT,
+            bet_amount NUMERIC(12,2),
+            bet_data JSONB,
+            updated_at TIMESTAMP DEFAULT NOW(),
+            PRIMARY KEY (user_id, game)
+        )
+    ''')
+
+    # ---- Таблица подтверждённых чатов ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS confirmed_chats (
+            chat_id BIGINT PRIMARY KEY,
+            title TEXT,
+            type TEXT,
+            joined_date TEXT,
+            confirmed_by BIGINT,
+            confirmed_date TEXT,
+            notify_enabled BOOLEAN DEFAULT TRUE,
+            last_gift_date DATE,
+            gift_count_today INTEGER DEFAULT 0,
+            boss_last_spawn TEXT,
+            boss_spawn_count INTEGER DEFAULT 0,
+            auto_delete_enabled BOOLEAN DEFAULT TRUE,
+            last_boss_status_time TEXT
+        )
+    ''')
+
+    # ---- Запросы на подтверждение чатов ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS chat_confirmation_requests (
+            chat_id BIGINT PRIMARY KEY,
+            title TEXT,
+            type TEXT,
+            requested_by BIGINT,
+            request_date TEXT,
+            status TEXT DEFAULT 'pending'
+        )
+    ''')
+
+    # ---- Боссы ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS bosses (
+            id SERIAL PRIMARY KEY,
+            chat_id BIGINT,
+            name TEXT,
+            level INTEGER,
+            hp INTEGER,
+            max_hp INTEGER,
+            spawned_at TIMESTAMPTZ,
+            expires_at TIMESTAMPTZ,
+            reward_coins INTEGER,
+            reward_bitcoin INTEGER,
+            participants BIGINT[] DEFAULT '{}',
+            status TEXT DEFAULT 'active',
+            image_file_id TEXT,
+            description TEXT
+        )
+    ''')
+
+    # ---- Атаки на босса ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS boss_attacks (
+            boss_id INTEGER,
+            user_id BIGINT,
+            damage INTEGER,
+            attack_time TIMESTAMPTZ,
+            PRIMARY KEY (boss_id, user_id)
+        )
+    ''')
+
+    # ---- Каналы для подписки ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS channels (
+            id SERIAL PRIMARY KEY,
+            chat_id TEXT UNIQUE,
+            title TEXT,
+            invite_link TEXT
+        )
+    ''')
+
+    # ---- Рефералы ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS referrals (
+            id SERIAL PRIMARY KEY,
+            referrer_id BIGINT,
+            referred_id BIGINT UNIQUE,
+            referred_date TEXT,
+            reward_given BOOLEAN DEFAULT FALSE,
+            clicks INTEGER DEFAULT 0,
+            active BOOLEAN DEFAULT FALSE
+        )
+    ''')
+
+    # ---- Товары магазина ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS shop_items (
+            id SERIAL PRIMARY KEY,
+            name TEXT,
+            description TEXT,
+            price NUMERIC(12,2),
+            stock INTEGER DEFAULT -1,
+            photo_file_id TEXT
+        )
+    ''')
+
+    # ---- Покупки ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS purchases (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            item_id INTEGER,
+            purchase_date TIMESTAMPTZ,
+            status TEXT DEFAULT 'pending',
+            admin_comment TEXT
+        )
+    ''')
+
+    # ---- Промокоды ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS promocodes (
+            code TEXT PRIMARY KEY,
+            reward NUMERIC(12,2),
+            max_uses INTEGER,
+            used_count INTEGER DEFAULT 0,
+            created_at TEXT
+        )
+    ''')
+
+    # ---- Активации промокодов ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS promo_activations (
+            user_id BIGINT,
+            promo_code TEXT,
+            activated_at TEXT,
+            PRIMARY KEY (user_id, promo_code)
+        )
+    ''')
+
+    # ---- Розыгрыши ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS giveaways (
+            id SERIAL PRIMARY KEY,
+            prize TEXT,
+            description TEXT,
+            end_date TIMESTAMPTZ,
+            media_file_id TEXT,
+            media_type TEXT,
+            status TEXT DEFAULT 'active',
+            winner_id BIGINT,
+            winners_count INTEGER DEFAULT 1,
+            winners_list TEXT,
+            notified BOOLEAN DEFAULT FALSE
+        )
+    ''')
+
+    # ---- Участники розыгрышей ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS participants (
+            user_id BIGINT,
+            giveaway_id INTEGER,
+            PRIMARY KEY (user_id, giveaway_id)
+        )
+    ''')
+
+    # ---- Админы ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS admins (
+            user_id BIGINT PRIMARY KEY,
+            added_by BIGINT,
+            added_date TEXT,
+            permissions TEXT DEFAULT '[]'
+        )
+    ''')
+
+    # ---- Забаненные ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS banned_users (
+            user_id BIGINT PRIMARY KEY,
+            banned_by BIGINT,
+            banned_date TEXT,
+            reason TEXT
+        )
+    ''')
 
-        # ---- Промокоды ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS promocodes (
-                code TEXT PRIMARY KEY,
-                reward NUMERIC(12,2),
-                max_uses INTEGER,
-                used_count INTEGER DEFAULT 0,
-                created_at TEXT
-            )
-        ''')
+    # ---- Настройки ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+
+    # ---- Задания ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS tasks (
+            id SERIAL PRIMARY KEY,
+            name TEXT,
+            description TEXT,
+            task_type TEXT,
+            target_id TEXT,
+            reward_coins NUMERIC(12,2) DEFAULT 0,
+            reward_reputation INTEGER DEFAULT 0,
+            required_days INTEGER DEFAULT 0,
+            penalty_days INTEGER DEFAULT 0,
+            created_by BIGINT,
+            created_at TEXT,
+            active BOOLEAN DEFAULT TRUE,
+            max_completions INTEGER DEFAULT 1,
+            completed_count INTEGER DEFAULT 0
+        )
+    ''')
+
+    # ---- Выполненные задания ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_tasks (
+            user_id BIGINT,
+            task_id INTEGER,
+            completed_at TIMESTAMPTZ,
+            expires_at TIMESTAMPTZ,
+            status TEXT DEFAULT 'completed',
+            PRIMARY KEY (user_id, task_id)
+        )
+    ''')
+
+    # ---- Мультиплеерные игры ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS multiplayer_games (
+            game_id TEXT PRIMARY KEY,
+            host_id BIGINT,
+            max_players INTEGER,
+            bet_amount NUMERIC(12,2),
+            status TEXT DEFAULT 'waiting',
+            deck TEXT,
+            created_at TEXT,
+            current_player_index INTEGER DEFAULT 0
+        )
+    ''')
+
+    # ---- Игроки в мультиплеере ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS game_players (
+            game_id TEXT,
+            user_id BIGINT,
+            username TEXT,
+            cards TEXT,
+            value INTEGER DEFAULT 0,
+            stopped BOOLEAN DEFAULT FALSE,
+            joined_at TEXT,
+            doubled BOOLEAN DEFAULT FALSE,
+            surrendered BOOLEAN DEFAULT FALSE,
+            PRIMARY KEY (game_id, user_id)
+        )
+    ''')
+
+    # ---- Награды за уровень ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS level_rewards (
+            level INTEGER PRIMARY KEY,
+            coins NUMERIC(12,2),
+            reputation INTEGER
+        )
+    ''')
+
+    # ---- Аукционы ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS auctions (
+            id SERIAL PRIMARY KEY,
+            item_name TEXT NOT NULL,
+            description TEXT,
+            start_price NUMERIC(12,2) NOT NULL,
+            current_price NUMERIC(12,2) NOT NULL,
+            start_time TIMESTAMP NOT NULL DEFAULT NOW(),
+            end_time TIMESTAMP,
+            target_price NUMERIC(12,2),
+            status TEXT DEFAULT 'active',
+            winner_id BIGINT,
+            created_by BIGINT NOT NULL,
+            created_at TIMESTAMP DEFAULT NOW(),
+            photo_file_id TEXT
+        )
+    ''')
+
+    # ---- Ставки на аукционе ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS auction_bids (
+            id SERIAL PRIMARY KEY,
+            auction_id INTEGER REFERENCES auctions(id) ON DELETE CASCADE,
+            user_id BIGINT NOT NULL,
+            bid_amount NUMERIC(12,2) NOT NULL,
+            bid_time TIMESTAMP DEFAULT NOW()
+        )
+    ''')
+
+    # ---- Авторитет в чатах ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS chat_authority (
+            chat_id BIGINT,
+            user_id BIGINT,
+            authority INTEGER DEFAULT 0,
+            total_damage INTEGER DEFAULT 0,
+            fights INTEGER DEFAULT 0,
+            PRIMARY KEY (chat_id, user_id)
+        )
+    ''')
+
+    # ---- Кулдауны боёв ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS fight_cooldowns (
+            chat_id BIGINT,
+            user_id BIGINT,
+            last_fight TIMESTAMP,
+            PRIMARY KEY (chat_id, user_id)
+        )
+    ''')
+
+    # ---- Глобальные кулдауны ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS global_cooldowns (
+            user_id BIGINT,
+            command TEXT,
+            last_used TIMESTAMP,
+            PRIMARY KEY (user_id, command)
+        )
+    ''')
+
+    # ---- Логи боёв ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS fight_logs (
+            id SERIAL PRIMARY KEY,
+            chat_id BIGINT,
+            user_id BIGINT,
+            timestamp TIMESTAMP DEFAULT NOW(),
+            damage INTEGER,
+            authority_gained INTEGER,
+            outcome TEXT
+        )
+    ''')
+
+    # ---- Реклама ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS ads (
+            id SERIAL PRIMARY KEY,
+            text TEXT NOT NULL,
+            interval_minutes INTEGER DEFAULT 60,
+            last_sent TIMESTAMP,
+            enabled BOOLEAN DEFAULT TRUE,
+            target TEXT DEFAULT 'chats'
+        )
+    ''')
+
+    # ---- Заявки на биткоин-бирже ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS bitcoin_orders (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            type TEXT NOT NULL CHECK (type IN ('buy', 'sell')),
+            amount NUMERIC(12,4) NOT NULL CHECK (amount > 0),
+            price INTEGER NOT NULL CHECK (price >= 1),
+            total_locked NUMERIC(12,4) NOT NULL,
+            created_at TIMESTAMP DEFAULT NOW(),
+            status TEXT DEFAULT 'active' CHECK (status IN ('active', 'completed', 'cancelled'))
+        )
+    ''')
+
+    # ---- Сделки ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS bitcoin_trades (
+            id SERIAL PRIMARY KEY,
+            buy_order_id INTEGER REFERENCES bitcoin_orders(id),
+            sell_order_id INTEGER REFERENCES bitcoin_orders(id),
+            amount NUMERIC(12,4) NOT NULL,
+            price INTEGER NOT NULL,
+            buyer_id BIGINT NOT NULL,
+            seller_id BIGINT NOT NULL,
+            traded_at TIMESTAMP DEFAULT NOW()
+        )
+    ''')
+
+    # ---- Контрабандные рейсы ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS smuggle_runs (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            chat_id BIGINT,
+            start_time TIMESTAMPTZ NOT NULL,
+            end_time TIMESTAMPTZ NOT NULL,
+            status TEXT DEFAULT 'in_progress',
+            result TEXT,
+            smuggle_amount NUMERIC(12,4) DEFAULT 0,
+            notified BOOLEAN DEFAULT FALSE
+        )
+    ''')
 
-        # ---- Активации промокодов ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS promo_activations (
-                user_id BIGINT,
-                promo_code TEXT,
-                activated_at TEXT,
-                PRIMARY KEY (user_id, promo_code)
-            )
-        ''')
+    # ---- Кулдауны контрабанды ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS smuggle_cooldowns (
+            user_id BIGINT PRIMARY KEY,
+            cooldown_until TIMESTAMP
+        )
+    ''')
+
+    # ---- Медиафайлы ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS media (
+            id SERIAL PRIMARY KEY,
+            key TEXT UNIQUE NOT NULL,
+            file_id TEXT NOT NULL,
+            description TEXT
+        )
+    ''')
+
+    # ---- Индексы ----
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_balance ON users(balance DESC)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_reputation ON users(reputation DESC)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_total_spent ON users(total_spent DESC)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users(LOWER(username))")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_purchases_user_id ON purchases(user_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_purchases_status ON purchases(status)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_giveaways_status ON giveaways(status)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_promo_activations_user ON promo_activations(user_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_tasks_expires ON user_tasks(expires_at)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_active ON tasks(active)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals(referrer_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_multiplayer_games_status ON multiplayer_games(status)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_level ON users(level)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_exp ON users(exp)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_bosses_chat_status ON bosses(chat_id, status)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_boss_attacks_boss ON boss_attacks(boss_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_boss_attacks_user ON boss_attacks(user_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_confirmed_chats_chat ON confirmed_chats(chat_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_requests_status ON chat_confirmation_requests(status)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_auctions_status ON auctions(status)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_auctions_end_time ON auctions(end_time)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_auction_bids_auction ON auction_bids(auction_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_authority_chat ON chat_authority(chat_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_fight_cooldowns_chat ON fight_cooldowns(chat_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_fight_logs_timestamp ON fight_logs(timestamp)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_ads_enabled ON ads(enabled)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_bitcoin_orders_user ON bitcoin_orders(user_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_bitcoin_orders_status ON bitcoin_orders(status)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_bitcoin_orders_type ON bitcoin_orders(type)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_smuggle_runs_user ON smuggle_runs(user_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_smuggle_runs_end ON smuggle_runs(end_time)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_smuggle_runs_pending ON smuggle_runs(end_time) WHERE status = 'in_progress' AND notified = FALSE")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_giveaways_active_end ON giveaways(end_date) WHERE status = 'active'")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_bosses_spawned_at ON bosses(spawned_at)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_purchases_date ON purchases(purchase_date)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_businesses_user ON user_businesses(user_id)")
+
+# Колонки, которые раньше хранились как TEXT "%Y-%m-%d %H:%M:%S".
+TIMESTAMP_COLUMNS = [
+    ('smuggle_runs', 'start_time'), ('smuggle_runs', 'end_time'),
+    ('users', 'last_bonus'), ('users', 'last_theft_time'),
+    ('giveaways', 'end_date'),
+    ('bosses', 'spawned_at'), ('bosses', 'expires_at'),
+    ('boss_attacks', 'attack_time'),
+    ('user_businesses', 'last_collection'),
+    ('purchases', 'purchase_date'),
+    ('user_tasks', 'completed_at'), ('user_tasks', 'expires_at'),
+]
+TIMESTAMP_BACKFILL_BATCH = 5000
+MIGRATION_LOCK_RETRIES = 5
 
-        # ---- Розыгрыши ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS giveaways (
-                id SERIAL PRIMARY KEY,
-                prize TEXT,
-                description TEXT,
-                end_date TEXT,
-                media_file_id TEXT,
-                media_type TEXT,
-                status TEXT DEFAULT 'active',
-                winner_id BIGINT,
-                winners_count INTEGER DEFAULT 1,
-                winners_list TEXT,
-                notified BOOLEAN DEFAULT FALSE
-            )
-        ''')
+async def _with_lock_retry(conn, statements: Callable[[], Awaitable[None]]):
+    """Короткая транзакция с DDL: не ждём блокировку дольше 5 секунд, чтобы не выстроить
+    за собой очередь запросов бота, а повторяем попытку позже."""
+    for attempt in range(1, MIGRATION_LOCK_RETRIES + 1):
+        try:
+            async with conn.transaction():
+                await conn.execute("SET LOCAL lock_timeout = '5s'")
+                await statements()
+            return
+        except asyncpg.LockNotAvailableError:
+            if attempt == MIGRATION_LOCK_RETRIES:
+                raise
+            logging.warning(f"Миграция ждёт блокировку (попытка {attempt}), повтор через {attempt * 2} с")
+            await asyncio.sleep(attempt * 2)
+
+async def _primary_key(conn, table: str) -> List[str]:
+    rows = await conn.fetch(
+        "SELECT a.attname FROM pg_index i "
+        "JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey) "
+        "WHERE i.indrelid = $1::regclass AND i.indisprimary "
+        "ORDER BY array_position(i.indkey::int2[], a.attnum)",
+        table
+    )
+    if not rows:
+        raise RuntimeError(f"У таблицы {table} нет первичного ключа — заполнить колонку пачками нельзя")
+    return [r['attname'] for r in rows]
+
+async def _convert_text_timestamp(conn, table: str, column: str):
+    new = f"{column}_tz"
+    sync = f"{table}_{column}_tz_sync"
+
+    # 1. Новая колонка (ADD COLUMN без DEFAULT не переписывает таблицу) и триггер, который
+    #    держит её в актуальном состоянии, пока работающие инстансы ещё пишут TEXT.
+    async def add_column():
+        await conn.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {new} TIMESTAMPTZ")
+        await conn.execute(f"""
+            CREATE OR REPLACE FUNCTION {sync}() RETURNS trigger AS $$
+            BEGIN
+                NEW.{new} := bot_parse_timestamp(NEW.{column});
+                RETURN NEW;
+            END $$ LANGUAGE plpgsql
+        """)
+        await conn.execute(f"DROP TRIGGER IF EXISTS {sync} ON {table}")
+        await conn.execute(
+            f"CREATE TRIGGER {sync} BEFORE INSERT OR UPDATE OF {column} ON {table} "
+            f"FOR EACH ROW EXECUTE PROCEDURE {sync}()"
+        )
+    await _with_lock_retry(conn, add_column)
+
+    # 2. Заполнение пачками по первичному ключу, каждая пачка — отдельная короткая транзакция.
+    keys = await _primary_key(conn, table)
+    key_list = ", ".join(keys)
+    lower = ", ".join(f"${i + 1}" for i in range(len(keys)))
+    upper = ", ".join(f"${i + 1 + len(keys)}" for i in range(len(keys)))
+    last = None
+    while True:
+        where = f"WHERE ({key_list}) > ({lower})" if last else ""
+        batch = await conn.fetch(
+            f"SELECT {key_list} FROM {table} {where} ORDER BY {key_list} LIMIT {TIMESTAMP_BACKFILL_BATCH}",
+            *(last or ())
+        )
+        if not batch:
+            break
+        first, last = tuple(batch[0]), tuple(batch[-1])
+        await conn.execute(
+            f"UPDATE {table} SET {new} = bot_parse_timestamp({column}) "
+            f"WHERE ({key_list}) >= ({lower}) AND ({key_list}) <= ({upper})",
+            *first, *last
+        )
 
-        # ---- Участники розыгрышей ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS participants (
-                user_id BIGINT,
-                giveaway_id INTEGER,
-                PRIMARY KEY (user_id, giveaway_id)
-            )
-        ''')
+    # 3. Индексы по старой колонке строим заранее на новой, без блокировки записи.
+    indexes = await conn.fetch(
+        "SELECT c.relname AS name, pg_get_indexdef(i.indexrelid) AS definition FROM pg_index i "
+        "JOIN pg_class c ON c.oid = i.indexrelid "
+        "JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey) "
+        "WHERE i.indrelid = $1::regclass AND a.attname = $2",
+        table, column
+    )
+    for index in indexes:
+        unique = "UNIQUE " if index['definition'].startswith("CREATE UNIQUE") else ""
+        using = re.sub(rf"\b{column}\b", new, index['definition'].split(" USING ", 1)[1])
+        await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index['name']}_tz")
+        await conn.execute(f"CREATE {unique}INDEX CONCURRENTLY {index['name']}_tz ON {table} USING {using}")
+
+    # 4. Подмена: только изменения каталога, без перезаписи данных.
+    async def swap():
+        await conn.execute(f"DROP TRIGGER IF EXISTS {sync} ON {table}")
+        await conn.execute(f"ALTER TABLE {table} DROP COLUMN {column}")
+        await conn.execute(f"ALTER TABLE {table} RENAME COLUMN {new} TO {column}")
+        for index in indexes:
+            await conn.execute(f"ALTER INDEX {index['name']}_tz RENAME TO {index['name']}")
+        await conn.execute(f"DROP FUNCTION IF EXISTS {sync}()")
+    await _with_lock_retry(conn, swap)
+
+async def migrate_text_timestamps(conn):
+    """Переводит старые TEXT-колонки времени в TIMESTAMPTZ без перезаписи таблицы под
+    эксклюзивной блокировкой: новая колонка, заполнение пачками, быстрая подмена.
+    Строки, которые не разбираются как время, становятся NULL. Уже переведённые колонки
+    пропускаются, прерванный перевод при следующем запуске начинается заново."""
+    text_columns = await conn.fetch(
+        "SELECT table_name, column_name FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND data_type = 'text' "
+        "AND (table_name, column_name) IN (SELECT * FROM unnest($1::text[], $2::text[]))",
+        [t for t, _ in TIMESTAMP_COLUMNS], [c for _, c in TIMESTAMP_COLUMNS]
+    )
+    if not text_columns:
+        return
+    await conn.execute("""
+        CREATE OR REPLACE FUNCTION bot_parse_timestamp(value TEXT) RETURNS TIMESTAMPTZ AS $$
+        BEGIN
+            RETURN NULLIF(value, '')::timestamp;
+        EXCEPTION WHEN others THEN
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql STABLE
+    """)
+    for row in text_columns:
+        await _convert_text_timestamp(conn, row['table_name'], row['column_name'])
+        logging.info(f"🕒 {row['table_name']}.{row['column_name']} переведена в TIMESTAMPTZ")
+    await conn.execute("DROP FUNCTION IF EXISTS bot_parse_timestamp(TEXT)")
+
+async def seed_settings(conn):
+    keys = list(DEFAULT_SETTINGS)
+    await conn.execute(
+        "INSERT INTO settings (key, value) SELECT * FROM unnest($1::text[], $2::text[]) ON CONFLICT (key) DO NOTHING",
+        keys, [DEFAULT_SETTINGS[k] for k in keys]
+    )
+
+async def seed_level_rewards(conn):
+    levels = list(range(1, 101))
+    coins = [
+        float(int(DEFAULT_SETTINGS["level_reward_coins"]) + (lvl-1) * int(DEFAULT_SETTINGS["level_reward_coins_increment"]))
+        for lvl in levels
+    ]
+    reps = [
+        int(DEFAULT_SETTINGS["level_reward_reputation"]) + (lvl-1) * int(DEFAULT_SETTINGS["level_reward_reputation_increment"])
+        for lvl in levels
+    ]
+    await conn.execute(
+        "INSERT INTO level_rewards (level, coins, reputation) "
+        "SELECT * FROM unnest($1::int[], $2::numeric[], $3::int[]) ON CONFLICT (level) DO NOTHING",
+        levels, coins, reps
+    )
+
+DEFAULT_BUSINESS_TYPES = [
+    ("🥙 Ларёк с шаурмой", "🥙", 5.0, 60, "Уличная точка быстрого питания. Приносит стабильный, но небольшой доход.", 10),
+    ("🏪 Магазин у дома", "🏪", 15.0, 120, "Небольшой продуктовый магазин. Доход выше, чем у ларька.", 10),
+    ("🚗 Автомойка", "🚗", 30.0, 180, "Мойка самообслуживания. Требует вложений, но окупается.", 10),
+    ("☕ Кафе", "☕", 50.0, 220, "Уютное кафе в центре. Хороший пассивный доход.", 10),
+    ("🏨 Мини-отель", "🏨", 80.0, 260, "Небольшая гостиница. Доход позволяет не работать.", 10),
+    ("🏬 Торговый центр", "🏬", 150.0, 298, "Крупный торговый комплекс. Максимальный доход (до 500 баксов/неделю).", 10),
+]
 
-        # ---- Админы ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS admins (
-                user_id BIGINT PRIMARY KEY,
-                added_by BIGINT,
-                added_date TEXT,
-                permissions TEXT DEFAULT '[]'
-            )
-        ''')
+async def seed_business_types(conn):
+    # Как и раньше, заполняем только пустую таблицу: удалённые админом типы не возвращаются.
+    columns = list(zip(*DEFAULT_BUSINESS_TYPES))
+    await conn.execute(
+        "INSERT INTO business_types (name, emoji, base_price_btc, base_income_cents, description, max_level) "
+        "SELECT * FROM unnest($1::text[], $2::text[], $3::numeric[], $4::int[], $5::text[], $6::int[]) "
+        "WHERE NOT EXISTS (SELECT 1 FROM business_types)",
+        *[list(c) for c in columns]
+    )
+
+# ==================== МИГРАЦИИ ====================
+# Шаги применяются по порядку и один раз; номер записывается в schema_version.
+# Новые изменения схемы — только новым шагом в конце списка.
+async def create_broadcast_jobs(conn):
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id SERIAL PRIMARY KEY,
+            created_by BIGINT,
+            content TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            runner TEXT,
+            last_user_id BIGINT NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            status_chat_id BIGINT,
+            status_message_id BIGINT,
+            created_at TIMESTAMPTZ DEFAULT NOW(),
+            updated_at TIMESTAMPTZ DEFAULT NOW()
+        )
+    ''')
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_running ON broadcast_jobs(id) WHERE status = 'running'"
+    )
+
+async def add_unreachable_marks(conn):
+    # Пользователь заблокировал бота / удалён, бота выгнали из чата. Массовые отправки
+    # таких получателей пропускают; отметка снимается, когда от них снова приходит апдейт.
+    await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS unreachable_since TIMESTAMPTZ")
+    await conn.execute("ALTER TABLE confirmed_chats ADD COLUMN IF NOT EXISTS unreachable_since TIMESTAMPTZ")
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_users_reachable ON users(user_id) WHERE unreachable_since IS NULL"
+    )
+
+MIGRATIONS = [
+    (1, "базовая схема", create_base_schema),
+    (2, "TEXT-время в TIMESTAMPTZ", migrate_text_timestamps),
+    (3, "награды за уровни", seed_level_rewards),
+    (4, "типы бизнесов", seed_business_types),
+    (5, "задания рассылок", create_broadcast_jobs),
+    (6, "недоступные получатели", add_unreachable_marks),
+    (7, "оставшиеся TEXT-времена в TIMESTAMPTZ", migrate_text_timestamps),
+]
+# Эти шаги сами режут работу на короткие транзакции и безопасны при повторном запуске,
+# поэтому выполняются без общей транзакции (иначе блокировки держались бы до конца шага).
+ONLINE_MIGRATIONS = {migrate_text_timestamps}
+MIGRATIONS_LOCK_ID = 724100817
 
-        # ---- Забаненные ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS banned_users (
-                user_id BIGINT PRIMARY KEY,
-                banned_by BIGINT,
-                banned_date TEXT,
-                reason TEXT
-            )
-        ''')
+async def _applied_versions(conn) -> set:
+    return {row['version'] for row in await conn.fetch("SELECT version FROM schema_version")}
 
-        # ---- Настройки ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS settings (
-                key TEXT PRIMARY KEY,
-                value TEXT
-            )
-        ''')
+async def _record_version(conn, version: int, description: str):
+    await conn.execute("INSERT INTO schema_version (version, description) VALUES ($1, $2)", version, description)
 
-        # ---- Задания ----
+async def init_db() -> None:
+    started = time.monotonic()
+    async with acquire() as conn:
         await conn.execute('''
-            CREATE TABLE IF NOT EXISTS tasks (
-                id SERIAL PRIMARY KEY,
-                name TEXT,
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
                 description TEXT,
-                task_type TEXT,
-                target_id TEXT,
-                reward_coins NUMERIC(12,2) DEFAULT 0,
-                reward_reputation INTEGER DEFAULT 0,
-                required_days INTEGER DEFAULT 0,
-                penalty_days INTEGER DEFAULT 0,
-                created_by BIGINT,
-                created_at TEXT,
-                active BOOLEAN DEFAULT TRUE,
-                max_completions INTEGER DEFAULT 1,
-                completed_count INTEGER DEFAULT 0
-            )
-        ''')
-
-        # ---- Выполненные задания ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS user_tasks (
-                user_id BIGINT,
-                task_id INTEGER,
-                completed_at TEXT,
-                expires_at TEXT,
-                status TEXT DEFAULT 'completed',
-                PRIMARY KEY (user_id, task_id)
+                applied_at TIMESTAMPTZ DEFAULT NOW()
             )
         ''')
+        applied = await _applied_versions(conn)
+        if any(version not in applied for version, _, _ in MIGRATIONS):
+            # Несколько инстансов при деплое не должны мигрировать одновременно.
+            await conn.execute("SELECT pg_advisory_lock($1)", MIGRATIONS_LOCK_ID)
+            try:
+                applied = await _applied_versions(conn)
+                for version, description, step in MIGRATIONS:
+                    if version in applied:
+                        continue
+                    if step in ONLINE_MIGRATIONS:
+                        await step(conn)
+                        await _record_version(conn, version, description)
+                    else:
+                        async with conn.transaction():
+                            await step(conn)
+                            await _record_version(conn, version, description)
+                    logging.info(f"📦 Миграция {version} ({description}) применена")
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATIONS_LOCK_ID)
+        await seed_settings(conn)
+    await reload_settings()
+    await load_access_cache()
+    await load_media_cache()
+    await load_theft_targets()
+    await load_cooldowns()
+    logging.info(f"✅ Схема БД актуальна (версия {MIGRATIONS[-1][0]}) за {time.monotonic() - started:.2f} с")
 
-        # ---- Мультиплеерные игры ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS multiplayer_games (
-                game_id TEXT PRIMARY KEY,
-                host_id BIGINT,
-                max_players INTEGER,
-                bet_amount NUMERIC(12,2),
-                status TEXT DEFAULT 'waiting',
-                deck TEXT,
-                created_at TEXT,
-                current_player_index INTEGER DEFAULT 0
-            )
-        ''')
+# ==================== РАБОТА С НАСТРОЙКАМИ ====================
+SETTINGS_REFRESH_INTERVAL = 3600
 
-        # ---- Игроки в мультиплеере ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS game_players (
-                game_id TEXT,
-                user_id BIGINT,
-                username TEXT,
-                cards TEXT,
-                value INTEGER DEFAULT 0,
-                stopped BOOLEAN DEFAULT FALSE,
-                joined_at TEXT,
-                doubled BOOLEAN DEFAULT FALSE,
-                surrendered BOOLEAN DEFAULT FALSE,
-                PRIMARY KEY (game_id, user_id)
-            )
-        ''')
+def _parse_int(value: str) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
 
-        # ---- Награды за уровень ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS level_rewards (
-                level INTEGER PRIMARY KEY,
-                coins NUMERIC(12,2),
-                reputation INTEGER
-            )
-        ''')
+def _parse_float(value: str) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
 
-        # ---- Аукционы ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS auctions (
-                id SERIAL PRIMARY KEY,
-                item_name TEXT NOT NULL,
-                description TEXT,
-                start_price NUMERIC(12,2) NOT NULL,
-                current_price NUMERIC(12,2) NOT NULL,
-                start_time TIMESTAMP NOT NULL DEFAULT NOW(),
-                end_time TIMESTAMP,
-                target_price NUMERIC(12,2),
-                status TEXT DEFAULT 'active',
-                winner_id BIGINT,
-                created_by BIGINT NOT NULL,
-                created_at TIMESTAMP DEFAULT NOW(),
-                photo_file_id TEXT
-            )
-        ''')
+class SettingsSnapshot:
+    """Неизменяемый снимок настроек: значения разобраны в int/float один раз при построении.
+    Обновление — это замена всего объекта, поэтому чтение не требует блокировок."""
+    __slots__ = ('raw', 'ints', 'floats')
 
-        # ---- Ставки на аукционе ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS auction_bids (
-                id SERIAL PRIMARY KEY,
-                auction_id INTEGER REFERENCES auctions(id) ON DELETE CASCADE,
-                user_id BIGINT NOT NULL,
-                bid_amount NUMERIC(12,2) NOT NULL,
-                bid_time TIMESTAMP DEFAULT NOW()
-            )
-        ''')
+    def __init__(self, values: Dict[str, str]):
+        merged = dict(DEFAULT_SETTINGS)
+        merged.update(values)
+        object.__setattr__(self, 'raw', MappingProxyType(merged))
+        object.__setattr__(self, 'ints', MappingProxyType({k: _parse_int(v) for k, v in merged.items()}))
+        object.__setattr__(self, 'floats', MappingProxyType({k: _parse_float(v) for k, v in merged.items()}))
 
-        # ---- Авторитет в чатах ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS chat_authority (
-                chat_id BIGINT,
-                user_id BIGINT,
-                authority INTEGER DEFAULT 0,
-                total_damage INTEGER DEFAULT 0,
-                fights INTEGER DEFAULT 0,
-                PRIMARY KEY (chat_id, user_id)
-            )
-        ''')
+    def __setattr__(self, name, value):
+        raise AttributeError("SettingsSnapshot неизменяем")
 
-        # ---- Кулдауны боёв ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS fight_cooldowns (
-                chat_id BIGINT,
-                user_id BIGINT,
-                last_fight TIMESTAMP,
-                PRIMARY KEY (chat_id, user_id)
-            )
-        ''')
+    def get(self, key: str) -> str:
+        return self.raw.get(key, "")
 
-        # ---- Глобальные кулдауны ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS global_cooldowns (
-                user_id BIGINT,
-                command TEXT,
-                last_used TIMESTAMP,
-                PRIMARY KEY (user_id, command)
-            )
-        ''')
+    def get_int(self, key: str) -> int:
+        return self.ints.get(key, 0)
 
-        # ---- Логи боёв ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS fight_logs (
-                id SERIAL PRIMARY KEY,
-                chat_id BIGINT,
-                user_id BIGINT,
-                timestamp TIMESTAMP DEFAULT NOW(),
-                damage INTEGER,
-                authority_gained INTEGER,
-                outcome TEXT
-            )
-        ''')
+    def get_float(self, key: str) -> float:
+        return self.floats.get(key, 0.0)
 
-        # ---- Реклама ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS ads (
-                id SERIAL PRIMARY KEY,
-                text TEXT NOT NULL,
-                interval_minutes INTEGER DEFAULT 60,
-                last_sent TIMESTAMP,
-                enabled BOOLEAN DEFAULT TRUE,
-                target TEXT DEFAULT 'chats'
-            )
-        ''')
+settings_snapshot = SettingsSnapshot({})
 
-        # ---- Заявки на биткоин-бирже ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS bitcoin_orders (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                type TEXT NOT NULL CHECK (type IN ('buy', 'sell')),
-                amount NUMERIC(12,4) NOT NULL CHECK (amount > 0),
-                price INTEGER NOT NULL CHECK (price >= 1),
-                total_locked NUMERIC(12,4) NOT NULL,
-                created_at TIMESTAMP DEFAULT NOW(),
-                status TEXT DEFAULT 'active' CHECK (status IN ('active', 'completed', 'cancelled'))
-            )
-        ''')
+def settings() -> SettingsSnapshot:
+    """Текущий снимок настроек; можно читать синхронно и сколько угодно раз."""
+    return settings_snapshot
 
-        # ---- Сделки ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS bitcoin_trades (
-                id SERIAL PRIMARY KEY,
-                buy_order_id INTEGER REFERENCES bitcoin_orders(id),
-                sell_order_id INTEGER REFERENCES bitcoin_orders(id),
-                amount NUMERIC(12,4) NOT NULL,
-                price INTEGER NOT NULL,
-                buyer_id BIGINT NOT NULL,
-                seller_id BIGINT NOT NULL,
-                traded_at TIMESTAMP DEFAULT NOW()
-            )
-        ''')
+async def reload_settings():
+    global settings_snapshot
+    async with acquire() as conn:
+        rows = await conn.fetch("SELECT key, value FROM settings")
+    settings_snapshot = SettingsSnapshot({row['key']: row['value'] for row in rows})
 
-        # ---- Контрабандные рейсы ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS smuggle_runs (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                chat_id BIGINT,
-                start_time TEXT NOT NULL,
-                end_time TEXT NOT NULL,
-                status TEXT DEFAULT 'in_progress',
-                result TEXT,
-                smuggle_amount NUMERIC(12,4) DEFAULT 0,
-                notified BOOLEAN DEFAULT FALSE
-            )
-        ''')
-
-        # ---- Кулдауны контрабанды ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS smuggle_cooldowns (
-                user_id BIGINT PRIMARY KEY,
-                cooldown_until TIMESTAMP
-            )
-        ''')
-
-        # ---- Медиафайлы ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS media (
-                id SERIAL PRIMARY KEY,
-                key TEXT UNIQUE NOT NULL,
-                file_id TEXT NOT NULL,
-                description TEXT
-            )
-        ''')
-
-        # ---- Индексы ----
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_balance ON users(balance DESC)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_reputation ON users(reputation DESC)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_total_spent ON users(total_spent DESC)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users(LOWER(username))")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_purchases_user_id ON purchases(user_id)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_purchases_status ON purchases(status)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_giveaways_status ON giveaways(status)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_promo_activations_user ON promo_activations(user_id)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_tasks_expires ON user_tasks(expires_at)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_active ON tasks(active)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals(referrer_id)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_multiplayer_games_status ON multiplayer_games(status)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_level ON users(level)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_exp ON users(exp)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_bosses_chat_status ON bosses(chat_id, status)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_boss_attacks_boss ON boss_attacks(boss_id)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_boss_attacks_user ON boss_attacks(user_id)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_confirmed_chats_chat ON confirmed_chats(chat_id)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_requests_status ON chat_confirmation_requests(status)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_auctions_status ON auctions(status)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_auctions_end_time ON auctions(end_time)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_auction_bids_auction ON auction_bids(auction_id)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_authority_chat ON chat_authority(chat_id)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_fight_cooldowns_chat ON fight_cooldowns(chat_id)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_fight_logs_timestamp ON fight_logs(timestamp)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_ads_enabled ON ads(enabled)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_bitcoin_orders_user ON bitcoin_orders(user_id)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_bitcoin_orders_status ON bitcoin_orders(status)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_bitcoin_orders_type ON bitcoin_orders(type)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_smuggle_runs_user ON smuggle_runs(user_id)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_smuggle_runs_end ON smuggle_runs(end_time)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_businesses_user ON user_businesses(user_id)")
-
-    # Заполняем настройки
-    await init_settings()
-    await init_level_rewards()
-    await init_business_types()
-    logging.info("✅ Таблицы в PostgreSQL проверены/обновлены")
-
-async def init_settings():
-    async with db_pool.acquire() as conn:
-        for key, value in DEFAULT_SETTINGS.items():
-            await conn.execute(
-                "INSERT INTO settings (key, value) VALUES ($1, $2) ON CONFLICT (key) DO NOTHING",
-                key, value
-            )
-
-async def init_level_rewards():
-    async with db_pool.acquire() as conn:
-        for lvl in range(1, 101):
-            exists = await conn.fetchval("SELECT level FROM level_rewards WHERE level=$1", lvl)
-            if not exists:
-                coins = int(DEFAULT_SETTINGS["level_reward_coins"]) + (lvl-1) * int(DEFAULT_SETTINGS["level_reward_coins_increment"])
-                rep = int(DEFAULT_SETTINGS["level_reward_reputation"]) + (lvl-1) * int(DEFAULT_SETTINGS["level_reward_reputation_increment"])
-                await conn.execute(
-                    "INSERT INTO level_rewards (level, coins, reputation) VALUES ($1, $2, $3)",
-                    lvl, float(coins), rep
-                )
-
-async def init_business_types():
-    async with db_pool.acquire() as conn:
-        count = await conn.fetchval("SELECT COUNT(*) FROM business_types")
-        if count == 0:
-            businesses = [
-                ("🥙 Ларёк с шаурмой", "🥙", 5.0, 60, "Уличная точка быстрого питания. Приносит стабильный, но небольшой доход.", 10),
-                ("🏪 Магазин у дома", "🏪", 15.0, 120, "Небольшой продуктовый магазин. Доход выше, чем у ларька.", 10),
-                ("🚗 Автомойка", "🚗", 30.0, 180, "Мойка самообслуживания. Требует вложений, но окупается.", 10),
-                ("☕ Кафе", "☕", 50.0, 220, "Уютное кафе в центре. Хороший пассивный доход.", 10),
-                ("🏨 Мини-отель", "🏨", 80.0, 260, "Небольшая гостиница. Доход позволяет не работать.", 10),
-                ("🏬 Торговый центр", "🏬", 150.0, 298, "Крупный торговый комплекс. Максимальный доход (до 500 баксов/неделю).", 10),
-            ]
-            for name, emoji, price, income, desc, max_lvl in businesses:
-                await conn.execute(
-                    "INSERT INTO business_types (name, emoji, base_price_btc, base_income_cents, description, max_level, available) VALUES ($1, $2, $3, $4, $5, $6, $7)",
-                    name, emoji, price, income, desc, max_lvl, True
-                )
+async def settings_refresher():
+    while True:
+        await asyncio.sleep(SETTINGS_REFRESH_INTERVAL)
+        try:
+            await reload_settings()
+        except Exception as e:
+            logging.error(f"Ошибка обновления настроек: {e}", exc_info=True)
 
-# ==================== РАБОТА С НАСТРОЙКАМИ ====================
 async def get_setting(key: str) -> str:
-    global settings_cache, last_settings_update
-    async with settings_cache_lock:
-        now = time.time()
-        if now - last_settings_update > 60 or not settings_cache:
-            async with db_pool.acquire() as conn:
-                rows = await conn.fetch("SELECT key, value FROM settings")
-                settings_cache = {row['key']: row['value'] for row in rows}
-            last_settings_update = now
-        value = settings_cache.get(key)
-        if value is None:
-            value = DEFAULT_SETTINGS.get(key, "")
-            if value:
-                async with db_pool.acquire() as conn:
-                    await conn.execute(
-                        "INSERT INTO settings (key, value) VALUES ($1, $2) ON CONFLICT (key) DO NOTHING",
-                        key, value
-                    )
-                settings_cache[key] = value
-        return value
+    return settings_snapshot.get(key)
 
 async def get_setting_float(key: str) -> float:
-    val = await get_setting(key)
-    try:
-        return float(val)
-    except:
-        return 0.0
+    return settings_snapshot.get_float(key)
 
 async def get_setting_int(key: str) -> int:
-    val = await get_setting(key)
-    try:
-        return int(val)
-    except:
-        return 0
+    return settings_snapshot.get_int(key)
 
 async def set_setting(key: str, value: str):
-    async with db_pool.acquire() as conn:
+    # Локальный снимок перечитает обработчик шины (_refresh_setting) внутри publish_invalidation.
+    async with acquire() as conn:
         await conn.execute("UPDATE settings SET value=$1 WHERE key=$2", value, key)
-    async with settings_cache_lock:
-        settings_cache[key] = value
-        global last_settings_update
-        last_settings_update = 0
+        await publish_invalidation("setting", key, conn=conn)
 
 # ==================== ФУНКЦИИ ДЛЯ ЧАТОВ И КАНАЛОВ ====================
-async def get_channels():
+async def get_channels(force_update=False):
     global channels_cache, last_channels_update
     async with channels_cache_lock:
         now = time.time()
-        if now - last_channels_update > 300 or not channels_cache:
-            async with db_pool.acquire() as conn:
+        if force_update or now - last_channels_update > CACHE_TTL or not channels_cache:
+            async with acquire() as conn:
                 rows = await conn.fetch("SELECT chat_id, title, invite_link FROM channels")
                 channels_cache = [(r['chat_id'], r['title'], r['invite_link']) for r in rows]
             last_channels_update = now
@@ -690,8 +1373,8 @@ async def get_confirmed_chats(force_update=False) -> Dict[int, dict]:
     global confirmed_chats_cache, last_confirmed_chats_update
     async with confirmed_chats_lock:
         now = time.time()
-        if force_update or now - last_confirmed_chats_update > 300 or not confirmed_chats_cache:
-            async with db_pool.acquire() as conn:
+        if force_update or now - last_confirmed_chats_update > CACHE_TTL or not confirmed_chats_cache:
+            async with acquire() as conn:
                 rows = await conn.fetch("SELECT * FROM confirmed_chats")
                 confirmed_chats_cache = {row['chat_id']: dict(row) for row in rows}
             last_confirmed_chats_update = now
@@ -702,114 +1385,764 @@ async def is_chat_confirmed(chat_id: int) -> bool:
     return chat_id in confirmed
 
 async def add_confirmed_chat(chat_id: int, title: str, chat_type: str, confirmed_by: int):
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         await conn.execute(
             "INSERT INTO confirmed_chats (chat_id, title, type, joined_date, confirmed_by, confirmed_date) VALUES ($1, $2, $3, $4, $5, $6) ON CONFLICT (chat_id) DO UPDATE SET confirmed_by=$5, confirmed_date=$6",
             chat_id, title, chat_type, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), confirmed_by, datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         )
-    await get_confirmed_chats(force_update=True)
+        await publish_invalidation("confirmed_chat", chat_id, conn=conn)
 
 async def remove_confirmed_chat(chat_id: int):
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         await conn.execute("DELETE FROM confirmed_chats WHERE chat_id=$1", chat_id)
-    await get_confirmed_chats(force_update=True)
+        await publish_invalidation("confirmed_chat", chat_id, conn=conn)
 
 async def create_chat_confirmation_request(chat_id: int, title: str, chat_type: str, requested_by: int):
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         await conn.execute(
             "INSERT INTO chat_confirmation_requests (chat_id, title, type, requested_by, request_date, status) VALUES ($1, $2, $3, $4, $5, $6) ON CONFLICT (chat_id) DO UPDATE SET status='pending', requested_by=$4, request_date=$5",
             chat_id, title, chat_type, requested_by, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'pending'
         )
 
 async def get_pending_chat_requests() -> List[dict]:
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         rows = await conn.fetch("SELECT * FROM chat_confirmation_requests WHERE status='pending' ORDER BY request_date")
         return [dict(r) for r in rows]
 
 async def update_chat_request_status(chat_id: int, status: str):
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         await conn.execute("UPDATE chat_confirmation_requests SET status=$1 WHERE chat_id=$2", status, chat_id)
 
+# ==================== ШИНА ИНВАЛИДАЦИИ КЭШЕЙ ====================
+# Каждый процесс бота слушает CACHE_CHANNEL на отдельном соединении и перечитывает только
+# затронутую запись. Автор изменения применяет его у себя сразу, свои уведомления пропускает.
+CACHE_CHANNEL = "bot_cache_invalidate"
+CACHE_LISTENER_RETRY = 5
+CACHE_LISTENER_PING = 60
+PROCESS_ID = f"{os.getpid()}-{''.join(random.choices(string.ascii_lowercase + string.digits, k=6))}"
+
+invalidation_handlers: Dict[str, Callable[[Optional[str]], Awaitable[None]]] = {}
+invalidations_received: Counter = Counter()
+# Ссылки на задачи применения уведомлений: цикл событий держит их слабо, без этого
+# задача может быть собрана сборщиком мусора посреди перечитывания кэша.
+invalidation_tasks: set = set()
+
+def on_invalidation(kind: str):
+    """Регистрирует обработчик события шины для данного вида кэша."""
+    def decorator(func):
+        invalidation_handlers[kind] = func
+        return func
+    return decorator
+
+async def apply_invalidation(kind: str, key: Optional[str] = None):
+    handler = invalidation_handlers.get(kind)
+    if handler is None:
+        return
+    try:
+        await handler(key)
+    except Exception as e:
+        logging.error(f"Ошибка обновления кэша {kind}:{key}: {e}", exc_info=True)
+
+async def publish_invalidation(kind: str, key: Any = None, conn=None):
+    """Сообщает всем процессам, что запись kind:key изменилась, и обновляет локальный кэш.
+    Внутри транзакции уведомление уйдёт только после COMMIT."""
+    payload = json.dumps({"kind": kind, "key": None if key is None else str(key), "origin": PROCESS_ID})
+    if conn is None:
+        async with acquire() as conn:
+            await conn.execute("SELECT pg_notify($1, $2)", CACHE_CHANNEL, payload)
+    else:
+        await conn.execute("SELECT pg_notify($1, $2)", CACHE_CHANNEL, payload)
+    await apply_invalidation(kind, None if key is None else str(key))
+
+def _on_notification(connection, pid, channel, payload):
+    try:
+        event = json.loads(payload)
+    except ValueError:
+        logging.warning(f"Некорректное уведомление шины кэшей: {payload!r}")
+        return
+    if event.get("origin") == PROCESS_ID:
+        return
+    invalidations_received[event.get("kind")] += 1
+    task = asyncio.create_task(apply_invalidation(event.get("kind"), event.get("key")))
+    invalidation_tasks.add(task)
+    task.add_done_callback(invalidation_tasks.discard)
+
+async def refresh_all_caches():
+    """После переподключения слушателя часть уведомлений могла потеряться — перечитываем всё."""
+    await reload_settings()
+    await get_channels(force_update=True)
+    await get_confirmed_chats(force_update=True)
+    for kind, handler in invalidation_handlers.items():
+        if kind not in ("setting", "channels", "confirmed_chat"):
+            await apply_invalidation(kind, None)
+
+async def cache_listener():
+    """Держит LISTEN на выделенном соединении (вне пула) и переподключается при обрыве."""
+    connected_before = False
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(DATABASE_URL)
+            lost = asyncio.Event()
+            conn.add_termination_listener(lambda c: lost.set())
+            await conn.add_listener(CACHE_CHANNEL, _on_notification)
+            if connected_before:
+                await refresh_all_caches()
+                logging.info("🔔 Слушатель шины кэшей переподключён, кэши перечитаны")
+            connected_before = True
+            while not lost.is_set():
+                try:
+                    await asyncio.wait_for(lost.wait(), timeout=CACHE_LISTENER_PING)
+                except asyncio.TimeoutError:
+                    await conn.fetchval("SELECT 1")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning(f"Слушатель шины кэшей отключился: {e}")
+        finally:
+            if conn is not None and not conn.is_closed():
+                await conn.close()
+        await asyncio.sleep(CACHE_LISTENER_RETRY)
+
+@on_invalidation("setting")
+async def _refresh_setting(key: Optional[str]):
+    global settings_snapshot
+    if key is None:
+        await reload_settings()
+        return
+    async with acquire() as conn:
+        value = await conn.fetchval("SELECT value FROM settings WHERE key=$1", key)
+    values = dict(settings_snapshot.raw)
+    if value is None:
+        values.pop(key, None)
+    else:
+        values[key] = value
+    settings_snapshot = SettingsSnapshot(values)
+
+@on_invalidation("channels")
+async def _refresh_channels(key: Optional[str]):
+    await get_channels(force_update=True)
+
+@on_invalidation("confirmed_chat")
+async def _refresh_confirmed_chat(key: Optional[str]):
+    global confirmed_chats_cache
+    if key is None:
+        await get_confirmed_chats(force_update=True)
+        return
+    chat_id = int(key)
+    async with acquire() as conn:
+        row = await conn.fetchrow("SELECT * FROM confirmed_chats WHERE chat_id=$1", chat_id)
+    async with confirmed_chats_lock:
+        # Копия, а не правка на месте: кто-то может итерироваться по старому словарю через await.
+        chats = dict(confirmed_chats_cache)
+        if row is None:
+            chats.pop(chat_id, None)
+        else:
+            chats[chat_id] = dict(row)
+        confirmed_chats_cache = chats
+
 # ==================== ФУНКЦИИ ДЛЯ МЕДИА ====================
-async def get_media_file_id(key: str) -> Optional[str]:
-    async with db_pool.acquire() as conn:
+# Таблица media меняется только из админки, поэтому карта key -> file_id держится в памяти
+# целиком и обновляется событием шины "media". Промахи запоминаются, чтобы предупреждение
+# об отсутствующем ключе писалось один раз, а не на каждый показ меню.
+media_cache: Dict[str, str] = {}
+missing_media_keys: set = set()
+
+async def load_media_cache():
+    global media_cache
+    async with acquire() as conn:
+        rows = await conn.fetch("SELECT key, file_id FROM media")
+    media_cache = {r['key']: r['file_id'] for r in rows}
+    missing_media_keys.clear()
+
+@on_invalidation("media")
+async def _refresh_media(key: Optional[str]):
+    if key is None:
+        await load_media_cache()
+        return
+    async with acquire() as conn:
         file_id = await conn.fetchval("SELECT file_id FROM media WHERE key=$1", key)
-        return file_id
+    if file_id is None:
+        media_cache.pop(key, None)
+    else:
+        media_cache[key] = file_id
+        missing_media_keys.discard(key)
+
+async def get_media_file_id(key: str) -> Optional[str]:
+    return media_cache.get(key)
+
+def is_media_missing(key: str) -> bool:
+    """True только при первом промахе по ключу — дальше промах уже известен и не логируется."""
+    if key in media_cache or key in missing_media_keys:
+        return False
+    missing_media_keys.add(key)
+    return True
+
+# ==================== СНИМОК ПОЛЬЗОВАТЕЛЯ (ОДНО ЧТЕНИЕ НА АПДЕЙТ) ====================
+class UserSnapshot:
+    """Горячие колонки users автора апдейта. Читаются одним SELECT при первом обращении хелпера,
+    дальше поддерживаются локальными записями. Апдейты, которым данные автора не нужны
+    (сообщения в группах, апдейты без подходящего хендлера), в БД за снимком не ходят."""
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.task = asyncio.current_task()
+        self.data: Optional[dict] = None
+        self.loaded = False
+
+    async def load(self):
+        async with acquire() as conn:
+            row = await conn.fetchrow(
+                "SELECT balance, negative_balance, bitcoin_balance, reputation, exp, level, "
+                "strength, agility, defense, authority_balance FROM users WHERE user_id=$1",
+                self.user_id
+            )
+        self.data = dict(row) if row else None
+        self.loaded = True
+
+    def reset(self):
+        self.data = None
+        self.loaded = False
+
+    def get(self, column: str):
+        return self.data.get(column)
+
+    def set(self, **values):
+        self.data.update(values)
+
+    def add(self, **deltas):
+        for column, delta in deltas.items():
+            self.data[column] = (self.data.get(column) or 0) + delta
+
+current_snapshot: ContextVar[Optional[UserSnapshot]] = ContextVar("current_snapshot", default=None)
+
+def begin_user_snapshot(user_id: int) -> Token:
+    return current_snapshot.set(UserSnapshot(user_id))
+
+def end_user_snapshot(token: Token):
+    current_snapshot.reset(token)
+
+def _current_snapshot(user_id: int) -> Optional[UserSnapshot]:
+    snapshot = current_snapshot.get()
+    if snapshot is not None and snapshot.user_id == user_id and snapshot.task is asyncio.current_task():
+        return snapshot
+    return None
+
+def _snapshot_for(user_id: int) -> Optional[UserSnapshot]:
+    """Уже прочитанный снимок — для записей: незагруженный снимок править не нужно,
+    он прочитает свежие значения при первом обращении."""
+    snapshot = _current_snapshot(user_id)
+    if snapshot is not None and snapshot.data is not None:
+        return snapshot
+    return None
+
+async def _load_snapshot(user_id: int) -> Optional[UserSnapshot]:
+    """Снимок для чтения: загружается при первом обращении в апдейте."""
+    snapshot = _current_snapshot(user_id)
+    if snapshot is None:
+        return None
+    if not snapshot.loaded:
+        await snapshot.load()
+    return snapshot if snapshot.data is not None else None
+
+# ==================== ОТЛОЖЕННАЯ ЗАПИСЬ (СТАТИСТИКА ИГР, ПОСЛЕДНИЕ СТАВКИ, ЛОГ БОЁВ, КУЛДАУНЫ) ====================
+# Немонетарные данные копятся в памяти и сбрасываются пачкой раз в WRITE_BEHIND_INTERVAL
+# или при WRITE_BEHIND_MAX_ITEMS записей. При падении процесса теряется не больше одного окна.
+WRITE_BEHIND_INTERVAL = int(os.getenv("WRITE_BEHIND_INTERVAL_MS", "500")) / 1000
+WRITE_BEHIND_MAX_ITEMS = int(os.getenv("WRITE_BEHIND_MAX_ITEMS", "500"))
+WRITE_BEHIND_MAX_BUFFER = int(os.getenv("WRITE_BEHIND_MAX_BUFFER", "100000"))
+WRITE_BEHIND_MAX_ATTEMPTS = 3
+
+GAME_STAT_GAMES = ['casino', 'dice', 'guess', 'slots', 'roulette', 'multiplayer']
+GAME_STAT_COLUMNS = [f"{game}_{result}" for game in GAME_STAT_GAMES for result in ("wins", "losses")]
+
+pending_game_stats: Dict[int, Counter] = {}
+pending_last_bets: Dict[Tuple[int, str], Tuple[float, Optional[str], datetime]] = {}
+pending_fight_logs: List[Tuple[int, int, datetime, int, int, str]] = []
+# chat_id -> True (недоступен) / False (снова доступен); положительные id — пользователи, отрицательные — чаты
+pending_reachability: Dict[int, bool] = {}
+# раздел -> неудачных попыток подряд / выброшено записей
+write_behind_failures: Counter = Counter()
+write_behind_dropped: Counter = Counter()
+write_behind_lock = asyncio.Lock()
+write_behind_wakeup = asyncio.Event()
+
+def _pending_write_count() -> int:
+    return (len(pending_game_stats) + len(pending_last_bets) + len(pending_fight_logs)
+            + len(pending_reachability))
+
+def _write_behind_added():
+    if _pending_write_count() >= WRITE_BEHIND_MAX_ITEMS:
+        write_behind_wakeup.set()
+
+def queue_game_stat(user_id: int, game: str, win: bool):
+    if game not in GAME_STAT_GAMES:
+        return
+    column = f"{game}_wins" if win else f"{game}_losses"
+    pending_game_stats.setdefault(user_id, Counter())[column] += 1
+    _write_behind_added()
+
+def queue_last_bet(user_id: int, game: str, amount: float, bet_data: dict = None):
+    pending_last_bets[(user_id, game)] = (
+        float(amount), json.dumps(bet_data) if bet_data else None, datetime.now()
+    )
+    _write_behind_added()
+
+def queue_fight_log(chat_id: int, user_id: int, damage: int, authority: int, outcome: str):
+    pending_fight_logs.append((chat_id, user_id, datetime.now(), damage, authority, outcome))
+    _write_behind_added()
+
+def mark_unreachable(chat_id: int):
+    """Отправка упала с BotBlocked/UserDeactivated/ChatNotFound — исключаем из массовых рассылок."""
+    pending_reachability[chat_id] = True
+    _write_behind_added()
+
+def mark_reachable(chat_id: int):
+    pending_reachability[chat_id] = False
+    _write_behind_added()
+
+async def _flush_game_stats(conn, stats: Dict[int, Counter]):
+    # Строки блокируются по возрастанию user_id — в том же порядке, что и apply_wallet_deltas.
+    user_ids = sorted(stats)
+    arrays = [[stats[uid][col] for uid in user_ids] for col in GAME_STAT_COLUMNS]
+    sets = ", ".join(f"{col} = u.{col} + d.{col}" for col in GAME_STAT_COLUMNS)
+    casts = ", ".join(f"${i + 2}::int[]" for i in range(len(GAME_STAT_COLUMNS)))
+    await conn.execute(
+        f"WITH d AS (SELECT * FROM unnest($1::bigint[], {casts}) AS d(user_id, {', '.join(GAME_STAT_COLUMNS)})), "
+        f"locked AS (SELECT u.user_id FROM users u WHERE u.user_id = ANY($1::bigint[]) ORDER BY u.user_id FOR UPDATE) "
+        f"UPDATE users u SET {sets} FROM d "
+        f"WHERE u.user_id = d.user_id AND u.user_id IN (SELECT user_id FROM locked)",
+        user_ids, *arrays
+    )
+
+async def _flush_last_bets(conn, bets: dict):
+    await conn.executemany("""
+        INSERT INTO user_last_bets (user_id, game, bet_amount, bet_data, updated_at)
+        VALUES ($1, $2, $3, $4, $5)
+        ON CONFLICT (user_id, game) DO UPDATE SET
+            bet_amount = EXCLUDED.bet_amount,
+            bet_data = EXCLUDED.bet_data,
+            updated_at = EXCLUDED.updated_at
+    """, [(uid, game, amount, data, ts) for (uid, game), (amount, data, ts) in sorted(bets.items())])
+
+async def _flush_fight_logs(conn, fights: list):
+    await conn.copy_records_to_table(
+        'fight_logs', records=fights,
+        columns=['chat_id', 'user_id', 'timestamp', 'damage', 'authority_gained', 'outcome']
+    )
+
+async def _flush_reachability(conn, reachability: Dict[int, bool]):
+    dead = sorted(cid for cid, unreachable in reachability.items() if unreachable)
+    alive = sorted(cid for cid, unreachable in reachability.items() if not unreachable)
+    for table, column in (("users", "user_id"), ("confirmed_chats", "chat_id")):
+        await conn.execute(
+            f"UPDATE {table} SET unreachable_since = NOW() "
+            f"WHERE {column} = ANY($1::bigint[]) AND unreachable_since IS NULL", dead
+        )
+        await conn.execute(
+            f"UPDATE {table} SET unreachable_since = NULL "
+            f"WHERE {column} = ANY($1::bigint[]) AND unreachable_since IS NOT NULL", alive
+        )
+
+def _restore_game_stats(stats):
+    for uid, counter in stats.items():
+        pending_game_stats.setdefault(uid, Counter()).update(counter)
+
+def _restore_last_bets(bets):
+    # Более свежие ставки, пришедшие во время сброса, не перетираем.
+    for key, value in bets.items():
+        pending_last_bets.setdefault(key, value)
+
+def _restore_fight_logs(fights):
+    pending_fight_logs[:0] = fights
+
+def _restore_reachability(reachability):
+    for key, value in reachability.items():
+        pending_reachability.setdefault(key, value)
+
+# раздел -> (запись пачки, возврат пачки в буфер)
+WRITE_BEHIND_SECTIONS = {
+    'game_stats': (_flush_game_stats, _restore_game_stats),
+    'last_bets': (_flush_last_bets, _restore_last_bets),
+    'fight_logs': (_flush_fight_logs, _restore_fight_logs),
+    'reachability': (_flush_reachability, _restore_reachability),
+}
+
+def _write_behind_failed(section: str, batch, error: Exception):
+    """Ошибка самого запроса (данные, ограничения) засчитывается попыткой: после
+    WRITE_BEHIND_MAX_ATTEMPTS раздел выбрасывается в лог, чтобы одна плохая запись не
+    блокировала сброс навсегда. Обрыв соединения попыткой не считается — пачка ждёт БД,
+    пока буфер не упрётся в WRITE_BEHIND_MAX_BUFFER."""
+    if isinstance(error, asyncpg.PostgresError):
+        write_behind_failures[section] += 1
+    attempts = write_behind_failures[section]
+    overflow = _pending_write_count() + len(batch) > WRITE_BEHIND_MAX_BUFFER
+    if attempts >= WRITE_BEHIND_MAX_ATTEMPTS or overflow:
+        write_behind_failures.pop(section, None)
+        write_behind_dropped[section] += len(batch)
+        reason = "буфер переполнен" if overflow else f"{attempts} неудачных попыток"
+        logging.error(
+            f"🗑 Отложенная запись {section}: выброшено {len(batch)} записей ({reason}): {error}. "
+            f"Пачка: {str(batch)[:1000]}"
+        )
+        return
+    logging.error(f"Ошибка сброса отложенной записи {section} (попытка {attempts}): {error}", exc_info=attempts <= 1)
+    WRITE_BEHIND_SECTIONS[section][1](batch)
+
+async def flush_write_behind():
+    global pending_game_stats, pending_last_bets, pending_fight_logs, pending_reachability
+    async with write_behind_lock:
+        batches = {
+            'game_stats': pending_game_stats, 'last_bets': pending_last_bets, 'fight_logs': pending_fight_logs,
+            'reachability': pending_reachability,
+        }
+        if not any(batches.values()):
+            return
+        pending_game_stats, pending_last_bets, pending_fight_logs = {}, {}, []
+        pending_reachability = {}
+        # Каждый раздел в своей транзакции: ошибка в одном не откатывает и не держит остальные.
+        done, flushed = set(), set()
+        try:
+            async with acquire() as conn:
+                for section, batch in batches.items():
+                    if not batch:
+                        continue
+                    done.add(section)
+                    try:
+                        async with conn.transaction():
+                            await WRITE_BEHIND_SECTIONS[section][0](conn, batch)
+                    except Exception as e:
+                        _write_behind_failed(section, batch, e)
+                    else:
+                        write_behind_failures.pop(section, None)
+                        flushed.add(section)
+        except Exception as e:
+            for section, batch in batches.items():
+                if batch and section not in done:
+                    _write_behind_failed(section, batch, e)
+    if 'reachability' in flushed:
+        # Отметки чатов лежат и в кэше подтверждённых чатов — обновляем его во всех процессах.
+        for chat_id in batches['reachability']:
+            if chat_id < 0:
+                try:
+                    await publish_invalidation("confirmed_chat", chat_id)
+                except Exception as e:
+                    logging.warning(f"Не удалось разослать обновление чата {chat_id}: {e}")
+
+async def write_behind_flusher():
+    while True:
+        try:
+            await asyncio.wait_for(write_behind_wakeup.wait(), timeout=WRITE_BEHIND_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        write_behind_wakeup.clear()
+        await flush_write_behind()
+
+# ==================== КУЛДАУНЫ ====================
+# Источник истины — таблицы: кулдаун занимается одним upsert'ом с условием «старая отметка
+# истекла», поэтому два быстрых сообщения или две реплики бота не запустят действие дважды.
+# Память — только негативный кэш: известный активный кулдаун отклоняем без запроса, а
+# отсутствие записи ничего не значит и решается в БД. Ключ — (scope, user_id, уточнение —
+# команда или чат), значение — то же, что в таблице (время последнего действия для
+# global/fight, время окончания для smuggle). Длительность берётся из текущих настроек.
+COOLDOWN_GLOBAL = "global"
+COOLDOWN_FIGHT = "fight"
+COOLDOWN_SMUGGLE = "smuggle"
+COOLDOWN_SWEEP_INTERVAL = 300
+
+# Параметры: $1 user_id, $2 уточнение, $3 новая отметка, $4 отметка старше этой уже истекла.
+# Строка возвращается, только если кулдаун удалось занять.
+COOLDOWN_CLAIM_SQL = {
+    COOLDOWN_GLOBAL: (
+        "INSERT INTO global_cooldowns (user_id, command, last_used) VALUES ($1, $2, $3) "
+        "ON CONFLICT (user_id, command) DO UPDATE SET last_used = EXCLUDED.last_used "
+        "WHERE global_cooldowns.last_used IS NULL OR global_cooldowns.last_used <= $4 "
+        "RETURNING last_used"
+    ),
+    COOLDOWN_FIGHT: (
+        "INSERT INTO fight_cooldowns (chat_id, user_id, last_fight) VALUES ($2, $1, $3) "
+        "ON CONFLICT (chat_id, user_id) DO UPDATE SET last_fight = EXCLUDED.last_fight "
+        "WHERE fight_cooldowns.last_fight IS NULL OR fight_cooldowns.last_fight <= $4 "
+        "RETURNING last_fight"
+    ),
+}
+
+COOLDOWN_MARK_SQL = {
+    COOLDOWN_GLOBAL: "SELECT last_used FROM global_cooldowns WHERE user_id=$1 AND command=$2",
+    COOLDOWN_FIGHT: "SELECT last_fight FROM fight_cooldowns WHERE user_id=$1 AND chat_id=$2",
+    COOLDOWN_SMUGGLE: "SELECT cooldown_until FROM smuggle_cooldowns WHERE user_id=$1",
+}
+
+cooldown_marks: Dict[Tuple[str, int, Any], datetime] = {}
+
+def _cooldown_duration(scope: str) -> timedelta:
+    if scope == COOLDOWN_GLOBAL:
+        return timedelta(seconds=settings_snapshot.get_int("global_cooldown_seconds"))
+    if scope == COOLDOWN_FIGHT:
+        return timedelta(minutes=settings_snapshot.get_int("fight_cooldown_minutes"))
+    return timedelta(0)
+
+def _cooldown_expiry(scope: str, mark: datetime) -> datetime:
+    return mark + _cooldown_duration(scope)
+
+def cooldown_remaining(scope: str, user_id: int, qualifier: Any = None) -> float:
+    """Сколько секунд ещё действует кулдаун по памяти; 0 не значит, что кулдауна нет в БД."""
+    mark = cooldown_marks.get((scope, user_id, qualifier))
+    if mark is None:
+        return 0
+    return max((_cooldown_expiry(scope, mark) - datetime.now()).total_seconds(), 0)
+
+async def claim_cooldown(scope: str, user_id: int, qualifier: Any) -> float:
+    """Атомарно занимает кулдаун global/fight. 0 — действие можно выполнять (отметка уже
+    записана), иначе сколько секунд ещё ждать."""
+    remaining = cooldown_remaining(scope, user_id, qualifier)
+    if remaining > 0:
+        return remaining
+    key = (scope, user_id, qualifier)
+    now = datetime.now()
+    async with acquire() as conn:
+        mark = await conn.fetchval(COOLDOWN_CLAIM_SQL[scope], user_id, qualifier, now, now - _cooldown_duration(scope))
+        if mark is not None:
+            cooldown_marks[key] = mark
+            return 0
+        mark = await conn.fetchval(COOLDOWN_MARK_SQL[scope], user_id, qualifier)
+    if mark is None:
+        return 0
+    cooldown_marks[key] = mark
+    return cooldown_remaining(scope, user_id, qualifier)
+
+async def fetch_cooldown_remaining(scope: str, user_id: int, qualifier: Any = None) -> float:
+    """Проверка без занятия: память, а при промахе — БД (кулдаун могла выставить другая реплика)."""
+    remaining = cooldown_remaining(scope, user_id, qualifier)
+    if remaining > 0:
+        return remaining
+    params = (user_id,) if qualifier is None else (user_id, qualifier)
+    async with acquire() as conn:
+        mark = await conn.fetchval(COOLDOWN_MARK_SQL[scope], *params)
+    if mark is None:
+        return 0
+    cooldown_marks[(scope, user_id, qualifier)] = mark
+    return cooldown_remaining(scope, user_id, qualifier)
+
+async def load_cooldowns():
+    global cooldown_marks
+    cfg = settings_snapshot
+    async with acquire() as conn:
+        global_rows = await conn.fetch(
+            "SELECT user_id, command, last_used FROM global_cooldowns WHERE last_used > $1",
+            datetime.now() - timedelta(seconds=cfg.get_int("global_cooldown_seconds"))
+        )
+        fight_rows = await conn.fetch(
+            "SELECT chat_id, user_id, last_fight FROM fight_cooldowns WHERE last_fight > $1",
+            datetime.now() - timedelta(minutes=cfg.get_int("fight_cooldown_minutes"))
+        )
+        smuggle_rows = await conn.fetch(
+            "SELECT user_id, cooldown_until FROM smuggle_cooldowns WHERE cooldown_until > $1",
+            datetime.now()
+        )
+    marks = {}
+    for r in global_rows:
+        marks[(COOLDOWN_GLOBAL, r['user_id'], r['command'])] = r['last_used']
+    for r in fight_rows:
+        marks[(COOLDOWN_FIGHT, r['user_id'], r['chat_id'])] = r['last_fight']
+    for r in smuggle_rows:
+        marks[(COOLDOWN_SMUGGLE, r['user_id'], None)] = r['cooldown_until']
+    cooldown_marks = marks
+    logging.info(f"⏱ Загружено активных кулдаунов: {len(marks)}")
+
+async def cooldown_sweeper():
+    """Выкидывает истёкшие кулдауны, чтобы словарь не рос бесконечно."""
+    while True:
+        await asyncio.sleep(COOLDOWN_SWEEP_INTERVAL)
+        now = datetime.now()
+        expired = [key for key, mark in cooldown_marks.items() if _cooldown_expiry(key[0], mark) <= now]
+        for key in expired:
+            cooldown_marks.pop(key, None)
 
 # ==================== ФУНКЦИИ ДЛЯ ПОЛЬЗОВАТЕЛЕЙ ====================
+# Пользователи, про которых известно, что строка в users уже есть. Строки не удаляются,
+# поэтому запись здесь никогда не устаревает — ограничиваем только размер (LRU).
+KNOWN_USERS_MAX = 100000
+known_users: "OrderedDict[int, None]" = OrderedDict()
+
+def _remember_user(user_id: int):
+    known_users[user_id] = None
+    known_users.move_to_end(user_id)
+    if len(known_users) > KNOWN_USERS_MAX:
+        known_users.popitem(last=False)
+
 async def ensure_user_exists(user_id: int, username: str = None, first_name: str = None):
-    async with db_pool.acquire() as conn:
-        exists = await conn.fetchval("SELECT 1 FROM users WHERE user_id=$1", user_id)
-        if not exists:
-            bonus = await get_setting_float("new_user_bonus")
-            await conn.execute(
-                "INSERT INTO users (user_id, username, first_name, joined_date, balance, reputation, total_spent, negative_balance, exp, level, strength, agility, defense, bitcoin_balance, authority_balance) "
-                "VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15)",
-                user_id, username, first_name, datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                bonus, 0, 0, 0, 0, 1, 1, 1, 1, 0.0, 0
-            )
-            return True, bonus
+    if user_id in known_users:
+        known_users.move_to_end(user_id)
+        return False, 0
+    if _snapshot_for(user_id) is not None:
+        _remember_user(user_id)
+        return False, 0
+    snapshot = _current_snapshot(user_id)
+    bonus = settings_snapshot.get_float("new_user_bonus")
+    async with acquire() as conn:
+        created = await conn.fetchval(
+            "INSERT INTO users (user_id, username, first_name, joined_date, balance, reputation, total_spent, negative_balance, exp, level, strength, agility, defense, bitcoin_balance, authority_balance) "
+            "VALUES ($1, $2, $3, $4, $5, 0, 0, 0, 0, 1, 1, 1, 1, 0.0, 0) "
+            "ON CONFLICT (user_id) DO NOTHING RETURNING user_id",
+            user_id, username, first_name, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), bonus
+        )
+        if created is not None:
+            await publish_invalidation("new_user", user_id, conn=conn)
+    if created is not None and snapshot is not None:
+        # Снимок мог успеть запомнить, что строки нет.
+        snapshot.reset()
+    _remember_user(user_id)
+    if created is not None:
+        return True, bonus
     return False, 0
 
 async def get_user_balance(user_id: int) -> float:
-    async with db_pool.acquire() as conn:
+    snapshot = await _load_snapshot(user_id)
+    if snapshot is not None:
+        return float(snapshot.get('balance') or 0)
+    async with acquire() as conn:
         balance = await conn.fetchval("SELECT balance FROM users WHERE user_id=$1", user_id)
         return float(balance) if balance is not None else 0.0
 
-async def update_user_balance(user_id: int, delta: float, conn=None):
+async def update_user_balance(user_id: int, delta: float, conn=None) -> Tuple[float, float]:
+    """Атомарно применяет дельту; уход в минус переносится в negative_balance. Возвращает (balance, negative_balance)."""
     delta = float(delta)
     async def _update(conn):
-        row = await conn.fetchrow("SELECT balance, negative_balance FROM users WHERE user_id=$1", user_id)
-        if not row:
-            await ensure_user_exists(user_id)
-            row = {'balance': 0.0, 'negative_balance': 0.0}
-        balance = float(row['balance'])
-        negative = float(row['negative_balance']) if row['negative_balance'] else 0.0
-        new_balance = balance + delta
-        if new_balance < 0:
-            negative += abs(new_balance)
-            new_balance = 0.0
-        new_balance = round(new_balance, 2)
-        negative = round(negative, 2)
-        await conn.execute(
-            "UPDATE users SET balance=$1, negative_balance=$2 WHERE user_id=$3",
-            new_balance, negative, user_id
+        # Дельта, перенос овердрафта в negative_balance и проверка на минус считаются
+        # в самой БД одним выражением, без SELECT перед UPDATE.
+        row = await conn.fetchrow(
+            "INSERT INTO users (user_id, joined_date, balance, negative_balance) "
+            "VALUES ($1, $3, GREATEST($2::numeric, 0), GREATEST(-$2::numeric, 0)) "
+            "ON CONFLICT (user_id) DO UPDATE SET "
+            "balance = GREATEST(users.balance + $2::numeric, 0), "
+            "negative_balance = COALESCE(users.negative_balance, 0) + GREATEST(-(users.balance + $2::numeric), 0) "
+            "RETURNING balance, negative_balance",
+            user_id, delta, datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         )
+        snapshot = _snapshot_for(user_id)
+        if snapshot is not None:
+            snapshot.set(balance=row['balance'], negative_balance=row['negative_balance'])
+        return float(row['balance']), float(row['negative_balance'])
     if conn:
-        await _update(conn)
+        return await _update(conn)
     else:
-        async with db_pool.acquire() as new_conn:
-            await _update(new_conn)
+        async with acquire() as new_conn:
+            return await _update(new_conn)
 
 async def get_user_bitcoin(user_id: int) -> float:
-    async with db_pool.acquire() as conn:
+    snapshot = await _load_snapshot(user_id)
+    if snapshot is not None:
+        return float(snapshot.get('bitcoin_balance') or 0)
+    async with acquire() as conn:
         btc = await conn.fetchval("SELECT bitcoin_balance FROM users WHERE user_id=$1", user_id)
         return float(btc) if btc is not None else 0.0
 
-async def update_user_bitcoin(user_id: int, delta: float, conn=None):
+async def update_user_bitcoin(user_id: int, delta: float, conn=None) -> float:
+    """Атомарно применяет дельту к биткоинам. Возвращает новый баланс."""
     delta = float(delta)
     async def _update(conn):
-        row = await conn.fetchrow("SELECT bitcoin_balance FROM users WHERE user_id=$1", user_id)
-        if not row:
-            await ensure_user_exists(user_id)
-            row = {'bitcoin_balance': 0.0}
-        current = float(row['bitcoin_balance'])
-        new_balance = current + delta
-        if new_balance < 0:
-            raise ValueError("Недостаточно биткоинов")
-        new_balance = round(new_balance, 4)
-        await conn.execute(
-            "UPDATE users SET bitcoin_balance=$1 WHERE user_id=$2",
-            new_balance, user_id
-        )
+        if delta < 0:
+            new_balance = await conn.fetchval(
+                "UPDATE users SET bitcoin_balance = bitcoin_balance + $2::numeric "
+                "WHERE user_id=$1 AND bitcoin_balance + $2::numeric >= 0 "
+                "RETURNING bitcoin_balance",
+                user_id, delta
+            )
+            if new_balance is None:
+                raise ValueError("Недостаточно биткоинов")
+        else:
+            new_balance = await conn.fetchval(
+                "INSERT INTO users (user_id, joined_date, bitcoin_balance) VALUES ($1, $3, $2::numeric) "
+                "ON CONFLICT (user_id) DO UPDATE SET bitcoin_balance = users.bitcoin_balance + $2::numeric "
+                "RETURNING bitcoin_balance",
+                user_id, delta, datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            )
+        snapshot = _snapshot_for(user_id)
+        if snapshot is not None:
+            snapshot.set(bitcoin_balance=new_balance)
+        return float(new_balance)
     if conn:
-        await _update(conn)
+        return await _update(conn)
     else:
-        async with db_pool.acquire() as new_conn:
-            await _update(new_conn)
+        async with acquire() as new_conn:
+            return await _update(new_conn)
+
+WALLET_APPLY_BATCH_SQL = (
+    "WITH d AS ("
+    "  SELECT * FROM unnest($1::bigint[], $2::numeric[], $3::numeric[], $4::int[]) AS d(user_id, coins, btc, exp)"
+    "), locked AS ("
+    "  SELECT u.user_id FROM users u WHERE u.user_id = ANY($1::bigint[]) ORDER BY u.user_id FOR UPDATE"
+    ") "
+    "UPDATE users u SET "
+    "balance = GREATEST(u.balance + d.coins, 0), "
+    "negative_balance = COALESCE(u.negative_balance, 0) + GREATEST(-(u.balance + d.coins), 0), "
+    "bitcoin_balance = u.bitcoin_balance + d.btc, "
+    "exp = u.exp + d.exp "
+    "FROM d WHERE u.user_id = d.user_id AND u.user_id IN (SELECT user_id FROM locked) "
+    "RETURNING u.user_id, u.balance, u.negative_balance, u.bitcoin_balance, u.exp, u.level"
+)
+
+async def apply_wallet_deltas(deltas: List[dict], conn=None) -> Dict[int, asyncpg.Record]:
+    """Применяет дельты баланса/биткоинов/опыта сразу нескольким игрокам одним UPDATE.
+    Каждая дельта — dict с ключами user_id и необязательными balance, bitcoin, exp.
+    Строки блокируются в порядке user_id, чтобы параллельные переводы не ловили дедлок."""
+    merged: Dict[int, List[float]] = {}
+    for d in deltas:
+        acc = merged.setdefault(d['user_id'], [0.0, 0.0, 0])
+        acc[0] += float(d.get('balance', 0))
+        acc[1] += float(d.get('bitcoin', 0))
+        acc[2] += int(d.get('exp', 0))
+    if not merged:
+        return {}
+    user_ids = sorted(merged)
+    balances = [merged[uid][0] for uid in user_ids]
+    bitcoins = [merged[uid][1] for uid in user_ids]
+    exps = [merged[uid][2] for uid in user_ids]
+
+    async def _apply(conn):
+        async with conn.transaction():
+            # Строки сначала блокируются по возрастанию user_id, потом обновляются одним проходом.
+            rows = await conn.fetch(WALLET_APPLY_BATCH_SQL, user_ids, balances, bitcoins, exps)
+            if len(rows) < len(user_ids):
+                # Как и update_user_balance, создаём недостающие строки, а не теряем дельту.
+                found = {r['user_id'] for r in rows}
+                missing = [i for i, uid in enumerate(user_ids) if uid not in found]
+                await conn.execute(
+                    "INSERT INTO users (user_id, joined_date) SELECT unnest($1::bigint[]), $2 ON CONFLICT (user_id) DO NOTHING",
+                    [user_ids[i] for i in missing], datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                )
+                rows = list(rows) + await conn.fetch(
+                    WALLET_APPLY_BATCH_SQL, [user_ids[i] for i in missing], [balances[i] for i in missing],
+                    [bitcoins[i] for i in missing], [exps[i] for i in missing]
+                )
+            if any(float(r['bitcoin_balance']) < 0 for r in rows):
+                raise ValueError("Недостаточно биткоинов")
+            result = {r['user_id']: r for r in rows}
+            for r in rows:
+                snapshot = _snapshot_for(r['user_id'])
+                if snapshot is None:
+                    continue
+                snapshot.set(
+                    balance=r['balance'], negative_balance=r['negative_balance'],
+                    bitcoin_balance=r['bitcoin_balance'], exp=r['exp'], level=r['level']
+                )
+            if any(exps):
+                level_mult = max(await get_setting_int("level_multiplier"), 1)
+                for r in rows:
+                    if r['exp'] >= r['level'] * level_mult:
+                        await add_exp(r['user_id'], 0, conn=conn)
+            return result
+    if conn:
+        return await _apply(conn)
+    else:
+        async with acquire() as new_conn:
+            return await _apply(new_conn)
 
 async def get_user_authority(user_id: int) -> int:
-    async with db_pool.acquire() as conn:
+    snapshot = await _load_snapshot(user_id)
+    if snapshot is not None:
+        return snapshot.get('authority_balance') or 0
+    async with acquire() as conn:
         auth = await conn.fetchval("SELECT authority_balance FROM users WHERE user_id=$1", user_id)
         return auth if auth is not None else 0
 
@@ -819,69 +2152,64 @@ async def update_user_authority(user_id: int, delta: int, conn=None):
             "UPDATE users SET authority_balance = authority_balance + $1 WHERE user_id=$2",
             delta, user_id
         )
+        snapshot = _snapshot_for(user_id)
+        if snapshot is not None:
+            snapshot.add(authority_balance=delta)
     if conn:
         await _update(conn)
     else:
-        async with db_pool.acquire() as new_conn:
+        async with acquire() as new_conn:
             await _update(new_conn)
 
 async def get_user_reputation(user_id: int) -> int:
-    async with db_pool.acquire() as conn:
+    snapshot = await _load_snapshot(user_id)
+    if snapshot is not None:
+        return snapshot.get('reputation') or 0
+    async with acquire() as conn:
         rep = await conn.fetchval("SELECT reputation FROM users WHERE user_id=$1", user_id)
         return rep if rep is not None else 0
 
-async def update_user_reputation(user_id: int, delta: int):
-    async with db_pool.acquire() as conn:
+async def update_user_reputation(user_id: int, delta: int, conn=None):
+    async def _update(conn):
         await conn.execute("UPDATE users SET reputation = reputation + $1 WHERE user_id=$2", delta, user_id)
+        snapshot = _snapshot_for(user_id)
+        if snapshot is not None:
+            snapshot.add(reputation=delta)
+    if conn:
+        await _update(conn)
+    else:
+        async with acquire() as new_conn:
+            await _update(new_conn)
 
 async def get_user_stats(user_id: int) -> dict:
-    async with db_pool.acquire() as conn:
+    snapshot = await _load_snapshot(user_id)
+    if snapshot is not None:
+        return {k: snapshot.get(k) for k in ('level', 'strength', 'agility', 'defense')}
+    async with acquire() as conn:
         row = await conn.fetchrow("SELECT level, strength, agility, defense FROM users WHERE user_id=$1", user_id)
         if row:
             return dict(row)
         return {'level': 1, 'strength': 1, 'agility': 1, 'defense': 1}
 
-async def update_user_stats(user_id: int, strength_delta=0, agility_delta=0, defense_delta=0):
-    async with db_pool.acquire() as conn:
+async def update_user_stats(user_id: int, strength_delta=0, agility_delta=0, defense_delta=0, conn=None):
+    async def _update(conn):
         await conn.execute(
             "UPDATE users SET strength = strength + $1, agility = agility + $2, defense = defense + $3 WHERE user_id=$4",
             strength_delta, agility_delta, defense_delta, user_id
         )
-
-async def update_user_game_stats(user_id: int, game: str, win: bool, conn=None):
-    async def _update(conn):
-        if win:
-            if game == 'casino':
-                await conn.execute("UPDATE users SET casino_wins = casino_wins + 1 WHERE user_id=$1", user_id)
-            elif game == 'dice':
-                await conn.execute("UPDATE users SET dice_wins = dice_wins + 1 WHERE user_id=$1", user_id)
-            elif game == 'guess':
-                await conn.execute("UPDATE users SET guess_wins = guess_wins + 1 WHERE user_id=$1", user_id)
-            elif game == 'slots':
-                await conn.execute("UPDATE users SET slots_wins = slots_wins + 1 WHERE user_id=$1", user_id)
-            elif game == 'roulette':
-                await conn.execute("UPDATE users SET roulette_wins = roulette_wins + 1 WHERE user_id=$1", user_id)
-            elif game == 'multiplayer':
-                await conn.execute("UPDATE users SET multiplayer_wins = multiplayer_wins + 1 WHERE user_id=$1", user_id)
-        else:
-            if game == 'casino':
-                await conn.execute("UPDATE users SET casino_losses = casino_losses + 1 WHERE user_id=$1", user_id)
-            elif game == 'dice':
-                await conn.execute("UPDATE users SET dice_losses = dice_losses + 1 WHERE user_id=$1", user_id)
-            elif game == 'guess':
-                await conn.execute("UPDATE users SET guess_losses = guess_losses + 1 WHERE user_id=$1", user_id)
-            elif game == 'slots':
-                await conn.execute("UPDATE users SET slots_losses = slots_losses + 1 WHERE user_id=$1", user_id)
-            elif game == 'roulette':
-                await conn.execute("UPDATE users SET roulette_losses = roulette_losses + 1 WHERE user_id=$1", user_id)
-            elif game == 'multiplayer':
-                await conn.execute("UPDATE users SET multiplayer_losses = multiplayer_losses + 1 WHERE user_id=$1", user_id)
+        snapshot = _snapshot_for(user_id)
+        if snapshot is not None:
+            snapshot.add(strength=strength_delta, agility=agility_delta, defense=defense_delta)
     if conn:
         await _update(conn)
     else:
-        async with db_pool.acquire() as new_conn:
+        async with acquire() as new_conn:
             await _update(new_conn)
 
+async def update_user_game_stats(user_id: int, game: str, win: bool, conn=None):
+    """Счётчики побед/поражений пишутся отложенно, conn оставлен для совместимости вызовов."""
+    queue_game_stat(user_id, game, win)
+
 async def add_exp(user_id: int, exp: int, conn=None):
     async def _add(conn):
         user = await conn.fetchrow("SELECT exp, level FROM users WHERE user_id=$1", user_id)
@@ -889,7 +2217,8 @@ async def add_exp(user_id: int, exp: int, conn=None):
             return
         new_exp = user['exp'] + exp
         level = user['level']
-        level_mult = await get_setting_int("level_multiplier")
+        cfg = settings()
+        level_mult = cfg.get_int("level_multiplier")
         if level_mult <= 0:
             level_mult = 1
         levels_gained = 0
@@ -901,17 +2230,20 @@ async def add_exp(user_id: int, exp: int, conn=None):
             "UPDATE users SET exp=$1, level=$2 WHERE user_id=$3",
             new_exp, level, user_id
         )
+        snapshot = _snapshot_for(user_id)
+        if snapshot is not None:
+            snapshot.set(exp=new_exp, level=level)
         if levels_gained > 0:
-            str_inc = await get_setting_int("stat_strength_per_level") * levels_gained
-            agi_inc = await get_setting_int("stat_agility_per_level") * levels_gained
-            def_inc = await get_setting_int("stat_defense_per_level") * levels_gained
-            await update_user_stats(user_id, str_inc, agi_inc, def_inc)
+            str_inc = cfg.get_int("stat_strength_per_level") * levels_gained
+            agi_inc = cfg.get_int("stat_agility_per_level") * levels_gained
+            def_inc = cfg.get_int("stat_defense_per_level") * levels_gained
+            await update_user_stats(user_id, str_inc, agi_inc, def_inc, conn=conn)
             for lvl in range(level - levels_gained + 1, level + 1):
                 await reward_level_up(user_id, lvl, conn)
     if conn:
         await _add(conn)
     else:
-        async with db_pool.acquire() as conn2:
+        async with acquire() as conn2:
             await _add(conn2)
 
 async def reward_level_up(user_id: int, new_level: int, conn=None):
@@ -922,59 +2254,156 @@ async def reward_level_up(user_id: int, new_level: int, conn=None):
         )
         if reward:
             await update_user_balance(user_id, float(reward['coins']), conn=conn)
-            await update_user_reputation(user_id, reward['reputation'])
+            await update_user_reputation(user_id, reward['reputation'], conn=conn)
     if conn:
         await _reward(conn)
     else:
-        async with db_pool.acquire() as conn2:
+        async with acquire() as conn2:
             await _reward(conn2)
 
 async def get_user_level(user_id: int) -> int:
-    async with db_pool.acquire() as conn:
+    snapshot = await _load_snapshot(user_id)
+    if snapshot is not None:
+        return snapshot.get('level') or 1
+    async with acquire() as conn:
         level = await conn.fetchval("SELECT level FROM users WHERE user_id=$1", user_id)
         return level if level is not None else 1
 
 async def get_user_exp(user_id: int) -> int:
-    async with db_pool.acquire() as conn:
+    snapshot = await _load_snapshot(user_id)
+    if snapshot is not None:
+        return snapshot.get('exp') or 0
+    async with acquire() as conn:
         exp = await conn.fetchval("SELECT exp FROM users WHERE user_id=$1", user_id)
         return exp if exp is not None else 0
 
+async def update_user_fields(user_id: int, increments: Dict[str, Any] = None, values: Dict[str, Any] = None, conn=None):
+    """Запись в users для колонок без своего хелпера (счётчики краж, время бонуса и т.п.):
+    increments прибавляются, values присваиваются. Снимок автора апдейта правится сразу,
+    поэтому чтения дальше в том же апдейте не устаревают. Имена колонок — только из кода."""
+    increments, values = increments or {}, values or {}
+    parts, args = [], [user_id]
+    for column, delta in increments.items():
+        args.append(delta)
+        parts.append(f"{column} = COALESCE({column}, 0) + ${len(args)}")
+    for column, value in values.items():
+        args.append(value)
+        parts.append(f"{column} = ${len(args)}")
+    if not parts:
+        return
+    sql = f"UPDATE users SET {', '.join(parts)} WHERE user_id=$1"
+    async def _update(conn):
+        await conn.execute(sql, *args)
+        snapshot = _snapshot_for(user_id)
+        if snapshot is not None:
+            snapshot.add(**{c: d for c, d in increments.items() if c in snapshot.data})
+            snapshot.set(**{c: v for c, v in values.items() if c in snapshot.data})
+    if conn:
+        await _update(conn)
+    else:
+        async with acquire() as new_conn:
+            await _update(new_conn)
+
 async def update_user_total_spent(user_id: int, amount: float):
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         await conn.execute("UPDATE users SET total_spent = total_spent + $1 WHERE user_id=$2", amount, user_id)
 
-async def get_random_user(exclude_id: int):
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow("""
-            SELECT user_id FROM users 
-            WHERE user_id != $1 AND user_id NOT IN (SELECT user_id FROM banned_users)
-            ORDER BY RANDOM() LIMIT 1
-        """, exclude_id)
-        return row['user_id'] if row else None
+# ==================== СЛУЧАЙНАЯ ЦЕЛЬ ДЛЯ КРАЖИ ====================
+THEFT_SAMPLE_SIZE = 20
+THEFT_SAMPLE_ATTEMPTS = 3
+
+class RandomSampler:
+    """Множество id со случайным выбором за O(1): массив плюс позиции, удаление — обменом с последним."""
+    def __init__(self, items=()):
+        self.items: List[int] = []
+        self.positions: Dict[int, int] = {}
+        for item in items:
+            self.add(item)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.positions
+
+    def add(self, item: int):
+        if item in self.positions:
+            return
+        self.positions[item] = len(self.items)
+        self.items.append(item)
+
+    def discard(self, item: int):
+        idx = self.positions.pop(item, None)
+        if idx is None:
+            return
+        last = self.items.pop()
+        if idx < len(self.items):
+            self.items[idx] = last
+            self.positions[last] = idx
+
+    def sample(self, k: int) -> List[int]:
+        if not self.items:
+            return []
+        return list({random.choice(self.items) for _ in range(k)})
+
+# Незабаненные пользователи — кандидаты в жертвы. Пополняется при регистрации (событие
+# шины "new_user"), правится при бане/разбане.
+theft_targets = RandomSampler()
+
+async def load_theft_targets():
+    global theft_targets
+    async with acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT user_id FROM users u WHERE NOT EXISTS (SELECT 1 FROM banned_users b WHERE b.user_id = u.user_id)"
+        )
+    theft_targets = RandomSampler(r['user_id'] for r in rows)
+
+@on_invalidation("new_user")
+async def _refresh_new_user(key: Optional[str]):
+    if key is None:
+        await load_theft_targets()
+    elif int(key) not in banned_user_ids:
+        theft_targets.add(int(key))
+
+async def get_random_user(exclude_id: int, min_balance: float = 0):
+    """Случайный незабаненный игрок, кроме exclude_id, с балансом не меньше min_balance.
+    Берём небольшую выборку из памяти и проверяем баланс одним запросом по первичному ключу."""
+    for _ in range(THEFT_SAMPLE_ATTEMPTS):
+        candidates = [
+            uid for uid in theft_targets.sample(THEFT_SAMPLE_SIZE)
+            if uid != exclude_id and uid not in banned_user_ids
+        ]
+        if not candidates:
+            if len(theft_targets) <= 1:
+                return None
+            continue
+        async with acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT user_id FROM users WHERE user_id = ANY($1::bigint[]) AND balance >= $2",
+                candidates, min_balance
+            )
+        if rows:
+            return random.choice(rows)['user_id']
+    return None
 
 # ==================== ФУНКЦИИ ДЛЯ ГЛОБАЛЬНОГО КУЛДАУНА ====================
 async def check_global_cooldown(user_id: int, command: str) -> Tuple[bool, int]:
-    cooldown = await get_setting_int("global_cooldown_seconds")
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT last_used FROM global_cooldowns WHERE user_id=$1 AND command=$2", user_id, command)
-        if row and row['last_used']:
-            diff = datetime.now() - row['last_used']
-            remaining = cooldown - diff.total_seconds()
-            if remaining > 0:
-                return False, int(remaining)
+    """Быстрая проверка по памяти до ввода ставки; окончательно решает claim_global_cooldown."""
+    remaining = cooldown_remaining(COOLDOWN_GLOBAL, user_id, command)
+    if remaining > 0:
+        return False, int(remaining)
     return True, 0
 
-async def set_global_cooldown(user_id: int, command: str):
-    async with db_pool.acquire() as conn:
-        await conn.execute('''
-            INSERT INTO global_cooldowns (user_id, command, last_used)
-            VALUES ($1, $2, $3)
-            ON CONFLICT (user_id, command) DO UPDATE SET last_used = $3
-        ''', user_id, command, datetime.now())
+async def claim_global_cooldown(user_id: int, command: str) -> Tuple[bool, int]:
+    """Занимает кулдаун перед тем, как игра тронет баланс."""
+    remaining = await claim_cooldown(COOLDOWN_GLOBAL, user_id, command)
+    if remaining > 0:
+        return False, max(int(remaining), 1)
+    return True, 0
 
 # ==================== ФУНКЦИИ ДЛЯ БИЗНЕСОВ ====================
 async def get_business_type_list(only_available: bool = True) -> List[dict]:
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         if only_available:
             rows = await conn.fetch("SELECT * FROM business_types WHERE available = TRUE ORDER BY base_price_btc")
         else:
@@ -987,7 +2416,7 @@ async def get_business_type_list(only_available: bool = True) -> List[dict]:
         return result
 
 async def get_business_type(business_type_id: int) -> Optional[dict]:
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         row = await conn.fetchrow("SELECT * FROM business_types WHERE id=$1", business_type_id)
         if row:
             d = dict(row)
@@ -996,7 +2425,7 @@ async def get_business_type(business_type_id: int) -> Optional[dict]:
         return None
 
 async def get_user_businesses(user_id: int) -> List[dict]:
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         rows = await conn.fetch("""
             SELECT ub.*, bt.name, bt.emoji, bt.base_price_btc, bt.base_income_cents, bt.max_level
             FROM user_businesses ub
@@ -1012,7 +2441,7 @@ async def get_user_businesses(user_id: int) -> List[dict]:
         return result
 
 async def get_user_business(user_id: int, business_type_id: int) -> Optional[dict]:
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         row = await conn.fetchrow("""
             SELECT ub.*, bt.name, bt.emoji, bt.base_price_btc, bt.base_income_cents, bt.max_level
             FROM user_businesses ub
@@ -1038,41 +2467,31 @@ async def get_business_income(business_type: dict, level: int) -> int:
     return business_type['base_income_cents'] * level
 
 async def create_user_business(user_id: int, business_type_id: int):
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         await conn.execute(
             "INSERT INTO user_businesses (user_id, business_type_id, level, last_collection, accumulated) VALUES ($1, $2, $3, $4, $5) ON CONFLICT (user_id, business_type_id) DO NOTHING",
-            user_id, business_type_id, 1, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 0
+            user_id, business_type_id, 1, datetime.now(), 0
         )
 
 async def update_business_income(user_id: int, conn=None):
     async def _update(conn):
-        now = datetime.now()
-        businesses = await conn.fetch(
-            "SELECT ub.*, bt.base_income_cents FROM user_businesses ub JOIN business_types bt ON ub.business_type_id = bt.id WHERE ub.user_id=$1",
-            user_id
-        )
-        for biz in businesses:
-            if biz['last_collection']:
-                try:
-                    last_col = datetime.strptime(biz['last_collection'], "%Y-%m-%d %H:%M:%S")
-                    hours_passed = int((now - last_col).total_seconds() // 3600)
-                    if hours_passed > 0:
-                        income_per_hour = biz['base_income_cents'] * biz['level']
-                        new_accum = biz['accumulated'] + hours_passed * income_per_hour
-                        await conn.execute(
-                            "UPDATE user_businesses SET accumulated=$1, last_collection=$2 WHERE id=$3",
-                            new_accum, now.strftime("%Y-%m-%d %H:%M:%S"), biz['id']
-                        )
-                except:
-                    pass
+        await conn.execute("""
+            UPDATE user_businesses ub
+            SET accumulated = ub.accumulated
+                    + FLOOR(EXTRACT(EPOCH FROM NOW() - ub.last_collection) / 3600)::int * bt.base_income_cents * ub.level,
+                last_collection = NOW()
+            FROM business_types bt
+            WHERE ub.business_type_id = bt.id AND ub.user_id = $1
+              AND ub.last_collection <= NOW() - INTERVAL '1 hour'
+        """, user_id)
     if conn:
         await _update(conn)
     else:
-        async with db_pool.acquire() as new_conn:
+        async with acquire() as new_conn:
             await _update(new_conn)
 
 async def collect_business_income(user_id: int, business_id: int) -> Tuple[bool, str]:
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         async with conn.transaction():
             biz = await conn.fetchrow("SELECT * FROM user_businesses WHERE id=$1 AND user_id=$2", business_id, user_id)
             if not biz:
@@ -1086,12 +2505,12 @@ async def collect_business_income(user_id: int, business_id: int) -> Tuple[bool,
                 await update_user_balance(user_id, float(coins), conn=conn)
             await conn.execute(
                 "UPDATE user_businesses SET accumulated=$1, last_collection=$2 WHERE id=$3",
-                remainder, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), business_id
+                remainder, datetime.now(), business_id
             )
             return True, f"Собрано {coins} баксов и {remainder} центов."
 
 async def upgrade_business(user_id: int, business_id: int) -> Tuple[bool, str]:
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         async with conn.transaction():
             biz = await conn.fetchrow("""
                 SELECT ub.*, bt.base_price_btc, bt.base_income_cents, bt.max_level 
@@ -1117,12 +2536,12 @@ async def upgrade_business(user_id: int, business_id: int) -> Tuple[bool, str]:
 
 # ==================== ФУНКЦИИ ДЛЯ ЧАТОВОГО АВТОРИТЕТА ====================
 async def get_chat_authority(chat_id: int, user_id: int) -> int:
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         val = await conn.fetchval("SELECT authority FROM chat_authority WHERE chat_id=$1 AND user_id=$2", chat_id, user_id)
         return val if val is not None else 0
 
 async def add_chat_authority(chat_id: int, user_id: int, amount: int, damage: int = 0):
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         await conn.execute('''
             INSERT INTO chat_authority (chat_id, user_id, authority, total_damage, fights)
             VALUES ($1, $2, $3, $4, 1)
@@ -1133,12 +2552,12 @@ async def add_chat_authority(chat_id: int, user_id: int, amount: int, damage: in
         ''', chat_id, user_id, amount, damage)
 
 async def get_total_user_authority(user_id: int) -> int:
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         total = await conn.fetchval("SELECT SUM(authority) FROM chat_authority WHERE user_id=$1", user_id)
         return total or 0
 
 async def get_total_user_fights(user_id: int) -> Tuple[int, int]:
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         row = await conn.fetchrow(
             "SELECT SUM(fights) as total_fights, SUM(total_damage) as total_damage FROM chat_authority WHERE user_id=$1",
             user_id
@@ -1149,35 +2568,19 @@ async def spend_chat_authority(chat_id: int, user_id: int, amount: int) -> bool:
     current = await get_chat_authority(chat_id, user_id)
     if current < amount:
         return False
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         await conn.execute("UPDATE chat_authority SET authority = authority - $1 WHERE chat_id=$2 AND user_id=$3", amount, chat_id, user_id)
     return True
 
 async def log_fight(chat_id: int, user_id: int, damage: int, authority: int, outcome: str):
-    async with db_pool.acquire() as conn:
-        await conn.execute(
-            "INSERT INTO fight_logs (chat_id, user_id, timestamp, damage, authority_gained, outcome) VALUES ($1, $2, $3, $4, $5, $6)",
-            chat_id, user_id, datetime.now(), damage, authority, outcome
-        )
-
-async def can_fight(chat_id: int, user_id: int) -> Tuple[bool, int]:
-    cooldown = await get_setting_int("fight_cooldown_minutes")
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT last_fight FROM fight_cooldowns WHERE chat_id=$1 AND user_id=$2", chat_id, user_id)
-        if row and row['last_fight']:
-            diff = datetime.now() - row['last_fight']
-            remaining = cooldown * 60 - diff.total_seconds()
-            if remaining > 0:
-                return False, int(remaining)
-        return True, 0
-
-async def set_fight_cooldown(chat_id: int, user_id: int):
-    async with db_pool.acquire() as conn:
-        await conn.execute('''
-            INSERT INTO fight_cooldowns (chat_id, user_id, last_fight)
-            VALUES ($1, $2, $3)
-            ON CONFLICT (chat_id, user_id) DO UPDATE SET last_fight = $3
-        ''', chat_id, user_id, datetime.now())
+    queue_fight_log(chat_id, user_id, damage, authority, outcome)
+
+async def claim_fight(chat_id: int, user_id: int) -> Tuple[bool, int]:
+    """Занимает кулдаун боя; при успехе бой уже засчитан как начатый."""
+    remaining = await claim_cooldown(COOLDOWN_FIGHT, user_id, chat_id)
+    if remaining > 0:
+        return False, max(int(remaining), 1)
+    return True, 0
 
 # ==================== БОССЫ ====================
 BOSS_NAMES = [
@@ -1205,22 +2608,23 @@ async def spawn_boss(chat_id: int, level: int = None, image_file_id: str = None)
         level = random.randint(1, 5)
     name = random.choice(BOSS_NAMES)
     description = random.choice(BOSS_DESCRIPTIONS)
-    hp_mult = await get_setting_int("boss_hp_multiplier")
+    cfg = settings()
+    hp_mult = cfg.get_int("boss_hp_multiplier")
     hp = level * hp_mult * random.randint(5, 10)
-    base_reward_coins = await get_setting_int("boss_reward_coins")
-    variance_coins = await get_setting_int("boss_reward_coins_variance")
+    base_reward_coins = cfg.get_int("boss_reward_coins")
+    variance_coins = cfg.get_int("boss_reward_coins_variance")
     reward_coins = base_reward_coins + random.randint(-variance_coins, variance_coins)
-    base_reward_btc = await get_setting_int("boss_reward_bitcoin")
-    variance_btc = await get_setting_int("boss_reward_bitcoin_variance")
+    base_reward_btc = cfg.get_int("boss_reward_bitcoin")
+    variance_btc = cfg.get_int("boss_reward_bitcoin_variance")
     reward_btc = base_reward_btc + random.randint(-variance_btc, variance_btc)
     now = datetime.now()
     expires_at = now + timedelta(hours=2)
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         boss_id = await conn.fetchval(
             "INSERT INTO bosses (chat_id, name, level, hp, max_hp, spawned_at, expires_at, reward_coins, reward_bitcoin, participants, status, image_file_id, description) "
             "VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13) RETURNING id",
-            chat_id, name, level, hp, hp, now.strftime("%Y-%m-%d %H:%M:%S"),
-            expires_at.strftime("%Y-%m-%d %H:%M:%S"), reward_coins, reward_btc, [], 'active', image_file_id, description
+            chat_id, name, level, hp, hp, now,
+            expires_at, reward_coins, reward_btc, [], 'active', image_file_id, description
         )
         await conn.execute(
             "UPDATE confirmed_chats SET boss_last_spawn=$1, boss_spawn_count = boss_spawn_count + 1 WHERE chat_id=$2",
@@ -1229,7 +2633,7 @@ async def spawn_boss(chat_id: int, level: int = None, image_file_id: str = None)
     return boss_id
 
 async def finish_boss_fight(boss_id: int):
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         boss = await conn.fetchrow("SELECT * FROM bosses WHERE id=$1", boss_id)
         if not boss or boss['status'] != 'active':
             return
@@ -1243,13 +2647,13 @@ async def finish_boss_fight(boss_id: int):
         btc_per_player = reward_btc // len(participants)
         remainder_coins = reward_coins % len(participants)
         remainder_btc = reward_btc % len(participants)
+        exp = await get_setting_int("exp_per_game_win")
+        deltas = []
         for i, uid in enumerate(participants):
             coins = coins_per_player + (1 if i < remainder_coins else 0)
             btc = btc_per_player + (1 if i < remainder_btc else 0)
-            await update_user_balance(uid, float(coins), conn=conn)
-            await update_user_bitcoin(uid, float(btc), conn=conn)
-            exp = await get_setting_int("exp_per_game_win")
-            await add_exp(uid, exp, conn=conn)
+            deltas.append({'user_id': uid, 'balance': coins, 'bitcoin': btc, 'exp': exp})
+        await apply_wallet_deltas(deltas, conn=conn)
         await conn.execute("UPDATE bosses SET status='defeated' WHERE id=$1", boss_id)
 
 # ==================== ФУНКЦИИ ДЛЯ РАСЧЁТА УРОНА ====================
@@ -1338,26 +2742,21 @@ async def roulette_spin(bet_type: str, bet_number: int = None) -> Tuple[int, str
 
 # ==================== ФУНКЦИИ ДЛЯ КОНТРАБАНДЫ ====================
 async def check_smuggle_cooldown(user_id: int) -> Tuple[bool, int]:
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT cooldown_until FROM smuggle_cooldowns WHERE user_id=$1", user_id)
-        if row and row['cooldown_until']:
-            cooldown_until = row['cooldown_until']
-            if isinstance(cooldown_until, str):
-                cooldown_until = datetime.strptime(cooldown_until, "%Y-%m-%d %H:%M:%S")
-            remaining = (cooldown_until - datetime.now()).total_seconds()
-            if remaining > 0:
-                return False, int(remaining)
+    remaining = await fetch_cooldown_remaining(COOLDOWN_SMUGGLE, user_id)
+    if remaining > 0:
+        return False, max(int(remaining), 1)
     return True, 0
 
 async def set_smuggle_cooldown(user_id: int, penalty: int = 0):
     base = await get_setting_int("smuggle_cooldown_minutes")
-    cooldown_until = datetime.now() + timedelta(minutes=base + penalty)
-    async with db_pool.acquire() as conn:
-        await conn.execute('''
-            INSERT INTO smuggle_cooldowns (user_id, cooldown_until)
-            VALUES ($1, $2)
-            ON CONFLICT (user_id) DO UPDATE SET cooldown_until = $2
-        ''', user_id, cooldown_until)
+    until = datetime.now() + timedelta(minutes=base + penalty)
+    async with acquire() as conn:
+        await conn.execute(
+            "INSERT INTO smuggle_cooldowns (user_id, cooldown_until) VALUES ($1, $2) "
+            "ON CONFLICT (user_id) DO UPDATE SET cooldown_until = $2",
+            user_id, until
+        )
+    cooldown_marks[(COOLDOWN_SMUGGLE, user_id, None)] = until
 
 # ==================== ФУНКЦИИ ДЛЯ МУЛЬТИПЛЕЕРА ====================
 def generate_game_id():
@@ -1389,7 +2788,7 @@ def create_deck():
 
 # ==================== ФУНКЦИИ ДЛЯ БИТКОИН-БИРЖИ ====================
 async def get_order_book() -> Dict[str, List[Dict]]:
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         buy_orders = await conn.fetch("""
             SELECT price, SUM(amount) as total_amount, COUNT(*) as count
             FROM bitcoin_orders
@@ -1421,7 +2820,7 @@ async def get_order_book() -> Dict[str, List[Dict]]:
         return {'bids': bids, 'asks': asks}
 
 async def get_active_orders(order_type: str = None) -> List[dict]:
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         if order_type == 'buy':
             rows = await conn.fetch("SELECT * FROM bitcoin_orders WHERE type='buy' AND status='active' ORDER BY price DESC, created_at ASC")
         elif order_type == 'sell':
@@ -1438,7 +2837,7 @@ async def get_active_orders(order_type: str = None) -> List[dict]:
 
 async def create_bitcoin_order(user_id: int, order_type: str, amount: float, price: int) -> int:
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             async with conn.transaction():
                 if order_type == 'sell':
                     current_btc = await get_user_bitcoin(user_id)
@@ -1470,7 +2869,7 @@ async def create_bitcoin_order(user_id: int, order_type: str, amount: float, pri
         raise ValueError("Внутренняя ошибка сервера. Попробуйте позже.")
 
 async def cancel_bitcoin_order(order_id: int, user_id: int) -> bool:
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         async with conn.transaction():
             order = await conn.fetchrow("SELECT * FROM bitcoin_orders WHERE id=$1 AND user_id=$2 AND status='active'", order_id, user_id)
             if not order:
@@ -1484,6 +2883,7 @@ async def cancel_bitcoin_order(order_id: int, user_id: int) -> bool:
             return True
 
 async def match_orders(conn):
+    deltas = []
     while True:
         buy = await conn.fetchrow("""
             SELECT id, user_id, price, amount, total_locked
@@ -1514,8 +2914,8 @@ async def match_orders(conn):
         buyer_id = buy['user_id']
         seller_id = sell['user_id']
 
-        await update_user_balance(seller_id, total_cost, conn=conn)
-        await update_user_bitcoin(buyer_id, trade_amount, conn=conn)
+        deltas.append({'user_id': seller_id, 'balance': total_cost})
+        deltas.append({'user_id': buyer_id, 'bitcoin': trade_amount})
 
         new_buy_amount = max(0, buy_amount - trade_amount)
         new_sell_amount = max(0, sell_amount - trade_amount)
@@ -1541,6 +2941,7 @@ async def match_orders(conn):
             "INSERT INTO bitcoin_trades (buy_order_id, sell_order_id, amount, price, buyer_id, seller_id) VALUES ($1, $2, $3, $4, $5, $6)",
             buy['id'], sell['id'], trade_amount, trade_price, buyer_id, seller_id
         )
+    await apply_wallet_deltas(deltas, conn=conn)
 
 # ==================== ОЧИСТКА ====================
 async def perform_cleanup(manual=False):
@@ -1554,16 +2955,16 @@ async def perform_cleanup(manual=False):
     days_orders = await get_setting_int("cleanup_days_bitcoin_orders")
 
     now = datetime.now()
-    cutoff_bosses = (now - timedelta(days=days_bosses)).strftime("%Y-%m-%d %H:%M:%S")
-    cutoff_purchases = (now - timedelta(days=days_purchases)).strftime("%Y-%m-%d %H:%M:%S")
-    cutoff_giveaways = (now - timedelta(days=days_giveaways)).strftime("%Y-%m-%d %H:%M:%S")
-    cutoff_tasks = (now - timedelta(days=days_tasks)).strftime("%Y-%m-%d %H:%M:%S")
-    cutoff_smuggle = (now - timedelta(days=days_smuggle)).strftime("%Y-%m-%d %H:%M:%S")
+    cutoff_bosses = now - timedelta(days=days_bosses)
+    cutoff_purchases = now - timedelta(days=days_purchases)
+    cutoff_giveaways = now - timedelta(days=days_giveaways)
+    cutoff_tasks = now - timedelta(days=days_tasks)
+    cutoff_smuggle = now - timedelta(days=days_smuggle)
     cutoff_auctions = now - timedelta(days=days_auctions)
     cutoff_fight = now - timedelta(days=days_fight)
     cutoff_orders = now - timedelta(days=days_orders)
 
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         await conn.execute("DELETE FROM bosses WHERE status IN ('defeated', 'expired') AND spawned_at < $1", cutoff_bosses)
         await conn.execute("DELETE FROM boss_attacks WHERE attack_time < $1", cutoff_bosses)
         await conn.execute("DELETE FROM purchases WHERE status IN ('completed','rejected') AND purchase_date < $1", cutoff_purchases)
@@ -1585,7 +2986,7 @@ async def perform_cleanup(manual=False):
 
 # ==================== ЭКСПОРТ ====================
 async def export_users_to_csv() -> bytes:
-    async with db_pool.acquire() as conn:
+    async with acquire(readonly=True) as conn:
         rows = await conn.fetch("SELECT * FROM users ORDER BY user_id")
     if not rows:
         return b""
@@ -1605,7 +3006,7 @@ ALLOWED_TABLES = ['users', 'purchases', 'bosses', 'auctions', 'giveaways', 'task
 async def export_table_to_csv(table: str) -> Optional[bytes]:
     if table not in ALLOWED_TABLES:
         return None
-    async with db_pool.acquire() as conn:
+    async with acquire(readonly=True) as conn:
         try:
             exists = await conn.fetchval(
                 "SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = $1)",
@@ -1629,15 +3030,146 @@ async def export_table_to_csv(table: str) -> Optional[bytes]:
             writer.writerow(row_dict.values())
         return output.getvalue().encode('utf-8')
 
+# ==================== КЭШ БАНОВ И ПРАВ АДМИНОВ ====================
+# Проверки доступа идут почти на каждый апдейт, поэтому баны и права младших админов
+# держатся в памяти целиком. Запись — сквозная: правка в БД + событие шины "ban"/"admin".
+banned_user_ids: set = set()
+admin_permissions: Dict[int, frozenset] = {}
+
+def _parse_permissions(perms_json: Optional[str]) -> frozenset:
+    if not perms_json:
+        return frozenset()
+    try:
+        return frozenset(json.loads(perms_json))
+    except (TypeError, ValueError):
+        return frozenset()
+
+async def load_access_cache():
+    global banned_user_ids, admin_permissions
+    async with acquire() as conn:
+        bans = await conn.fetch("SELECT user_id FROM banned_users")
+        admins = await conn.fetch("SELECT user_id, permissions FROM admins")
+    banned_user_ids = {r['user_id'] for r in bans}
+    admin_permissions = {r['user_id']: _parse_permissions(r['permissions']) for r in admins}
+    logging.info(f"🔐 Загружено банов: {len(banned_user_ids)}, младших админов: {len(admin_permissions)}")
+
+@on_invalidation("ban")
+async def _refresh_ban(key: Optional[str]):
+    if key is None:
+        await load_access_cache()
+        return
+    user_id = int(key)
+    async with acquire() as conn:
+        banned = await conn.fetchval("SELECT 1 FROM banned_users WHERE user_id=$1", user_id)
+    if banned:
+        banned_user_ids.add(user_id)
+        theft_targets.discard(user_id)
+    else:
+        banned_user_ids.discard(user_id)
+        theft_targets.add(user_id)
+
+@on_invalidation("admin")
+async def _refresh_admin(key: Optional[str]):
+    global admin_permissions
+    if key is None:
+        await load_access_cache()
+        return
+    user_id = int(key)
+    async with acquire() as conn:
+        row = await conn.fetchrow("SELECT permissions FROM admins WHERE user_id=$1", user_id)
+    admins = dict(admin_permissions)
+    if row is None:
+        admins.pop(user_id, None)
+    else:
+        admins[user_id] = _parse_permissions(row['permissions'])
+    admin_permissions = admins
+
+def get_admin_ids() -> List[int]:
+    """Суперадмины и младшие админы — для рассылки уведомлений администрации."""
+    from utils.constants import SUPER_ADMINS
+    return list(dict.fromkeys(list(SUPER_ADMINS) + list(admin_permissions)))
+
+# ==================== ЗАДАНИЯ РАССЫЛОК ====================
+# Рассылка — строка в broadcast_jobs. Получатели идут по users в порядке user_id пачками
+# (keyset: user_id > last_user_id), после каждой пачки прогресс сохраняется, поэтому после
+# перезапуска рассылка продолжается с последней сохранённой пачки. Поле runner — кто сейчас
+# ведёт задание: если его перехватили (продолжили после паузы, перезапуск), старый исполнитель
+# узнает об этом на ближайшем чекпоинте и остановится.
+BROADCAST_RECIPIENTS_SQL = (
+    "SELECT u.user_id FROM users u "
+    "WHERE u.user_id > $1 AND u.unreachable_since IS NULL AND NOT EXISTS (SELECT 1 FROM banned_users b WHERE b.user_id = u.user_id) "
+    "ORDER BY u.user_id LIMIT $2"
+)
+
+async def create_broadcast_job(created_by: int, content: dict, status_chat_id: int, status_message_id: int) -> int:
+    async with acquire() as conn:
+        total = await conn.fetchval(
+            "SELECT COUNT(*) FROM users u WHERE u.unreachable_since IS NULL AND NOT EXISTS (SELECT 1 FROM banned_users b WHERE b.user_id = u.user_id)"
+        )
+        return await conn.fetchval(
+            "INSERT INTO broadcast_jobs (created_by, content, total, status_chat_id, status_message_id) "
+            "VALUES ($1, $2, $3, $4, $5) RETURNING id",
+            created_by, json.dumps(content), total, status_chat_id, status_message_id
+        )
+
+async def get_broadcast_job(job_id: int) -> Optional[dict]:
+    async with acquire() as conn:
+        row = await conn.fetchrow("SELECT * FROM broadcast_jobs WHERE id=$1", job_id)
+    return dict(row) if row else None
+
+async def set_broadcast_status(job_id: int, status: str, from_statuses: List[str]) -> Optional[dict]:
+    """Меняет статус, только если текущий входит в from_statuses. Возвращает задание или None."""
+    async with acquire() as conn:
+        row = await conn.fetchrow(
+            "UPDATE broadcast_jobs SET status=$2, updated_at=NOW() WHERE id=$1 AND status = ANY($3::text[]) RETURNING *",
+            job_id, status, from_statuses
+        )
+    return dict(row) if row else None
+
+async def claim_broadcast(job_id: int, runner: str) -> Optional[dict]:
+    async with acquire() as conn:
+        row = await conn.fetchrow(
+            "UPDATE broadcast_jobs SET runner=$2, updated_at=NOW() WHERE id=$1 AND status='running' RETURNING *",
+            job_id, runner
+        )
+    return dict(row) if row else None
+
+async def fetch_broadcast_batch(after_user_id: int, limit: int) -> List[int]:
+    async with acquire() as conn:
+        rows = await conn.fetch(BROADCAST_RECIPIENTS_SQL, after_user_id, limit)
+    return [r['user_id'] for r in rows]
+
+async def checkpoint_broadcast(job_id: int, runner: str, last_user_id: int, sent: int, failed: int) -> Optional[dict]:
+    """Сохраняет прогресс пачки. None — задание перехватил другой исполнитель."""
+    async with acquire() as conn:
+        row = await conn.fetchrow(
+            "UPDATE broadcast_jobs SET last_user_id=$3, sent=sent+$4, failed=failed+$5, updated_at=NOW() "
+            "WHERE id=$1 AND runner=$2 RETURNING *",
+            job_id, runner, last_user_id, sent, failed
+        )
+    return dict(row) if row else None
+
+async def finish_broadcast(job_id: int, runner: str) -> Optional[dict]:
+    async with acquire() as conn:
+        row = await conn.fetchrow(
+            "UPDATE broadcast_jobs SET status='completed', updated_at=NOW() "
+            "WHERE id=$1 AND runner=$2 AND status='running' RETURNING *",
+            job_id, runner
+        )
+    return dict(row) if row else None
+
+async def get_running_broadcasts() -> List[int]:
+    async with acquire() as conn:
+        rows = await conn.fetch("SELECT id FROM broadcast_jobs WHERE status='running' ORDER BY id")
+    return [r['id'] for r in rows]
+
 # ==================== ДОПОЛНИТЕЛЬНЫЕ ФУНКЦИИ (ПРОВЕРКА ПРАВ, БАН, ПОДПИСКА) ====================
 async def is_super_admin(user_id: int) -> bool:
     from utils.constants import SUPER_ADMINS
     return user_id in SUPER_ADMINS
 
 async def is_junior_admin(user_id: int) -> bool:
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchval("SELECT user_id FROM admins WHERE user_id=$1", user_id)
-    return row is not None
+    return user_id in admin_permissions
 
 async def is_admin(user_id: int) -> bool:
     return await is_super_admin(user_id) or await is_junior_admin(user_id)
@@ -1645,68 +3177,92 @@ async def is_admin(user_id: int) -> bool:
 async def has_permission(user_id: int, permission: str) -> bool:
     if await is_super_admin(user_id):
         return True
-    async with db_pool.acquire() as conn:
-        perms_json = await conn.fetchval("SELECT permissions FROM admins WHERE user_id=$1", user_id)
-    if not perms_json:
-        return False
-    try:
-        perms = json.loads(perms_json)
-        return permission in perms
-    except:
-        return False
+    return permission in admin_permissions.get(user_id, ())
 
 async def is_banned(user_id: int) -> bool:
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchval("SELECT user_id FROM banned_users WHERE user_id=$1", user_id)
-    return row is not None
-
-async def check_subscription(user_id: int):
+    return user_id in banned_user_ids
+
+# Членство в обязательных каналах кэшируется по паре (user, channel): подписку проверяют почти
+# на каждое действие в личке, а последовательные get_chat_member съедают лимиты Bot API.
+# Отрицательный ответ живёт меньше, чтобы только что подписавшийся не ждал долго.
+SUBSCRIPTION_POSITIVE_TTL = 600
+SUBSCRIPTION_NEGATIVE_TTL = 30
+SUBSCRIPTION_CACHE_MAX = 50000
+# (user, channel) -> (подписан; None — Bot API не ответил, момент истечения)
+membership_cache: Dict[Tuple[int, str], Tuple[Optional[bool], float]] = {}
+
+def _prune_membership_cache(now: float):
+    expired = [k for k, (_, expires) in membership_cache.items() if expires <= now]
+    for k in expired:
+        del membership_cache[k]
+    overflow = len(membership_cache) - SUBSCRIPTION_CACHE_MAX
+    if overflow > 0:
+        for k in list(membership_cache)[:overflow]:
+            del membership_cache[k]
+
+async def _is_channel_member(bot, user_id: int, chat_id: str, force: bool) -> Optional[bool]:
+    now = time.monotonic()
+    cached = membership_cache.get((user_id, chat_id))
+    if cached is not None and not force and cached[1] > now:
+        return cached[0]
+    try:
+        # Каналы хранятся как числовой id, в заданиях бывает и @username.
+        chat_ref = int(chat_id) if chat_id.lstrip('-').isdigit() else chat_id
+        member = await bot.get_chat_member(chat_id=chat_ref, user_id=user_id)
+        subscribed = member.status not in ['left', 'kicked']
+    except Exception as e:
+        logging.warning(f"Не удалось проверить подписку {user_id} на {chat_id}: {e}")
+        subscribed = None
+    ttl = SUBSCRIPTION_POSITIVE_TTL if subscribed else SUBSCRIPTION_NEGATIVE_TTL
+    membership_cache.pop((user_id, chat_id), None)
+    membership_cache[(user_id, chat_id)] = (subscribed, time.monotonic() + ttl)
+    if len(membership_cache) > SUBSCRIPTION_CACHE_MAX:
+        _prune_membership_cache(time.monotonic())
+    return subscribed
+
+async def check_subscription(user_id: int, force: bool = False):
+    """force=True игнорирует кэш — для кнопки «Я подписался»."""
     channels = await get_channels()
     if not channels:
         return True, []
-    not_subscribed = []
     from bot_instance import bot
-    for chat_id, title, link in channels:
-        try:
-            chat_id_int = int(chat_id)
-            member = await bot.get_chat_member(chat_id=chat_id_int, user_id=user_id)
-            if member.status in ['left', 'kicked']:
-                not_subscribed.append((title, link))
-        except Exception:
-            not_subscribed.append((title, link))
+    results = await asyncio.gather(*(
+        _is_channel_member(bot, user_id, chat_id, force) for chat_id, _, _ in channels
+    ))
+    not_subscribed = [(title, link) for (_, title, link), ok in zip(channels, results) if not ok]
     return len(not_subscribed) == 0, not_subscribed
 
+async def check_channel_member(user_id: int, chat_id: str, force: bool = False) -> Optional[bool]:
+    """Подписка на один канал через тот же кэш (задания на подписку). None — проверить не удалось."""
+    from bot_instance import bot
+    return await _is_channel_member(bot, user_id, str(chat_id).strip(), force)
+
 async def find_user_by_input(input_str: str) -> Optional[Dict]:
     input_str = input_str.strip()
     try:
         uid = int(input_str)
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             row = await conn.fetchrow("SELECT * FROM users WHERE user_id=$1", uid)
             return dict(row) if row else None
     except ValueError:
         username = input_str.lower()
         if username.startswith('@'):
             username = username[1:]
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             row = await conn.fetchrow("SELECT * FROM users WHERE LOWER(username)=$1", username)
             return dict(row) if row else None
 
 async def get_admin_permissions(user_id: int) -> List[str]:
+    from utils.constants import PERMISSIONS_LIST
     if await is_super_admin(user_id):
-        from utils.constants import PERMISSIONS_LIST
         return PERMISSIONS_LIST.copy()
-    async with db_pool.acquire() as conn:
-        perms_json = await conn.fetchval("SELECT permissions FROM admins WHERE user_id=$1", user_id)
-    if not perms_json:
-        return []
-    try:
-        return json.loads(perms_json)
-    except:
-        return []
+    perms = admin_permissions.get(user_id, frozenset())
+    return [p for p in PERMISSIONS_LIST if p in perms] + sorted(perms.difference(PERMISSIONS_LIST))
 
 async def update_admin_permissions(user_id: int, permissions: List[str]):
-    async with db_pool.acquire() as conn:
+    async with acquire() as conn:
         await conn.execute(
             "UPDATE admins SET permissions=$1 WHERE user_id=$2",
             json.dumps(permissions), user_id
         )
+        await publish_invalidation("admin", user_id, conn=conn)
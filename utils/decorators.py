@@ -36,3 +36,11 @@ def permission_required(permission: str):
             return await func(message, *args, **kwargs)
         return wrapper
     return decorator
+
+def guarded(private_only: bool = True, subscription: bool = True):
+    """Помечает хендлер для GuardMiddleware: бан, строка в users и подписка проверяются
+    в middleware один раз, результат лежит в data['guard']. Сам хендлер не меняется."""
+    def decorator(func):
+        func.guard = {'private_only': private_only, 'subscription': subscription}
+        return func
+    return decorator
@@ -6,47 +6,25 @@ from datetime import datetime, timedelta
 from typing import List, Tuple, Optional, Dict, Any
 
 from aiogram import types
-from aiogram.utils.exceptions import (
-    BotBlocked, UserDeactivated, ChatNotFound, RetryAfter, TelegramAPIError
-)
 
 from bot_instance import bot
+from utils import outbox
 from utils.db import (
-    db_pool, get_setting, get_setting_int, get_setting_float,
-    get_confirmed_chats, get_media_file_id
+    acquire, get_setting, get_setting_int, get_setting_float,
+    get_confirmed_chats, get_media_file_id, is_media_missing, is_banned
 )
 
 async def safe_send_message(user_id: int, text: str, **kwargs):
+    """Ставит сообщение в очередь отправки и не ждёт доставки; ошибки логирует очередь."""
     if kwargs.get('parse_mode') == 'HTML':
         text = html.escape(text)
-    try:
-        await bot.send_message(user_id, text, **kwargs)
-    except BotBlocked:
-        logging.warning(f"Bot blocked by user {user_id}")
-    except UserDeactivated:
-        logging.warning(f"User {user_id} deactivated")
-    except ChatNotFound:
-        logging.warning(f"Chat {user_id} not found")
-    except RetryAfter as e:
-        logging.warning(f"Flood limit exceeded. Retry after {e.timeout} seconds")
-        await asyncio.sleep(e.timeout)
-        try:
-            await bot.send_message(user_id, text, **kwargs)
-        except Exception as ex:
-            logging.warning(f"Still failed after retry: {ex}")
-    except TelegramAPIError as e:
-        logging.warning(f"Telegram API error for user {user_id}: {e}")
-    except Exception as e:
-        logging.warning(f"Failed to send message to {user_id}: {e}")
+    return outbox.send_message(user_id, text, **kwargs)
 
 def safe_send_message_task(user_id: int, text: str, **kwargs):
-    asyncio.create_task(safe_send_message(user_id, text, **kwargs))
+    outbox.send_message(user_id, text, **kwargs)
 
 async def safe_send_chat(chat_id: int, text: str, **kwargs):
-    try:
-        await bot.send_message(chat_id, text, **kwargs)
-    except Exception as e:
-        logging.error(f"Failed to send to chat {chat_id}: {e}")
+    return outbox.send_message(chat_id, text, **kwargs)
 
 async def can_delete_message(chat_id: int, message: types.Message) -> bool:
     try:
@@ -94,6 +72,22 @@ def progress_bar(current: int, total: int, length: int = 10) -> str:
     filled = int(current / total * length)
     return "🟩" * filled + "⬜" * (length - filled)
 
+BROADCAST_STATUS_TITLES = {
+    'running': "⏳ Рассылка идёт",
+    'paused': "⏸ Рассылка на паузе",
+    'cancelled': "✖️ Рассылка отменена",
+    'completed': "✅ Рассылка завершена!",
+}
+
+def broadcast_status_text(job: dict) -> str:
+    done = job['sent'] + job['failed']
+    return (
+        f"{BROADCAST_STATUS_TITLES.get(job['status'], job['status'])} (#{job['id']})\n"
+        f"Прогресс: {done}/{job['total']} {progress_bar(done, job['total'])}\n"
+        f"✅ Отправлено: {job['sent']}\n"
+        f"❌ Ошибок: {job['failed']}"
+    )
+
 def format_time_remaining(seconds: int) -> str:
     if seconds < 60:
         return f"{seconds} сек"
@@ -106,6 +100,16 @@ def format_time_remaining(seconds: int) -> str:
         return f"{hours} ч"
     return f"{hours} ч {minutes} мин"
 
+def format_datetime(value) -> str:
+    """TIMESTAMPTZ из БД приходит в UTC — показываем в локальном времени бота."""
+    if value is None:
+        return "—"
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone()
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return str(value)
+
 def get_random_phrase(phrase_list: List[str], **kwargs) -> str:
     phrase = random.choice(phrase_list)
     return phrase.format(**kwargs)
@@ -113,27 +117,22 @@ def get_random_phrase(phrase_list: List[str], **kwargs) -> str:
 async def notify_chats(message_text: str):
     confirmed = await get_confirmed_chats()
     for chat_id, data in confirmed.items():
-        if not data.get('notify_enabled', True):
+        if not data.get('notify_enabled', True) or data.get('unreachable_since') is not None:
             continue
         await safe_send_chat(chat_id, message_text)
 
-async def is_banned(user_id: int) -> bool:
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchval("SELECT user_id FROM banned_users WHERE user_id=$1", user_id)
-    return row is not None
-
 async def find_user_by_input(input_str: str) -> Optional[Dict]:
     input_str = input_str.strip()
     try:
         uid = int(input_str)
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             row = await conn.fetchrow("SELECT * FROM users WHERE user_id=$1", uid)
             return dict(row) if row else None
     except ValueError:
         username = input_str.lower()
         if username.startswith('@'):
             username = username[1:]
-        async with db_pool.acquire() as conn:
+        async with acquire() as conn:
             row = await conn.fetchrow("SELECT * FROM users WHERE LOWER(username)=$1", username)
             return dict(row) if row else None
 
@@ -144,7 +143,7 @@ async def send_with_media(chat_id: int, text: str, media_key: str = None, **kwar
             if file_id:
                 await bot.send_photo(chat_id, file_id, caption=text, **kwargs)
                 return
-            else:
+            elif is_media_missing(media_key):
                 logging.warning(f"Media key '{media_key}' not found in database")
         except Exception as e:
             logging.error(f"Ошибка отправки фото с ключом {media_key}: {e}", exc_info=True)
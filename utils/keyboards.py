@@ -184,7 +184,7 @@ def active_giveaways_keyboard(giveaways: List[dict], page: int, total_pages: int
     kb = []
     for gw in giveaways:
         kb.append([InlineKeyboardButton(
-            text=f"#{gw['id']} | {gw['prize']} | до {gw['end_date']}",
+            text=f"#{gw['id']} | {gw['prize']} | до {gw['end_date'].astimezone():%d.%m %H:%M}" if gw['end_date'] else f"#{gw['id']} | {gw['prize']}",
             callback_data=f"active_gw_{gw['id']}"
         )])
     nav = []
@@ -250,6 +250,16 @@ def confirm_chat_inline(chat_id: int):
          InlineKeyboardButton(text="❌ Отклонить", callback_data=f"reject_chat_{chat_id}")]
     ])
 
+def broadcast_job_inline(job_id: int, status: str):
+    if status == 'running':
+        row = [InlineKeyboardButton(text="⏸ Пауза", callback_data=f"bcast_pause_{job_id}")]
+    elif status == 'paused':
+        row = [InlineKeyboardButton(text="▶️ Продолжить", callback_data=f"bcast_resume_{job_id}")]
+    else:
+        return None
+    row.append(InlineKeyboardButton(text="✖️ Отменить", callback_data=f"bcast_cancel_{job_id}"))
+    return InlineKeyboardMarkup(inline_keyboard=[row])
+
 def subscription_inline(not_subscribed: List[Tuple[str, str]]):
     kb = []
     for title, link in not_subscribed:
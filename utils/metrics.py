@@ -0,0 +1,82 @@
+import os
+import logging
+
+from aiohttp import web
+
+from utils.db import get_pool_stats, get_query_stats, QUERY_BUCKETS_MS
+from utils.middlewares import throttle_stats
+from utils.outbox import get_outbox_stats
+
+METRICS_PORT = os.getenv("METRICS_PORT")
+
+def render_prometheus() -> str:
+    stats = get_pool_stats(limit=50)
+    lines = [
+        "# TYPE bot_db_pool_size gauge",
+        f"bot_db_pool_size {stats['size']}",
+        "# TYPE bot_db_pool_in_use gauge",
+        f"bot_db_pool_in_use {stats['in_use']}",
+        "# TYPE bot_db_pool_idle gauge",
+        f"bot_db_pool_idle {stats['idle']}",
+        "# TYPE bot_db_pool_max_size gauge",
+        f"bot_db_pool_max_size {stats['max_size']}",
+        "# TYPE bot_db_acquires_total counter",
+        f"bot_db_acquires_total {stats['acquires']}",
+        "# TYPE bot_db_acquire_wait_seconds gauge",
+        f'bot_db_acquire_wait_seconds{{stat="avg"}} {stats["wait_avg"]:.6f}',
+        f'bot_db_acquire_wait_seconds{{stat="p95"}} {stats["wait_p95"]:.6f}',
+        f'bot_db_acquire_wait_seconds{{stat="max"}} {stats["wait_max"]:.6f}',
+        "# TYPE bot_db_background_in_use gauge",
+        f"bot_db_background_in_use {stats['background_in_use']}",
+        "# TYPE bot_db_interactive_wait_seconds gauge",
+        f"bot_db_interactive_wait_seconds {stats['interactive_pressure']:.6f}",
+        "# TYPE bot_db_busy_rejections_total counter",
+        f"bot_db_busy_rejections_total {stats['busy_rejections']}",
+        "# TYPE bot_db_hold_seconds_total counter",
+    ]
+    for h in stats['holders']:
+        lines.append(f'bot_db_hold_seconds_total{{site="{h["site"]}"}} {h["total"]:.6f}')
+    lines.append("# TYPE bot_db_holds_total counter")
+    for h in stats['holders']:
+        lines.append(f'bot_db_holds_total{{site="{h["site"]}"}} {h["count"]}')
+    lines.append("# TYPE bot_db_long_holds gauge")
+    lines.append(f"bot_db_long_holds {len(stats['long_holds'])}")
+    lines.append("# TYPE bot_updates_total counter")
+    lines.append(f'bot_updates_total{{result="passed"}} {throttle_stats["passed"]}')
+    lines.append(f'bot_updates_total{{result="throttled_user"}} {throttle_stats["throttled_user"]}')
+    lines.append(f'bot_updates_total{{result="throttled_chat"}} {throttle_stats["throttled_chat"]}')
+    outbox = get_outbox_stats()
+    lines.append("# TYPE bot_outbox_queue gauge")
+    lines.append(f"bot_outbox_queue {outbox['queue']}")
+    lines.append("# TYPE bot_outbox_parked gauge")
+    lines.append(f"bot_outbox_parked {outbox['parked']}")
+    lines.append("# TYPE bot_outbox_paused_seconds gauge")
+    lines.append(f"bot_outbox_paused_seconds {outbox['paused']:.3f}")
+    lines.append("# TYPE bot_outbox_messages_total counter")
+    for result in ('sent', 'retry_after', 'unreachable', 'failed'):
+        lines.append(f'bot_outbox_messages_total{{result="{result}"}} {outbox[result]}')
+    lines.append("# TYPE bot_db_query_duration_ms histogram")
+    for fingerprint, stat in get_query_stats(limit=50):
+        label = fingerprint[:120].replace("\\", "\\\\").replace('"', '\\"')
+        cumulative = 0
+        for bound, count in zip(QUERY_BUCKETS_MS, stat['buckets']):
+            cumulative += count
+            lines.append(f'bot_db_query_duration_ms_bucket{{query="{label}",le="{bound}"}} {cumulative}')
+        lines.append(f'bot_db_query_duration_ms_bucket{{query="{label}",le="+Inf"}} {stat["count"]}')
+        lines.append(f'bot_db_query_duration_ms_sum{{query="{label}"}} {stat["total"]:.3f}')
+        lines.append(f'bot_db_query_duration_ms_count{{query="{label}"}} {stat["count"]}')
+    return "\n".join(lines) + "\n"
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=render_prometheus(), content_type="text/plain")
+
+async def start_metrics_server():
+    """Поднимает /metrics в формате Prometheus, если задан METRICS_PORT."""
+    if not METRICS_PORT:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", int(METRICS_PORT)).start()
+    logging.info(f"📈 Метрики доступны на :{METRICS_PORT}/metrics")
@@ -0,0 +1,167 @@
+import os
+import time
+import logging
+from collections import Counter
+from typing import Dict, Tuple
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from utils.db import (
+    begin_unit_of_work, end_unit_of_work, begin_user_snapshot, end_user_snapshot,
+    is_banned, is_admin, ensure_user_exists, check_subscription,
+    get_confirmed_chats, mark_reachable
+)
+from utils.keyboards import subscription_inline
+
+# Лимиты: токенов в секунду и размер пачки. Ноль в *_RATE отключает соответствующий лимит.
+THROTTLE_USER_RATE = float(os.getenv("THROTTLE_USER_RATE", "1"))
+THROTTLE_USER_BURST = float(os.getenv("THROTTLE_USER_BURST", "5"))
+THROTTLE_CHAT_RATE = float(os.getenv("THROTTLE_CHAT_RATE", "5"))
+THROTTLE_CHAT_BURST = float(os.getenv("THROTTLE_CHAT_BURST", "20"))
+THROTTLE_PRUNE_EVERY = 1000
+
+throttle_stats: Counter = Counter()
+
+
+class TokenBuckets:
+    """Token bucket на каждый ключ: rate токенов в секунду, не больше burst."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.buckets: Dict[int, Tuple[float, float]] = {}
+
+    def consume(self, key: int) -> bool:
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        tokens, last = self.buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        allowed = tokens >= 1
+        self.buckets[key] = (tokens - 1 if allowed else tokens, now)
+        return allowed
+
+    def prune(self):
+        """Удаляет полностью восстановившиеся корзины — они ничем не отличаются от отсутствующих."""
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        full_after = self.burst / self.rate
+        for key in [k for k, (_, last) in self.buckets.items() if now - last >= full_after]:
+            del self.buckets[key]
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Отбрасывает лишние апдейты пользователя и чата до хендлеров и до любой работы с БД.
+    Должна подключаться первой: CancelHandler в pre-process пропускает все следующие middleware."""
+
+    def __init__(self):
+        super().__init__()
+        self.users = TokenBuckets(THROTTLE_USER_RATE, THROTTLE_USER_BURST)
+        self.chats = TokenBuckets(THROTTLE_CHAT_RATE, THROTTLE_CHAT_BURST)
+        self.notified = set()
+        self.seen = 0
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        event = update.message or update.callback_query
+        if event is None or event.from_user is None:
+            return
+        self.seen += 1
+        if self.seen % THROTTLE_PRUNE_EVERY == 0:
+            self.users.prune()
+            self.chats.prune()
+            # Без корзины серия троттлинга точно закончилась — флаг ответа тоже не нужен.
+            self.notified.intersection_update(self.users.buckets)
+        user_id = event.from_user.id
+        message = update.message or update.callback_query.message
+        chat = message.chat if message else None
+        if not self.users.consume(user_id):
+            scope = "user"
+        elif chat is not None and chat.type != 'private' and not self.chats.consume(chat.id):
+            scope = "chat"
+        else:
+            throttle_stats["passed"] += 1
+            self.notified.discard(user_id)
+            return
+        throttle_stats[f"throttled_{scope}"] += 1
+        # Кнопка без ответа крутит «часики», поэтому один раз за серию отвечаем на callback.
+        if update.callback_query and user_id not in self.notified:
+            self.notified.add(user_id)
+            try:
+                await update.callback_query.answer("⏳ Не так быстро!")
+            except Exception as e:
+                logging.debug(f"Не удалось ответить на callback при троттлинге: {e}")
+        raise CancelHandler()
+
+
+class UnitOfWorkMiddleware(BaseMiddleware):
+    """Открывает единицу работы на каждый апдейт: вложенные хелперы utils/db.py делят одно соединение,
+    пока открыт внешний блок acquire() или транзакция."""
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        data['uow_token'] = begin_unit_of_work()
+
+    async def on_post_process_update(self, update: types.Update, result, data: dict):
+        token = data.pop('uow_token', None)
+        if token is not None:
+            await end_unit_of_work(token)
+
+
+class UserSnapshotMiddleware(BaseMiddleware):
+    """Заводит ленивый снимок горячих колонок автора апдейта: SELECT выполнится, только когда
+    хелпер впервые спросит баланс, уровень и т.п."""
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        event = update.message or update.callback_query
+        if event is None or event.from_user is None:
+            return
+        data['snapshot_token'] = begin_user_snapshot(event.from_user.id)
+        message = update.message or update.callback_query.message
+        chat = message.chat if message else None
+        if chat is None:
+            return
+        # Исключение в pre-process пропускает все post-process, и UnitOfWorkMiddleware не вернёт
+        # соединение в пул, поэтому всё, что может сходить в БД, — только внутри try.
+        try:
+            if chat.type == 'private':
+                # Пользователь пишет боту в личку — значит, не заблокировал его: возвращаем в рассылки.
+                # Это запись в буфер отложенной записи, сам апдейт в БД не ходит.
+                mark_reachable(event.from_user.id)
+            else:
+                chat_data = (await get_confirmed_chats()).get(chat.id)
+                if chat_data and chat_data.get('unreachable_since') is not None:
+                    mark_reachable(chat.id)
+        except Exception as e:
+            logging.warning(f"Не удалось проверить доступность чата {chat.id}: {e}")
+
+    async def on_post_process_update(self, update: types.Update, result, data: dict):
+        token = data.pop('snapshot_token', None)
+        if token is not None:
+            end_user_snapshot(token)
+
+
+class GuardMiddleware(BaseMiddleware):
+    """Общая преамбула хендлеров, помеченных @guarded(): бан → строка в users → подписка.
+    Баны и права в памяти, пользователь обычно уже в снимке, членство в каналах кэшировано,
+    так что в типичном случае это ни одного запроса. Результат — data['guard']."""
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        handler = current_handler.get()
+        flags = getattr(handler, 'guard', None)
+        if flags is None:
+            return
+        if flags['private_only'] and message.chat.type != 'private':
+            raise CancelHandler()
+        user = message.from_user
+        admin = await is_admin(user.id)
+        if not admin and await is_banned(user.id):
+            raise CancelHandler()
+        created, bonus = await ensure_user_exists(user.id, user.username, user.first_name)
+        if flags['subscription']:
+            ok, not_subscribed = await check_subscription(user.id)
+            if not ok:
+                await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
+                raise CancelHandler()
+        data['guard'] = {'is_admin': admin, 'created': created, 'bonus': bonus}
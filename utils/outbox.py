@@ -0,0 +1,239 @@
+import os
+import time
+import asyncio
+import logging
+import itertools
+from collections import Counter
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram.utils.exceptions import (
+    BotBlocked, UserDeactivated, ChatNotFound, RetryAfter, TelegramAPIError
+)
+
+from bot_instance import bot
+from utils.db import mark_unreachable
+
+# ==================== ОЧЕРЕДЬ ИСХОДЯЩИХ СООБЩЕНИЙ ====================
+# Лимиты Telegram: около 30 сообщений в секунду на бота, 1 в секунду в один личный чат,
+# 20 в минуту в одну группу. Прямые ответы хендлеров (message.answer, edit_text и т.п.)
+# в очередь не встают, но берут слот того же общего лимита и ждут ту же паузу RetryAfter
+# (см. RateLimitedBot в bot_instance.py). Лимит ниже 30 — запас на прочие методы API.
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "25"))
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "8"))
+OUTBOX_PRIVATE_INTERVAL = 1.0
+OUTBOX_GROUP_INTERVAL = 3.0
+OUTBOX_MAX_RETRIES = 3
+OUTBOX_PRUNE_INTERVAL = 60
+# Массовые рассылки не кладут в очередь больше этого числа заданий сразу, иначе
+# реклама на всю базу займёт память и надолго отодвинет уведомления.
+OUTBOX_BULK_BACKLOG = int(os.getenv("OUTBOX_BULK_BACKLOG", "1000"))
+OUTBOX_BACKLOG_POLL = 0.5
+
+# Полосы приоритета: интерактив — прямые ответы хендлеров, слот берут сразу, отодвигая
+# очередь (interactive_slot); в очереди игровые уведомления раньше массовых рассылок.
+PRIORITY_NOTIFY = 1
+PRIORITY_BULK = 2
+
+UNREACHABLE_ERRORS = (BotBlocked, UserDeactivated, ChatNotFound)
+# Методы, которые расходуют лимит сообщений; getUpdates, getChatMember и т.п. не ограничиваем.
+RATE_LIMITED_PREFIXES = ('send', 'edit', 'copy', 'forward')
+
+
+class OutboxJob:
+    __slots__ = ('chat_id', 'factory', 'future', 'reserved', 'attempts')
+
+    def __init__(self, chat_id: int, factory: Callable[[], Awaitable[Any]]):
+        self.chat_id = chat_id
+        self.factory = factory
+        self.future = asyncio.get_event_loop().create_future()
+        self.reserved = False
+        self.attempts = 0
+
+
+outbox_queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+_sequence = itertools.count()
+chat_next_slot: Dict[int, float] = {}
+global_next_slot: float = 0
+paused_until: float = 0
+next_prune: float = 0
+outbox_stats: Counter = Counter()
+outbox_workers: List[asyncio.Task] = []
+# Вызов бота идёт из воркера очереди: слот уже занят, RetryAfter обработает _deliver.
+outbox_call: ContextVar[bool] = ContextVar("outbox_call", default=False)
+# Задания, ждущие слота своего чата вне очереди. Для join() они остаются незавершёнными.
+parked_jobs: Dict[OutboxJob, asyncio.TimerHandle] = {}
+
+def submit(chat_id: int, factory: Callable[[], Awaitable[Any]], priority: int = PRIORITY_NOTIFY) -> asyncio.Future:
+    """Ставит отправку в очередь и сразу возвращается. Future получит отправленное сообщение
+    или None, если доставить не удалось; исключений он не содержит."""
+    job = OutboxJob(chat_id, factory)
+    outbox_queue.put_nowait((priority, next(_sequence), job))
+    outbox_stats['queued'] += 1
+    return job.future
+
+def send(chat_id: int, method: str, *args, priority: int = PRIORITY_NOTIFY, **kwargs) -> asyncio.Future:
+    """submit для метода бота: send(chat_id, 'send_photo', file_id, caption=...)."""
+    return submit(chat_id, lambda: getattr(bot, method)(chat_id, *args, **kwargs), priority)
+
+def send_message(chat_id: int, text: str, priority: int = PRIORITY_NOTIFY, **kwargs) -> asyncio.Future:
+    return send(chat_id, 'send_message', text, priority=priority, **kwargs)
+
+def _requeue(priority: int, seq: int, job: OutboxJob):
+    outbox_queue.put_nowait((priority, seq, job))
+
+def _unpark(priority: int, seq: int, job: OutboxJob):
+    # Сначала кладём, потом закрываем выборку, с которой задание ушло на ожидание, —
+    # счётчик незавершённых не обнуляется посередине.
+    parked_jobs.pop(job, None)
+    outbox_queue.put_nowait((priority, seq, job))
+    outbox_queue.task_done()
+
+async def wait_for_room(limit: int = OUTBOX_BULK_BACKLOG):
+    """Для массовых рассылок: ждёт, пока в очереди (вместе с отложенными) меньше limit заданий."""
+    while outbox_queue.qsize() + len(parked_jobs) >= limit:
+        await asyncio.sleep(OUTBOX_BACKLOG_POLL)
+
+def note_retry_after(timeout: float):
+    """Флуд-лимит общий для бота — ставим на паузу все воркеры и прямые ответы."""
+    global paused_until
+    paused_until = max(paused_until, time.monotonic() + timeout)
+    outbox_stats['retry_after'] += 1
+    logging.warning(f"Flood limit exceeded. Отправка на паузе {timeout} с")
+
+async def interactive_slot():
+    """Слот общего лимита для прямого ответа хендлера: ждёт только паузу RetryAfter,
+    а не очередь, и сдвигает следующий слот очереди."""
+    global global_next_slot
+    now = time.monotonic()
+    slot = max(now, paused_until)
+    global_next_slot = max(global_next_slot, slot) + 1 / OUTBOX_GLOBAL_RATE
+    if slot > now:
+        await asyncio.sleep(slot - now)
+
+async def direct_request(call: Callable[..., Awaitable[Any]], method: str, *args, **kwargs):
+    """Обёртка Bot.request для вызовов мимо очереди."""
+    if outbox_call.get():
+        return await call(method, *args, **kwargs)
+    if method.startswith(RATE_LIMITED_PREFIXES):
+        await interactive_slot()
+    try:
+        return await call(method, *args, **kwargs)
+    except RetryAfter as e:
+        note_retry_after(e.timeout)
+        raise
+
+async def _deliver(priority: int, seq: int, job: OutboxJob):
+    result = None
+    try:
+        token = outbox_call.set(True)
+        try:
+            result = await job.factory()
+        finally:
+            outbox_call.reset(token)
+        outbox_stats['sent'] += 1
+    except RetryAfter as e:
+        note_retry_after(e.timeout)
+        job.attempts += 1
+        if job.attempts <= OUTBOX_MAX_RETRIES:
+            job.reserved = False
+            _requeue(priority, seq, job)
+            return
+        outbox_stats['failed'] += 1
+    except UNREACHABLE_ERRORS as e:
+        outbox_stats['unreachable'] += 1
+        mark_unreachable(job.chat_id)
+        logging.warning(f"Получатель {job.chat_id} недоступен: {e}")
+    except TelegramAPIError as e:
+        outbox_stats['failed'] += 1
+        logging.warning(f"Telegram API error for chat {job.chat_id}: {e}")
+    except Exception as e:
+        outbox_stats['failed'] += 1
+        logging.warning(f"Failed to send message to {job.chat_id}: {e}")
+    if not job.future.done():
+        job.future.set_result(result)
+
+def _prune_slots(now: float):
+    global next_prune
+    next_prune = now + OUTBOX_PRUNE_INTERVAL
+    for chat_id in [c for c, slot in chat_next_slot.items() if slot <= now]:
+        del chat_next_slot[chat_id]
+
+async def outbox_worker():
+    global global_next_slot
+    loop = asyncio.get_running_loop()
+    while True:
+        priority, seq, job = await outbox_queue.get()
+        parked = False
+        try:
+            now = time.monotonic()
+            if not job.reserved:
+                # Слот в чате бронируется при первой выборке: так сообщения в один чат
+                # не обгоняют друг друга, а воркер не спит, пока чат «остывает».
+                interval = OUTBOX_PRIVATE_INTERVAL if job.chat_id > 0 else OUTBOX_GROUP_INTERVAL
+                slot = max(now, chat_next_slot.get(job.chat_id, 0))
+                chat_next_slot[job.chat_id] = slot + interval
+                job.reserved = True
+                if slot > now:
+                    parked_jobs[job] = loop.call_later(slot - now, _unpark, priority, seq, job)
+                    parked = True
+                    continue
+            slot = max(now, global_next_slot, paused_until)
+            global_next_slot = slot + 1 / OUTBOX_GLOBAL_RATE
+            if slot > now:
+                await asyncio.sleep(slot - now)
+            await _deliver(priority, seq, job)
+            # По времени, а не по числу успешных отправок: при сплошных ошибках счётчик
+            # sent стоит на месте, и проверка по нему чистила бы словарь после каждой доставки.
+            now = time.monotonic()
+            if now >= next_prune:
+                _prune_slots(now)
+        except Exception as e:
+            logging.error(f"Ошибка воркера очереди отправки: {e}", exc_info=True)
+            if not job.future.done():
+                job.future.set_result(None)
+        finally:
+            if not parked:
+                outbox_queue.task_done()
+
+def start_outbox():
+    if outbox_workers:
+        return
+    for _ in range(OUTBOX_WORKERS):
+        outbox_workers.append(asyncio.create_task(outbox_worker()))
+    logging.info(f"📤 Очередь отправки запущена: {OUTBOX_WORKERS} воркеров, до {OUTBOX_GLOBAL_RATE:g} сообщений/с")
+
+async def stop_outbox(timeout: float = 10):
+    """Даёт очереди дослать накопленное, затем останавливает воркеры."""
+    try:
+        await asyncio.wait_for(outbox_queue.join(), timeout=timeout)
+    except asyncio.TimeoutError:
+        logging.warning(
+            f"Очередь отправки не успела опустеть, осталось {outbox_queue.qsize()}, отложено {len(parked_jobs)}"
+        )
+    for task in outbox_workers:
+        task.cancel()
+    outbox_workers.clear()
+    # Недосланное отдаём ожидающим как None, чтобы никто не завис на future.
+    for job, handle in list(parked_jobs.items()):
+        handle.cancel()
+        if not job.future.done():
+            job.future.set_result(None)
+    parked_jobs.clear()
+    while not outbox_queue.empty():
+        _, _, job = outbox_queue.get_nowait()
+        outbox_queue.task_done()
+        if not job.future.done():
+            job.future.set_result(None)
+
+def get_outbox_stats() -> dict:
+    return {
+        'queue': outbox_queue.qsize(),
+        'parked': len(parked_jobs),
+        'paused': max(paused_until - time.monotonic(), 0),
+        'sent': outbox_stats['sent'],
+        'queued': outbox_stats['queued'],
+        'retry_after': outbox_stats['retry_after'],
+        'unreachable': outbox_stats['unreachable'],
+        'failed': outbox_stats['failed'],
+    }